@@ -28,6 +28,13 @@ setup(name='simpleais',
               'aisstat = simpleais.tools:stat',
               'aisrefine = simpleais.tools:refine',
               'ais2json = simpleais.tools:to_json',
+              'aisserve = simpleais.tools:serve',
+              'aisshare = simpleais.tools:share',
+              'aisdedup = simpleais.tools:dedup',
+              'aissort = simpleais.tools:sort',
+              'aisfence = simpleais.tools:fence',
+              'aisheatmap = simpleais.tools:heatmap',
+              'aiswindow = simpleais.tools:window',
           ],
       },
       )
@@ -1,10 +1,20 @@
+import bz2
 import calendar
 import collections
 import gzip
+import hashlib
+import heapq
+import io
 import json
 import logging
+import lzma
+import math
 import os
+import random
 import re
+import shutil
+import subprocess
+import threading
 import time
 from functools import reduce
 from io import TextIOBase
@@ -426,6 +436,7 @@ class BitFieldDecoder(FieldDecoder):
         self.name = name
         self.start = start
         self.end = end
+        self.data_type = data_type
         self.length = 1 + end - start
         self.bit_range = slice(start, end + 1)
         self.description = description
@@ -464,9 +475,9 @@ class BitFieldDecoder(FieldDecoder):
             if name in ['status', 'shiptype']:
                 def lookup(p):
                     i = self.int(p)
-                    if i not in ENUM_LOOKUPS[name]:
-                        ENUM_LOOKUPS[name][i] = AisEnum(i, "enum-unknown-{}".format(i))
-                    return ENUM_LOOKUPS[name][i]
+                    if i in ENUM_LOOKUPS[name]:
+                        return ENUM_LOOKUPS[name][i]
+                    return _unknown_enum(name, i)
                 return lookup
             return lambda p: "enum-{}".format(self.int(p))  # TODO: find and include enumerated types
         elif data_type == 'b':
@@ -628,6 +639,18 @@ def _load_decoders(source_file):
 
 
 MESSAGE_DECODERS, ENUM_LOOKUPS = _load_decoders('aivdm.json')
+_UNKNOWN_ENUMS = collections.defaultdict(dict)
+
+
+def _unknown_enum(name, key):
+    """
+    An AisEnum for a code missing from ENUM_LOOKUPS. These are cached apart, so decoding
+    one doesn't change the published lookups that callers and tests inspect.
+    """
+    unknown = _UNKNOWN_ENUMS[name]
+    if key not in unknown:
+        unknown[key] = AisEnum(key, "enum-unknown-{}".format(key))
+    return unknown[key]
 
 BACKUP_DECODER = MessageDecoder({
     "name": "Unknown message",
@@ -860,14 +883,127 @@ class FragmentPool:
             self.fragments.clear()
 
 
-def lines_from_source(source):
-    if isinstance(source, TextIOBase):
+class ReadAhead:
+    """
+    Reads lines on a separate thread into a bounded buffer that the consumer drains
+    as it goes. Blocking reads and decompression then overlap with parsing, a consumer
+    that keeps up gets each line as it arrives, and one that falls behind finds the
+    lines already waiting. The buffer holds up to depth batches of batch_size lines,
+    after which the reader waits.
+    """
+
+    def __init__(self, lines, depth=64, batch_size=1000):
+        self.lines = lines
+        self.batch_size = batch_size
+        self.limit = depth * batch_size
+        self.buffer = collections.deque()
+        self.ready = threading.Condition()
+        self.reader_waiting = False
+        self.consumer_waiting = False
+        self.error = None
+        self.done = False
+        self.lines_read = 0
+        self.max_depth = 0
+        self.reader_stall = 0.0
+        self.consumer_stall = 0.0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._read, name="read-ahead", daemon=True)
+        self.thread.start()
+
+    def _wait_for_room(self):
+        start = time.time()
+        with self.ready:
+            self.reader_waiting = True
+            while len(self.buffer) >= self.limit and not self.stopped.is_set():
+                self.ready.wait(0.1)
+            self.reader_waiting = False
+        self.reader_stall += time.time() - start
+
+    def _wake(self):
+        with self.ready:
+            self.ready.notify_all()
+
+    def _read(self):
+        buffer = self.buffer
+        try:
+            for line in self.lines:
+                if len(buffer) >= self.limit:
+                    self._wait_for_room()
+                if self.stopped.is_set():
+                    return
+                buffer.append(line)
+                self.lines_read += 1
+                if self.consumer_waiting:
+                    self._wake()
+                if self.lines_read % self.batch_size == 0:
+                    self.max_depth = max(self.max_depth, self.depth())
+        except Exception as e:
+            self.error = e
+        finally:
+            if hasattr(self.lines, 'close'):
+                self.lines.close()
+            self.done = True
+            self._wake()
+
+    def _wait_for_lines(self):
+        start = time.time()
+        with self.ready:
+            self.consumer_waiting = True
+            while not self.buffer and not self.done:
+                self.ready.wait(0.1)
+            self.consumer_waiting = False
+        self.consumer_stall += time.time() - start
+
+    def __iter__(self):
+        buffer = self.buffer
+        try:
+            while True:
+                try:
+                    line = buffer.popleft()
+                except IndexError:
+                    if self.done and not buffer:
+                        if self.error:
+                            raise self.error
+                        break
+                    self._wait_for_lines()
+                    continue
+                if self.reader_waiting and len(buffer) < self.limit // 2:
+                    self._wake()
+                yield line
+        finally:
+            self.close()
+
+    def close(self):
+        self.stopped.set()
+        self.buffer.clear()
+        self._wake()
+
+    def depth(self):
+        return -(-len(self.buffer) // self.batch_size)
+
+    def stats(self):
+        return {'lines': self.lines_read, 'depth': self.depth(), 'max_depth': self.max_depth,
+                'reader_stall': self.reader_stall, 'consumer_stall': self.consumer_stall}
+
+
+def lines_from_source(source, read_ahead=None, follow=False, report=False):
+    if read_ahead:
+        reader = ReadAhead(lines_from_source(source, follow=follow), read_ahead)
+        yield from reader
+        stats = reader.stats()
+        message = "read-ahead for {}: {} lines, peak depth {} of {}, reader stalled {:.2f}s, consumer stalled {:.2f}s"
+        logging.getLogger().log(logging.WARNING if report else logging.DEBUG,
+                                message.format(getattr(source, 'name', source), stats['lines'], stats['max_depth'],
+                                               read_ahead, stats['reader_stall'], stats['consumer_stall']))
+    elif isinstance(source, (TextIOBase, ReadAhead)):
         for line in source:
             yield line
     elif re.match("/dev/tty.*", source):
         yield from _handle_serial_source(source)
     elif re.match("https?://.*", source):
         yield from _handle_url_source(source)
+    elif follow:
+        yield from follow_file(source)
     else:
         # assume it's a file
         yield from _handle_file_source(source)
@@ -886,9 +1022,19 @@ def fragments_from_source(source, log_errors=False):
             logging.getLogger().error("unexpected failure for line {} in source {}".format(line, source), exc_info=True)
 
 
-def sentences_from_source(source, log_errors=False):
+def sentences_from_source(source, log_errors=False, read_ahead=None, follow=False):
+    """
+    Yields complete sentences from a file name, URL, serial device, or open text stream.
+    Pass read_ahead=N to read on a separate thread, buffering up to N batches of lines;
+    its line count, peak depth and stall times are logged at the end, as a warning with
+    log_errors. With follow, a file is read as it grows and across rotations (see follow_file).
+    """
+    yield from _sentences_from_lines(lines_from_source(source, read_ahead, follow, log_errors), source, log_errors)
+
+
+def _sentences_from_lines(lines, source, log_errors=False):
     parser = StreamParser(log_errors=log_errors)
-    for fragment in lines_from_source(source):
+    for fragment in lines:
         # noinspection PyBroadException
         try:
             parser.add(fragment)
@@ -899,6 +1045,314 @@ def sentences_from_source(source, log_errors=False):
                                       exc_info=True)
 
 
+class Deduplicator:
+    """
+    Spots repeats of a transmission, such as the same message heard by several receivers,
+    by comparing payloads regardless of talker and channel. Payloads are remembered in two
+    rotating generations, each covering the window, so memory holds at most two windows'
+    worth; max_entries caps a generation for feeds that are busier than expected.
+    """
+
+    def __init__(self, window=10.0, max_entries=1000000):
+        self.window = window
+        self.max_entries = max_entries
+        self.current = {}
+        self.previous = {}
+        self.generation_start = None
+        self.seen_count = 0
+        self.duplicate_count = 0
+
+    def key(self, sentence):
+        return hash((sentence.type_num, "".join(l.ascii for l in sentence.payload.data),
+                     sentence.payload.data[-1].fill))
+
+    def is_duplicate(self, sentence):
+        now = sentence.time if sentence.time is not None else time.time()
+        if self.generation_start is None:
+            self.generation_start = now
+        elif now - self.generation_start > self.window or len(self.current) >= self.max_entries:
+            self.previous = self.current
+            self.current = {}
+            self.generation_start = now
+
+        self.seen_count += 1
+        key = self.key(sentence)
+        last_seen = self.current.get(key)
+        if last_seen is None:
+            last_seen = self.previous.get(key)
+        self.current[key] = now
+        if last_seen is not None and abs(now - last_seen) <= self.window:
+            self.duplicate_count += 1
+            return True
+        return False
+
+
+def deduplicate(sentences, window=10.0, deduplicator=None):
+    if deduplicator is None:
+        deduplicator = Deduplicator(window)
+    for sentence in sentences:
+        if not deduplicator.is_duplicate(sentence):
+            yield sentence
+
+
+def reorder_by_time(sentences, lateness=0.0):
+    """
+    Puts a nearly time-ordered stream in order, holding back only the sentences within
+    lateness seconds of the newest seen. Anything later than that passes through as is.
+    Sentences without a time stay next to their predecessor.
+    """
+    held = []
+    newest = None
+    count = 0
+    for sentence in sentences:
+        if sentence.time is not None:
+            t = sentence.time
+        else:
+            t = newest if newest is not None else float('-inf')
+        heapq.heappush(held, (t, count, sentence))
+        count += 1
+        if newest is None or t > newest:
+            newest = t
+        while held and held[0][0] <= newest - lateness:
+            yield heapq.heappop(held)[2]
+    while held:
+        yield heapq.heappop(held)[2]
+
+
+def merge_by_time(streams, lateness=0.0):
+    """
+    Interleaves several sentence streams into one in time order, keeping only the next
+    sentence of each stream (plus anything within lateness) in memory.
+    """
+
+    def keyed(stream):
+        last = float('-inf')
+        for sentence in reorder_by_time(stream, lateness):
+            if sentence.time is not None:
+                last = sentence.time
+            yield last, sentence
+
+    for t, sentence in heapq.merge(*[keyed(s) for s in streams], key=lambda item: item[0]):
+        yield sentence
+
+
+_BYTE_RANGE_LOOKBACK = 64 * 1024
+
+
+def sentences_from_byte_range(source, start, end, log_errors=False):
+    """
+    Yields the sentences of a plain file that are completed by a line starting within
+    [start, end), so that adjacent ranges together yield exactly what the whole file does.
+    Reading begins a little before start to pick up earlier fragments.
+    """
+    parser = StreamParser(log_errors=log_errors)
+    with open(source, 'rb') as f:
+        position = max(0, start - _BYTE_RANGE_LOOKBACK)
+        f.seek(position)
+        if position > 0:
+            position += len(f.readline())  # almost certainly partial
+        for raw_line in f:
+            line_start = position
+            position += len(raw_line)
+            if line_start >= end:
+                break
+            line = raw_line.decode('utf-8', errors='replace')
+            parser.log_errors = log_errors and line_start >= start
+            # noinspection PyBroadException
+            try:
+                parser.add(line)
+                if parser.has_sentence():
+                    sentence = parser.next_sentence()
+                    if line_start >= start:
+                        yield sentence
+            except Exception:
+                logging.getLogger().error("unexpected failure for fragment {} in source {}".format(line, source),
+                                          exc_info=True)
+
+
+def hash64(value):
+    """A 64-bit hash of a value's text that, unlike hash(), is the same in every process."""
+    return int.from_bytes(hashlib.blake2b(str(value).encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class Sampler:
+    """
+    Reads a sample of the sources instead of everything, counting what it saw and kept so
+    that totals can be scaled up. The kinds of sample are
+
+        lines       every amount-th sentence, picked from the raw lines before parsing;
+                    the later fragments of a multi-part sentence go with its first
+        blocks      an amount (0 to 1) of a plain file's blocks of block_size bytes, picked
+                    at random and reached by seeking; other sources are taken in blocks of
+                    lines_per_block lines, of which one in every 1 / amount is kept
+        vessels     every sentence from an amount (0 to 1) of the senders, picked by a hash
+                    of the MMSI, so tracks stay whole and the same senders are picked each time
+        reservoir   amount sentences picked uniformly from all of them, held until the end
+
+    The random choices are seeded, so the same sources give the same sample.
+    """
+
+    KINDS = ('lines', 'blocks', 'vessels', 'reservoir')
+
+    def __init__(self, kind, amount, block_size=1 << 20, lines_per_block=10000, seed=0):
+        if kind not in self.KINDS:
+            raise ValueError("unknown kind of sample {!r}; try one of {}".format(kind, ", ".join(self.KINDS)))
+        if kind in ('lines', 'reservoir') and (amount != int(amount) or amount < 1):
+            raise ValueError("a {} sample needs a whole number of at least 1, not {}".format(kind, amount))
+        if kind in ('blocks', 'vessels') and not 0 < amount <= 1:
+            raise ValueError("a {} sample needs a fraction above 0 and at most 1, not {}".format(kind, amount))
+        self.kind = kind
+        self.amount = int(amount) if kind in ('lines', 'reservoir') else amount
+        self.block_size = block_size
+        self.lines_per_block = lines_per_block
+        self.random = random.Random(seed)
+        self.seen = 0
+        self.kept = 0
+
+    @classmethod
+    def from_text(cls, text):
+        """A Sampler from text like "lines:100", "blocks:0.01", "vessels:0.1" or "reservoir:10000"."""
+        kind, ignored, amount = text.partition(':')
+        try:
+            amount = float(amount)
+        except ValueError:
+            raise ValueError("expected a kind of sample and an amount, like lines:100, not {!r}".format(text))
+        return cls(kind, amount)
+
+    def sentences(self, source, log_errors=False):
+        """The sampled sentences of one source; a reservoir is only chosen in select()."""
+        if self.kind == 'lines':
+            yield from _sentences_from_lines(self._sample_lines(lines_from_source(source)), source, log_errors)
+        elif self.kind == 'blocks':
+            yield from self._sample_blocks(source, log_errors)
+        elif self.kind == 'vessels':
+            threshold = int(self.amount * 2 ** 64)
+            for sentence in sentences_from_source(source, log_errors):
+                self.seen += 1
+                mmsi = sentence['mmsi']
+                if mmsi is not None and hash64(mmsi) < threshold:
+                    self.kept += 1
+                    yield sentence
+        else:
+            yield from sentences_from_source(source, log_errors)
+
+    def select(self, sentences):
+        """Passes sentences through, except for a reservoir sample, which it picks from them."""
+        if self.kind != 'reservoir':
+            yield from sentences
+            return
+        reservoir = []
+        for i, sentence in enumerate(sentences):
+            self.seen += 1
+            if i < self.amount:
+                reservoir.append((i, sentence))
+            else:
+                j = self.random.randint(0, i)
+                if j < self.amount:
+                    reservoir[j] = (i, sentence)
+        self.kept = len(reservoir)
+        for ignored, sentence in sorted(reservoir, key=lambda item: item[0]):
+            yield sentence
+
+    def _sample_lines(self, lines):
+        offset = self.random.randrange(self.amount)
+        keeping = False
+        for line in lines:
+            start = line.find('!')
+            fragment_number = line[start + 9:start + 10] if start >= 0 else ''
+            if fragment_number and fragment_number in '23456789':
+                # a later fragment, kept if its first was
+                if keeping:
+                    yield line
+                continue
+            keeping = (self.seen + offset) % self.amount == 0
+            self.seen += 1
+            if keeping:
+                self.kept += 1
+                yield line
+
+    def _sample_blocks(self, source, log_errors):
+        if isinstance(source, str) and os.path.isfile(source) and not is_compressed(source):
+            size = os.path.getsize(source)
+            count = max(1, int(math.ceil(size / self.block_size)))
+            chosen = sorted(self.random.sample(range(count), max(1, int(round(count * self.amount)))))
+            self.seen += count
+            self.kept += len(chosen)
+            for block in chosen:
+                start = block * self.block_size
+                yield from sentences_from_byte_range(source, start, min(size, start + self.block_size), log_errors)
+        else:
+            yield from _sentences_from_lines(self._sample_line_blocks(lines_from_source(source)), source, log_errors)
+
+    def _sample_line_blocks(self, lines):
+        period = max(1, int(round(1 / self.amount)))
+        offset = self.random.randrange(period)
+        keeping = False
+        for i, line in enumerate(lines):
+            if i % self.lines_per_block == 0:
+                keeping = (self.seen + offset) % period == 0
+                self.seen += 1
+                if keeping:
+                    self.kept += 1
+            if keeping:
+                yield line
+
+    def scale(self):
+        """What to multiply sampled counts by to estimate the full ones."""
+        if self.kind == 'vessels':
+            return 1 / self.amount
+        return self.seen / self.kept if self.kept else 1.0
+
+    def scales_senders(self):
+        """Whether the number of distinct senders scales too, as it only does when sampling senders."""
+        return self.kind == 'vessels'
+
+    def description(self):
+        if self.kind == 'vessels':
+            return "{} of {} sentences, from senders picked 1 in {:g}".format(self.kept, self.seen, 1 / self.amount)
+        units = {'lines': 'lines', 'blocks': 'blocks', 'reservoir': 'sentences'}[self.kind]
+        return "{} of {} {}".format(self.kept, self.seen, units)
+
+
+READ_BUFFER_SIZE = 1 << 20
+
+# Parallel or simply faster decompressors worth a separate process; the first one found wins.
+EXTERNAL_DECOMPRESSORS = {
+    '.gz': [['pigz', '-dc']],
+    '.bz2': [['lbzip2', '-dc'], ['pbzip2', '-dc']],
+    '.zst': [['zstd', '-dcq']],
+}
+
+
+def _compression_suffix(source):
+    return os.path.splitext(source)[1].lower()
+
+
+def _open_zstd(source):
+    try:
+        from compression import zstd  # Python 3.14 and later
+        return zstd.open(source, 'rb')
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError("reading {} needs the zstandard module or the zstd command".format(source))
+    return zstandard.open(source, 'rb')
+
+
+DECOMPRESSORS = {
+    '.gz': gzip.open,
+    '.bz2': bz2.open,
+    '.xz': lzma.open,
+    '.zst': _open_zstd,
+}
+
+
+def is_compressed(source):
+    return _compression_suffix(source) in DECOMPRESSORS
+
+
 # noinspection PyBroadException
 def _handle_serial_source(source):
     import serial
@@ -933,11 +1387,106 @@ def _handle_url_source(source):
             time.sleep(1)
 
 
-def _handle_file_source(source):
-    if source.endswith('.gz'):
-        source_reader = gzip.open(source, mode='rt')
+def follow_file(path, poll_interval=0.1, max_poll_interval=2.0, from_end=False):
+    """
+    Yields lines as they are added to a file, like tail -F, starting from the beginning
+    unless from_end is set. While nothing arrives, waits with pauses that double up to
+    max_poll_interval. If the file is truncated, starts over at its beginning; if the name
+    comes to refer to a new file, as with log rotation, finishes the old one first.
+    """
+    f = None
+    identity = None
+    partial = ""
+    delay = poll_interval
+    while True:
+        if f is None:
+            try:
+                f = open(path, encoding='utf-8', errors='replace')
+            except FileNotFoundError:
+                time.sleep(delay)
+                delay = min(2 * delay, max_poll_interval)
+                continue
+            stat = os.fstat(f.fileno())
+            identity = (stat.st_dev, stat.st_ino)
+            if from_end:
+                f.seek(0, os.SEEK_END)
+                from_end = False
+
+        line = f.readline()
+        if line:
+            if line.endswith("\n"):
+                yield partial + line
+                partial = ""
+            else:
+                partial += line
+            delay = poll_interval
+            continue
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            stat = None
+        if stat is not None and (stat.st_dev, stat.st_ino) != identity:
+            for line in f.readlines():  # whatever the writer added before moving on
+                yield partial + line
+                partial = ""
+            if partial:
+                yield partial
+                partial = ""
+            f.close()
+            f = None
+            logging.getLogger().info("{} was replaced; moving on to the new file".format(path))
+            delay = poll_interval
+        elif stat is not None and stat.st_size < f.tell():
+            logging.getLogger().info("{} was truncated; starting over".format(path))
+            f.seek(0)
+            partial = ""
+        else:
+            time.sleep(delay)
+            delay = min(2 * delay, max_poll_interval)
+
+
+def _external_decompressor(source):
+    for command in EXTERNAL_DECOMPRESSORS.get(_compression_suffix(source), []):
+        if shutil.which(command[0]):
+            return command
+    return None
+
+
+def _handle_command_source(command, source):
+    command = command + ['--', source]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=READ_BUFFER_SIZE)
+    try:
+        with io.TextIOWrapper(process.stdout, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                yield line
+        status = process.wait()
+    finally:
+        if process.poll() is None:
+            process.terminate()
+            process.wait()
+    # a failed decompressor has usually cut the input short
+    if status != 0:
+        raise subprocess.CalledProcessError(status, command)
+
+
+def _handle_file_source(source, external=True):
+    """
+    Yields the lines of a plain or compressed file, read in large blocks. Compressed files
+    go through a parallel decompressor such as pigz or zstd when one is installed and
+    external is set, so the decompression runs alongside the parsing; otherwise they are
+    decompressed in-process. Passing read_ahead to sentences_from_source moves that
+    work onto a helper thread.
+    """
+    suffix = _compression_suffix(source)
+    command = _external_decompressor(source) if external and os.path.isfile(source) else None
+    if command:
+        yield from _handle_command_source(command, source)
+        return
+    if suffix in DECOMPRESSORS:
+        raw = io.BufferedReader(DECOMPRESSORS[suffix](source, 'rb'), READ_BUFFER_SIZE)
     else:
-        source_reader = open(source)
-    with source_reader as f:
+        raw = open(source, 'rb', buffering=READ_BUFFER_SIZE)
+    with io.TextIOWrapper(raw, encoding='utf-8', errors='replace') as f:
         for line in f:
             yield line
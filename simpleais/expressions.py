@@ -0,0 +1,376 @@
+"""
+A small filter language for AIS sentences, for example
+
+    type in (1, 2, 3) and speed > 20 and lat between 50 and 55
+
+Comparisons (=, !=, <, <=, >, >=), "in (...)", "between ... and ..." and a bare field name,
+which means the field is present, can be combined with and, or, not and parentheses. A
+field is any decoded message field; type is the message type and time is when the
+sentence was received. Comparisons with missing values are false.
+
+An Expression is compiled once into a function of a sentence, which the tools use, and
+into a function of columns giving a NumPy boolean mask, for records that are already in
+arrays, such as those from a SentenceRing. Sentences are matched one at a time, and since
+fields are decoded when first asked for, matching stops decoding once a sentence is settled.
+"""
+import operator
+import re
+
+import numpy
+
+from simpleais import MESSAGE_DECODERS, BACKUP_DECODER, AisEnum
+
+KNOWN_FIELDS = frozenset([name for decoder in list(MESSAGE_DECODERS.values()) + [BACKUP_DECODER]
+                          for name in decoder.field_decoders_by_id] + ['time'])
+
+# fields that are a number in every message that has them; mmsi is text, but all digits
+_NUMERIC_TYPES = frozenset(['u', 'U1', 'I1', 'I3', 'I4', 'x'])
+NUMERIC_FIELDS = (KNOWN_FIELDS - frozenset(['mmsi'] + [
+    name for decoder in list(MESSAGE_DECODERS.values()) + [BACKUP_DECODER]
+    for name, field in decoder.field_decoders_by_id.items()
+    if getattr(field, 'data_type', None) not in _NUMERIC_TYPES])) | frozenset(['type', 'time'])
+
+_OPERATORS = {'=': operator.eq, '==': operator.eq, '!=': operator.ne, '<': operator.lt, '<=': operator.le,
+              '>': operator.gt, '>=': operator.ge}
+_FLIPPED = {'<': '>', '<=': '>=', '>': '<', '>=': '<='}
+_KEYWORDS = frozenset(['and', 'or', 'not', 'in', 'between'])
+
+_token_pattern = re.compile(r"""\s*(?:
+    (?P<number>-?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+    |(?P<string>'[^']*'|"[^"]*")
+    |(?P<op><=|>=|!=|==|=|<|>|\(|\)|,)
+    |(?P<name>[A-Za-z_][A-Za-z0-9_]*)
+    )""", re.VERBOSE)
+
+
+def _tokens(text):
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = _token_pattern.match(text, position)
+        if not match:
+            raise ValueError("can't make sense of {!r} at position {}".format(text[position:], position))
+        kind = match.lastgroup
+        value, start = match.group(kind), match.start(kind)
+        if kind == 'number':
+            value = float(value) if any(c in value for c in '.eE') else int(value)
+        elif kind == 'string':
+            value = value[1:-1]
+        elif kind == 'name' and value.lower() in _KEYWORDS:
+            kind, value = 'keyword', value.lower()
+        yield kind, value, start
+        position = match.end()
+    yield 'end', None, position
+
+
+class _Parser:
+    """
+    Recursive descent over the grammar
+
+        expression := conjunction ('or' conjunction)*
+        conjunction := negation ('and' negation)*
+        negation := 'not' negation | '(' expression ')' | test
+        test := field [operator literal | ['not'] 'in' '(' literal (',' literal)* ')'
+                       | 'between' literal 'and' literal]
+              | literal operator field
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = list(_tokens(text))
+        self.position = 0
+
+    def parse(self):
+        result = self.expression()
+        self.expect('end')
+        return result
+
+    def peek(self):
+        return self.tokens[self.position]
+
+    def take(self):
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def accept(self, kind, value=None):
+        token_kind, token_value, ignored = self.peek()
+        if token_kind == kind and (value is None or token_value == value):
+            return self.take()
+        return None
+
+    def expect(self, kind, value=None):
+        token = self.accept(kind, value)
+        if token is None:
+            self.fail("expected {}".format(value or kind))
+        return token
+
+    def fail(self, problem):
+        kind, value, start = self.peek()
+        found = "the end" if kind == 'end' else repr(value)
+        raise ValueError("{} but found {} at position {} in {!r}".format(problem, found, start, self.text))
+
+    def expression(self):
+        terms = [self.conjunction()]
+        while self.accept('keyword', 'or'):
+            terms.append(self.conjunction())
+        return terms[0] if len(terms) == 1 else ('or', terms)
+
+    def conjunction(self):
+        terms = [self.negation()]
+        while self.accept('keyword', 'and'):
+            terms.append(self.negation())
+        return terms[0] if len(terms) == 1 else ('and', terms)
+
+    def negation(self):
+        if self.accept('keyword', 'not'):
+            return 'not', self.negation()
+        if self.accept('op', '('):
+            result = self.expression()
+            self.expect('op', ')')
+            return result
+        return self.test()
+
+    def literal(self):
+        kind, value, ignored = self.peek()
+        if kind not in ('number', 'string'):
+            self.fail("expected a number or a quoted string")
+        self.take()
+        return value
+
+    def field(self):
+        kind, value, start = self.peek()
+        if kind != 'name':
+            self.fail("expected a field name")
+        if value not in KNOWN_FIELDS:
+            raise ValueError("unknown field {!r} at position {} in {!r}".format(value, start, self.text))
+        self.take()
+        return value
+
+    def test(self):
+        if self.peek()[0] in ('number', 'string'):
+            value = self.literal()
+            op = self.expect('op')[1]
+            if op not in _OPERATORS:
+                self.fail("expected a comparison")
+            name = self.field()
+            return 'compare', _FLIPPED.get(op, op), name, self.check_literals(name, [value])
+        name = self.field()
+        kind, op, ignored = self.peek()
+        if kind == 'op' and op in _OPERATORS:
+            self.take()
+            return 'compare', op, name, self.check_literals(name, [self.literal()])
+        negated = self.accept('keyword', 'not')
+        if self.accept('keyword', 'in'):
+            self.expect('op', '(')
+            values = [self.literal()]
+            while self.accept('op', ','):
+                values.append(self.literal())
+            self.expect('op', ')')
+            self.check_literals(name, values)
+            result = ('in', name, tuple(values))
+            return ('not', result) if negated else result
+        if negated:
+            self.fail("expected in")
+        if self.accept('keyword', 'between'):
+            low = self.literal()
+            self.expect('keyword', 'and')
+            high = self.literal()
+            if isinstance(low, str) != isinstance(high, str):
+                raise ValueError("between needs two numbers or two strings, not {!r} and {!r} in {!r}".format(
+                    low, high, self.text))
+            self.check_literals(name, [low, high])
+            return 'between', name, low, high
+        return 'present', name
+
+    def check_literals(self, name, values):
+        """Returns the first value, once sure that none is text where the field is a number."""
+        if name in NUMERIC_FIELDS:
+            for value in values:
+                if isinstance(value, str):
+                    raise ValueError("{} is a number, so it can't be compared with {!r} in {!r}".format(
+                        name, value, self.text))
+        return values[0]
+
+
+def _cost(tree):
+    """Rough relative cost of evaluating a tree: type and time are free, fields need decoding."""
+    kind = tree[0]
+    if kind in ('and', 'or'):
+        return sum(_cost(t) for t in tree[1])
+    elif kind == 'not':
+        return _cost(tree[1])
+    name = tree[2] if kind == 'compare' else tree[1]
+    return 0 if name in ('type', 'time') else 1
+
+
+def _as_number(value):
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    if isinstance(value, AisEnum):
+        return int(value)
+    return None
+
+
+def _converter(literal):
+    return str if isinstance(literal, str) else _as_number
+
+
+def _getter(name):
+    if name == 'type':
+        return lambda s: s.type_id()
+    elif name == 'time':
+        return lambda s: s.time
+    return lambda s: s[name]
+
+
+def _both(first, rest):
+    return lambda s: first(s) and rest(s)
+
+
+def _either(first, rest):
+    return lambda s: first(s) or rest(s)
+
+
+def _compile(tree):
+    kind = tree[0]
+    if kind in ('and', 'or'):
+        # cheapest first, so that decoding is skipped whenever an earlier term settles it
+        terms = [_compile(t) for t in sorted(tree[1], key=_cost)]
+        result = terms[-1]
+        for term in reversed(terms[:-1]):
+            result = _both(term, result) if kind == 'and' else _either(term, result)
+        return result
+    elif kind == 'not':
+        term = _compile(tree[1])
+        return lambda s: not term(s)
+
+    get = _getter(tree[2] if kind == 'compare' else tree[1])
+    if kind == 'present':
+        return lambda s: get(s) is not None
+    elif kind == 'compare':
+        ignored, op, name, literal = tree
+        compare, convert = _OPERATORS[op], _converter(literal)
+
+        def check(s):
+            value = get(s)
+            if value is None:
+                return False
+            value = convert(value)
+            return value is not None and compare(value, literal)
+
+        return check
+    elif kind == 'in':
+        numbers = frozenset(v for v in tree[2] if not isinstance(v, str))
+        texts = frozenset(v for v in tree[2] if isinstance(v, str))
+
+        def check(s):
+            value = get(s)
+            if value is None:
+                return False
+            return (bool(numbers) and _as_number(value) in numbers) or (bool(texts) and str(value) in texts)
+
+        return check
+    elif kind == 'between':
+        ignored, name, low, high = tree
+        convert = _converter(low)
+
+        def check(s):
+            value = get(s)
+            if value is None:
+                return False
+            value = convert(value)
+            return value is not None and low <= value <= high
+
+        return check
+    raise ValueError("unknown expression {}".format(tree))
+
+
+def _numbers(column):
+    column = numpy.asarray(column)
+    if column.dtype.kind in 'biuf':
+        return column
+    return numpy.array([numpy.nan if v is None else _as_number(v) for v in column], dtype=float)
+
+
+def _present(column):
+    column = numpy.asarray(column)
+    if column.dtype.kind == 'f':
+        return ~numpy.isnan(column)
+    elif column.dtype.kind == 'O':
+        return numpy.array([v is not None for v in column], dtype=bool)
+    return numpy.ones(len(column), dtype=bool)
+
+
+def _texts(column):
+    """The column's values as strings, and where it has values at all."""
+    column = numpy.asarray(column)
+    present = _present(column)
+    texts = numpy.array([str(v) for v in column[present]], dtype=str) if present.any() else numpy.array([], dtype=str)
+    return texts, present
+
+
+def _compare_mask(column, compare, literal):
+    if isinstance(literal, str):
+        texts, present = _texts(column)
+        result = numpy.zeros(len(present), dtype=bool)
+        result[present] = compare(texts, literal)
+        return result
+    values = _numbers(column)
+    with numpy.errstate(invalid='ignore'):
+        result = compare(values, literal)
+    if values.dtype.kind == 'f':
+        result &= ~numpy.isnan(values)
+    return result
+
+
+def _mask(tree, columns):
+    kind = tree[0]
+    if kind == 'and':
+        return numpy.logical_and.reduce([_mask(t, columns) for t in tree[1]])
+    elif kind == 'or':
+        return numpy.logical_or.reduce([_mask(t, columns) for t in tree[1]])
+    elif kind == 'not':
+        return ~_mask(tree[1], columns)
+    elif kind == 'present':
+        return _present(columns[tree[1]])
+    elif kind == 'compare':
+        ignored, op, name, literal = tree
+        return _compare_mask(columns[name], _OPERATORS[op], literal)
+    elif kind == 'in':
+        column = columns[tree[1]]
+        return numpy.logical_or.reduce([_compare_mask(column, operator.eq, v) for v in tree[2]])
+    elif kind == 'between':
+        ignored, name, low, high = tree
+        column = columns[name]
+        return _compare_mask(column, operator.ge, low) & _compare_mask(column, operator.le, high)
+    raise ValueError("unknown expression {}".format(tree))
+
+
+class Expression:
+    """A compiled filter expression; matches(sentence) for one sentence, mask(columns) for many."""
+
+    def __init__(self, text):
+        self.text = text
+        self.tree = _Parser(text).parse()
+        self.matches = _compile(self.tree)
+
+    def mask(self, columns):
+        """
+        A boolean array saying which rows match, given a mapping from field names to
+        equal-length arrays, such as a structured array. Missing numbers are NaN.
+        """
+        return numpy.asarray(_mask(self.tree, columns), dtype=bool)
+
+    def filter(self, sentences):
+        return (s for s in sentences if self.matches(s))
+
+    def __reduce__(self):
+        return self.__class__, (self.text,)
+
+    def __repr__(self):
+        return "Expression({!r})".format(self.text)
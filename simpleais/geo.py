@@ -0,0 +1,366 @@
+"""
+Distances and bearings on a spherical earth. The plain functions take (lon, lat) points and
+use the math module, which is quickest for one pair at a time; the plural ones take NumPy
+arrays of longitudes and latitudes, or anything that broadcasts with them.
+
+Areas (circles, polygons and indexes of many polygons) all answer contains(point) for one
+position and mask(lons, lats) for arrays of them. web_mercator_pixels places positions on
+the pixels of slippy-map tiles.
+"""
+import json
+import math
+from math import radians, degrees, sin, cos, asin, atan2, sqrt
+
+import numpy
+
+RADIUS_OF_EARTH = 6373.0  # km
+MAX_MERCATOR_LATITUDE = 85.0511287798  # where the Web-Mercator world map is square
+
+
+def distance(p1, p2):
+    """Great-circle distance in km between two (lon, lat) points."""
+    lon1 = radians(p1[0])
+    lat1 = radians(p1[1])
+    lon2 = radians(p2[0])
+    lat2 = radians(p2[1])
+
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+
+    a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
+    c = 2 * atan2(sqrt(a), sqrt(1 - a))
+
+    return RADIUS_OF_EARTH * c
+
+
+def distances(lon1, lat1, lon2, lat2):
+    """Great-circle distances in km, element by element; NaN wherever a coordinate is NaN."""
+    lon1, lat1, lon2, lat2 = [numpy.radians(numpy.asarray(x, dtype=float)) for x in (lon1, lat1, lon2, lat2)]
+    a = numpy.sin((lat2 - lat1) / 2) ** 2 + numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin((lon2 - lon1) / 2) ** 2
+    return 2 * RADIUS_OF_EARTH * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+
+
+def bearing(p1, p2):
+    """Initial compass bearing in degrees, 0 to 360, for the great circle from p1 to p2."""
+    lon1, lat1, lon2, lat2 = radians(p1[0]), radians(p1[1]), radians(p2[0]), radians(p2[1])
+    x = sin(lon2 - lon1) * cos(lat2)
+    y = cos(lat1) * sin(lat2) - sin(lat1) * cos(lat2) * cos(lon2 - lon1)
+    return degrees(atan2(x, y)) % 360
+
+
+def bearings(lon1, lat1, lon2, lat2):
+    """Initial compass bearings in degrees, element by element."""
+    lon1, lat1, lon2, lat2 = [numpy.radians(numpy.asarray(x, dtype=float)) for x in (lon1, lat1, lon2, lat2)]
+    x = numpy.sin(lon2 - lon1) * numpy.cos(lat2)
+    y = numpy.cos(lat1) * numpy.sin(lat2) - numpy.sin(lat1) * numpy.cos(lat2) * numpy.cos(lon2 - lon1)
+    return numpy.degrees(numpy.arctan2(x, y)) % 360
+
+
+def web_mercator_pixels(lons, lats, zoom, tile_size=256):
+    """
+    Pixel columns and rows on the Web-Mercator world map at a zoom level, counted from the
+    top left as map tiles are. Latitudes beyond the map's edge are clamped to it.
+    """
+    size = tile_size << zoom
+    lons = numpy.asarray(lons, dtype=float)
+    lats = numpy.radians(numpy.clip(numpy.asarray(lats, dtype=float), -MAX_MERCATOR_LATITUDE, MAX_MERCATOR_LATITUDE))
+    x = (lons + 180) / 360 * size
+    y = (1 - numpy.log(numpy.tan(lats) + 1 / numpy.cos(lats)) / math.pi) / 2 * size
+    return (numpy.clip(numpy.floor(x), 0, size - 1).astype(numpy.int64),
+            numpy.clip(numpy.floor(y), 0, size - 1).astype(numpy.int64))
+
+
+class Circle:
+    """
+    Everything within radius km of a center point. Single points are first checked against
+    the circle's bounding box, which rules out most of them without any trigonometry.
+    """
+
+    def __init__(self, lon, lat, radius):
+        self.lon = lon
+        self.lat = lat
+        self.radius = radius
+        angle = radius / RADIUS_OF_EARTH
+        self.lat_reach = degrees(angle)
+        if angle >= math.pi / 2 - abs(radians(lat)):
+            self.lon_reach = 180.0  # takes in a pole, so every longitude
+        else:
+            self.lon_reach = degrees(asin(sin(angle) / cos(radians(lat))))
+
+    def in_box(self, lon, lat):
+        return abs(lat - self.lat) <= self.lat_reach and abs((lon - self.lon + 180) % 360 - 180) <= self.lon_reach
+
+    def contains(self, point):
+        if point is None:
+            return False
+        lon, lat = point[0], point[1]
+        return self.in_box(lon, lat) and distance((self.lon, self.lat), (lon, lat)) <= self.radius
+
+    def mask(self, lons, lats):
+        """A boolean array saying which of the positions fall inside; NaN positions don't."""
+        with numpy.errstate(invalid='ignore'):
+            return distances(self.lon, self.lat, lons, lats) <= self.radius
+
+    def __repr__(self):
+        return "Circle({}, {}, {})".format(self.lon, self.lat, self.radius)
+
+
+OUTSIDE, INSIDE, BOUNDARY = 0, 1, 2
+
+
+def _crossings(xs, ys, x1, y1, x2, y2):
+    """Even-odd test of points against edges, by counting crossings of a ray going east."""
+    xs = xs[:, numpy.newaxis]
+    ys = ys[:, numpy.newaxis]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        straddles = (y1 > ys) != (y2 > ys)
+        crossing_x = x1 + (ys - y1) * (x2 - x1) / (y2 - y1)
+        crossed = straddles & (xs < crossing_x)
+    return (numpy.count_nonzero(crossed, axis=1) % 2).astype(bool)
+
+
+class Polygon:
+    """
+    An area bounded by one or more rings of (lon, lat) points: the outer boundary, any
+    holes, and for multi-part areas the other parts, all under the even-odd rule. Rings
+    are taken as drawn in longitude and latitude, so areas crossing the dateline should be
+    split, as GeoJSON asks anyway.
+
+    A resolution by resolution grid over the bounding box records which cells are wholly
+    inside, wholly outside, or on the boundary; only points in boundary cells need the
+    exact test against the edges.
+    """
+
+    def __init__(self, rings, name=None, properties=None, resolution=64):
+        edges = []
+        for ring in rings:
+            ring = numpy.asarray(ring, dtype=float)[:, :2]
+            if len(ring) < 3:
+                continue
+            edges.append(numpy.hstack([ring, numpy.roll(ring, -1, axis=0)]))
+        if not edges:
+            raise ValueError("a polygon needs at least one ring of three or more points")
+        edges = numpy.vstack(edges)
+        edges = edges[(edges[:, 0] != edges[:, 2]) | (edges[:, 1] != edges[:, 3])]
+        self.x1, self.y1, self.x2, self.y2 = [numpy.ascontiguousarray(edges[:, i]) for i in range(4)]
+        self.name = name
+        self.properties = properties or {}
+        self.lon_min = float(min(self.x1.min(), self.x2.min()))
+        self.lon_max = float(max(self.x1.max(), self.x2.max()))
+        self.lat_min = float(min(self.y1.min(), self.y2.min()))
+        self.lat_max = float(max(self.y1.max(), self.y2.max()))
+        self.resolution = resolution
+        self.cell_width = max(self.lon_max - self.lon_min, 1e-9) / resolution
+        self.cell_height = max(self.lat_max - self.lat_min, 1e-9) / resolution
+        self.cells = self._classify_cells()
+
+    def bounds(self):
+        return self.lon_min, self.lat_min, self.lon_max, self.lat_max
+
+    def _cell_indexes(self, lons, lats):
+        columns = numpy.floor((lons - self.lon_min) / self.cell_width).astype(int)
+        rows = numpy.floor((lats - self.lat_min) / self.cell_height).astype(int)
+        return numpy.clip(rows, 0, self.resolution - 1), numpy.clip(columns, 0, self.resolution - 1)
+
+    def _classify_cells(self):
+        n = self.resolution
+        cells = numpy.zeros((n, n), dtype=numpy.uint8)
+
+        # Cut the edges into pieces no bigger than a cell; each piece's bounding box then
+        # covers at most two by two cells, and marking those covers everywhere the edge goes.
+        steps = numpy.ceil(numpy.maximum(abs(self.x2 - self.x1) / self.cell_width,
+                                         abs(self.y2 - self.y1) / self.cell_height)).astype(int) + 1
+        edge = numpy.repeat(numpy.arange(len(steps)), steps)
+        fraction = (numpy.arange(len(edge)) - numpy.repeat(numpy.cumsum(steps) - steps, steps)) / steps[edge]
+        starts_x = self.x1[edge] + fraction * (self.x2 - self.x1)[edge]
+        starts_y = self.y1[edge] + fraction * (self.y2 - self.y1)[edge]
+        ends_x = self.x1[edge] + (fraction + 1.0 / steps[edge]) * (self.x2 - self.x1)[edge]
+        ends_y = self.y1[edge] + (fraction + 1.0 / steps[edge]) * (self.y2 - self.y1)[edge]
+        low_rows, low_columns = self._cell_indexes(numpy.minimum(starts_x, ends_x), numpy.minimum(starts_y, ends_y))
+        high_rows, high_columns = self._cell_indexes(numpy.maximum(starts_x, ends_x), numpy.maximum(starts_y, ends_y))
+        for rows in (low_rows, high_rows):
+            for columns in (low_columns, high_columns):
+                cells[rows, columns] = BOUNDARY
+
+        # No edge enters the other cells, so each run of them along a row is all in or
+        # all out, and testing one center per run settles the whole run.
+        run_rows, run_starts, run_ends = [], [], []
+        for row in range(n):
+            open_cells = numpy.flatnonzero(cells[row] != BOUNDARY)
+            if len(open_cells) == 0:
+                continue
+            breaks = numpy.flatnonzero(numpy.diff(open_cells) > 1)
+            run_rows.extend([row] * (len(breaks) + 1))
+            run_starts.extend(open_cells[numpy.concatenate([[0], breaks + 1])])
+            run_ends.extend(open_cells[numpy.concatenate([breaks, [len(open_cells) - 1]])] + 1)
+        if run_rows:
+            run_rows = numpy.array(run_rows)
+            run_starts = numpy.array(run_starts)
+            inside = self._exact(self.lon_min + (run_starts + 0.5) * self.cell_width,
+                                 self.lat_min + (run_rows + 0.5) * self.cell_height)
+            for row, start, end, is_inside in zip(run_rows, run_starts, run_ends, inside):
+                if is_inside:
+                    cells[row, start:end] = INSIDE
+        return cells
+
+    def _exact(self, lons, lats, chunk_size=4096):
+        chunk_size = max(1, min(chunk_size, (1 << 22) // len(self.x1)))
+        result = numpy.zeros(len(lons), dtype=bool)
+        for start in range(0, len(lons), chunk_size):
+            end = start + chunk_size
+            result[start:end] = _crossings(lons[start:end], lats[start:end], self.x1, self.y1, self.x2, self.y2)
+        return result
+
+    def contains(self, point):
+        if point is None:
+            return False
+        lon, lat = point[0], point[1]
+        if not (self.lon_min <= lon <= self.lon_max and self.lat_min <= lat <= self.lat_max):
+            return False
+        row = min(int((lat - self.lat_min) / self.cell_height), self.resolution - 1)
+        column = min(int((lon - self.lon_min) / self.cell_width), self.resolution - 1)
+        cell = self.cells[row, column]
+        if cell != BOUNDARY:
+            return bool(cell == INSIDE)
+        return bool(self._exact(numpy.array([lon]), numpy.array([lat]))[0])
+
+    def mask(self, lons, lats):
+        """A boolean array saying which of the positions fall inside; NaN positions don't."""
+        lons = numpy.asarray(lons, dtype=float)
+        lats = numpy.asarray(lats, dtype=float)
+        result = numpy.zeros(len(lons), dtype=bool)
+        candidates = numpy.flatnonzero((self.lon_min <= lons) & (lons <= self.lon_max) &
+                                       (self.lat_min <= lats) & (lats <= self.lat_max))
+        if len(candidates) == 0:
+            return result
+        cells = self.cells[self._cell_indexes(lons[candidates], lats[candidates])]
+        result[candidates[cells == INSIDE]] = True
+        boundary = candidates[cells == BOUNDARY]
+        result[boundary] = self._exact(lons[boundary], lats[boundary])
+        return result
+
+    def __repr__(self):
+        return "Polygon({!r}, {} edges)".format(self.name, len(self.x1))
+
+
+class PolygonIndex:
+    """
+    Many polygons, bucketed by the cell_size degree grid cells their bounding boxes touch,
+    so that a point is only checked against the polygons in its own cell. By default cells
+    are about twice the size of a typical polygon.
+    """
+
+    def __init__(self, polygons, cell_size=None):
+        self.polygons = list(polygons)
+        if cell_size is None:
+            sizes = [max(p.lon_max - p.lon_min, p.lat_max - p.lat_min) for p in self.polygons]
+            cell_size = min(max(2 * float(numpy.median(sizes)), 0.01), 10.0) if sizes else 1.0
+        self.cell_size = cell_size
+        self.buckets = {}
+        for number, polygon in enumerate(self.polygons):
+            for column in range(int(math.floor(polygon.lon_min / cell_size)),
+                                int(math.floor(polygon.lon_max / cell_size)) + 1):
+                for row in range(int(math.floor(polygon.lat_min / cell_size)),
+                                 int(math.floor(polygon.lat_max / cell_size)) + 1):
+                    self.buckets.setdefault((column, row), []).append(number)
+        # crowded cells also get their polygons' bounding boxes as arrays, to narrow them down at once
+        self.crowded = {}
+        for key, numbers in self.buckets.items():
+            if len(numbers) > self.CROWDED:
+                numbers = numpy.array(numbers)
+                bounds = numpy.array([self.polygons[n].bounds() for n in numbers]).T.copy()
+                self.crowded[key] = numbers, bounds
+
+    CROWDED = 16
+
+    def candidates(self, point):
+        """Numbers of the polygons that might contain the point."""
+        key = (int(math.floor(point[0] / self.cell_size)), int(math.floor(point[1] / self.cell_size)))
+        crowded = self.crowded.get(key)
+        if crowded is None:
+            return self.buckets.get(key, ())
+        numbers, (lon_min, lat_min, lon_max, lat_max) = crowded
+        lon, lat = point[0], point[1]
+        return numbers[(lon_min <= lon) & (lon <= lon_max) & (lat_min <= lat) & (lat <= lat_max)].tolist()
+
+    def containing(self, point):
+        """All polygons containing the point."""
+        return [self.polygons[n] for n in self.numbers_containing(point)]
+
+    def numbers_containing(self, point):
+        """Numbers of all polygons containing the point."""
+        if point is None:
+            return []
+        return [n for n in self.candidates(point) if self.polygons[n].contains(point)]
+
+    def contains(self, point):
+        """Whether any polygon contains the point."""
+        if point is None:
+            return False
+        for n in self.candidates(point):
+            if self.polygons[n].contains(point):
+                return True
+        return False
+
+    def mask(self, lons, lats):
+        """A boolean array saying which of the positions fall in at least one polygon."""
+        lons = numpy.asarray(lons, dtype=float)
+        lats = numpy.asarray(lats, dtype=float)
+        result = numpy.zeros(len(lons), dtype=bool)
+        with numpy.errstate(invalid='ignore'):
+            valid = numpy.flatnonzero(~(numpy.isnan(lons) | numpy.isnan(lats)))
+        if len(valid) == 0:
+            return result
+        keys = (numpy.floor(lons[valid] / self.cell_size).astype(int),
+                numpy.floor(lats[valid] / self.cell_size).astype(int))
+        by_bucket = {}
+        for i, column, row in zip(valid, *keys):
+            by_bucket.setdefault((column, row), []).append(i)
+        for bucket, points in by_bucket.items():
+            points = numpy.array(points)
+            for n in self.buckets.get(bucket, ()):
+                undecided = points[~result[points]]
+                if len(undecided) == 0:
+                    break
+                result[undecided] = self.polygons[n].mask(lons[undecided], lats[undecided])
+        return result
+
+    def __len__(self):
+        return len(self.polygons)
+
+
+def _geojson_polygons(geometry):
+    kind = geometry.get('type')
+    if kind == 'Polygon':
+        return list(geometry['coordinates'])
+    elif kind == 'MultiPolygon':
+        return [ring for part in geometry['coordinates'] for ring in part]
+    elif kind == 'GeometryCollection':
+        return [ring for g in geometry['geometries'] for ring in _geojson_polygons(g)]
+    return []
+
+
+def polygons_from_geojson(source, resolution=64):
+    """
+    Polygons from a GeoJSON file name, file or already-parsed object: one for each feature
+    or bare geometry with an area, named by its name property if it has one.
+    """
+    if isinstance(source, str):
+        with open(source) as f:
+            source = json.load(f)
+    elif hasattr(source, 'read'):
+        source = json.load(source)
+    if source.get('type') == 'FeatureCollection':
+        features = source['features']
+    elif source.get('type') == 'Feature':
+        features = [source]
+    else:
+        features = [{'type': 'Feature', 'geometry': source, 'properties': {}}]
+    result = []
+    for number, feature in enumerate(features):
+        rings = _geojson_polygons(feature.get('geometry') or {})
+        if rings:
+            properties = feature.get('properties') or {}
+            name = properties.get('name', feature.get('id', str(number)))
+            result.append(Polygon(rings, name, properties, resolution))
+    return result
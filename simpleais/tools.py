@@ -1,13 +1,25 @@
+import bz2
 import functools
+import glob
+import gzip
+import heapq
+import itertools
 import logging
+import lzma
 import math
+import multiprocessing
 import os
 import re
+import socket
+import subprocess
 import sys
-from collections import defaultdict
+import tempfile
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from contextlib import contextmanager
-from copy import copy
-from math import radians, sin, atan2, sqrt, cos
+from operator import itemgetter
 from time import localtime
 from time import strftime
 
@@ -15,9 +27,13 @@ import click
 import numpy
 from dateutil.parser import parse as dateutil_parse
 
-from simpleais import sentences_from_source
-
-_RADIUS_OF_EARTH = 6373.0
+from simpleais import sentences_from_source, sentences_from_byte_range, is_compressed, parse_many, Deduplicator, \
+    deduplicate, merge_by_time, Sampler
+from simpleais.expressions import Expression
+from simpleais.geo import RADIUS_OF_EARTH, Circle, PolygonIndex, distance, polygons_from_geojson, \
+    web_mercator_pixels
+from simpleais.sketches import ApproximateCounts, HyperLogLog, NumericSummary
+from simpleais.windows import Aggregators, CountBy, DistinctSenders, SentenceCount, Windows
 
 
 @contextmanager
@@ -32,51 +48,449 @@ def time_to_text(t):
     return strftime("%Y/%m/%d %H:%M:%S", localtime(t))
 
 
-def print_sentence_source(sentence, file=None):
+def source_lines_for(sentence):
     text = sentence.text
     if isinstance(text, str):
         text = [text]
     for line in text:
         if sentence.time:
-            output = "{:.3f} {}".format(sentence.time, line)
+            yield "{:.3f} {}".format(sentence.time, line)
         else:
-            output = line
+            yield line
+
+
+class LineOutput:
+    """
+    Where the line-emitting tools write. Output to a terminal goes out line by line; output
+    to files and pipes is written in blocks of about block_size bytes, but no line waits
+    longer than flush_interval seconds, so tailing a live feed still works.
+    """
+
+    def __init__(self, file=None, buffered=None, flush_interval=0.5, block_size=1 << 16):
+        self.file = file if file is not None else sys.stdout
+        if buffered is None:
+            buffered = not self.file.isatty()
+        self.buffered = buffered
+        self.flush_interval = flush_interval
+        self.block_size = block_size
+        self.pending = []
+        self.pending_size = 0
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def write(self, line=""):
+        if not self.buffered:
+            self.file.write(line + "\n")
+            self.file.flush()
+            return
+        with self.lock:
+            self.pending.append(line)
+            self.pending_size += len(line) + 1
+            if self.pending_size >= self.block_size:
+                self._flush()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.flush_interval, self._timed_flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def write_sentence(self, sentence):
+        for line in source_lines_for(sentence):
+            self.write(line)
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _timed_flush(self):
+        try:
+            self.flush()
+        except OSError:
+            pass  # the next write or close will run into it too
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.pending:
+            self.pending.append("")
+            text = "\n".join(self.pending)
+            self.pending = []
+            self.pending_size = 0
+            self.file.write(text)
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+COMPRESSION_LEVELS = {'gz': 6, 'bz2': 9, 'xz': 6, 'zst': 3}
+
+# A WriterPool may hold hundreds of compressors open at once, and at the usual settings
+# bzip2 and xz each take several to nearly a hundred megabytes, so pooled files use these.
+POOLED_COMPRESSION_LEVELS = {'gz': 6, 'bz2': 1, 'xz': 0, 'zst': 3}
+
+
+def compression_for(path):
+    """The compression format a file name calls for, or None for plain text."""
+    if not path:
+        return None
+    format = os.path.splitext(path)[1][1:].lower()
+    return format if format in COMPRESSION_LEVELS else None
+
+
+def _zstd_module():
+    try:
+        from compression import zstd  # Python 3.14 and later
+        return zstd
+    except ImportError:
+        pass
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
+        raise ValueError("zstd output needs the zstandard module")
+
+
+def compressor_for(format, level=None):
+    """A function turning bytes into a complete, self-contained compressed stream."""
+    if level is None:
+        level = COMPRESSION_LEVELS[format]
+    if format == 'gz':
+        return functools.partial(gzip.compress, compresslevel=level, mtime=0)
+    elif format == 'bz2':
+        return functools.partial(bz2.compress, compresslevel=level)
+    elif format == 'xz':
+        return functools.partial(lzma.compress, preset=level)
+    elif format == 'zst':
+        return functools.partial(_zstd_module().compress, level=level)
+    raise ValueError("unknown compression format {}".format(format))
+
+
+def open_compressed(path, mode, format, level=None):
+    if level is None:
+        level = COMPRESSION_LEVELS[format]
+    if format == 'gz':
+        return gzip.open(path, mode, compresslevel=level)
+    elif format == 'bz2':
+        return bz2.open(path, mode, compresslevel=level)
+    elif format == 'xz':
+        return lzma.open(path, mode, preset=level)
+    elif format == 'zst':
+        zstd = _zstd_module()
+        if zstd.__name__ == 'zstandard':
+            return zstd.open(path, mode, cctx=zstd.ZstdCompressor(level=level))
+        return zstd.open(path, mode, level=level)
+    raise ValueError("unknown compression format {}".format(format))
+
+
+class CompressedOutput:
+    """
+    A text file that compresses what is written to it. Text is cut into blocks of about
+    block_size bytes, and each becomes its own gzip member, xz stream or zstd frame, so
+    a pool of threads can compress several at once, as pigz does; the concatenation is
+    still an ordinary compressed file. Flushing writes out the finished blocks but does
+    not cut the current one short.
+    """
+
+    def __init__(self, file, format='gz', level=None, threads=None, block_size=1 << 20, close_file=True):
+        self.file = file
+        self.compress = compressor_for(format, level)
+        self.threads = threads or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(self.threads)
+        self.block_size = block_size
+        self.close_file = close_file
+        self.pending = []
+        self.pending_size = 0
+        self.in_flight = deque()
+
+    def isatty(self):
+        return False
 
-        if file:
-            print(output, file=file)
+    def write(self, text):
+        self.pending.append(text)
+        self.pending_size += len(text)
+        if self.pending_size >= self.block_size:
+            self._submit()
+
+    def _submit(self):
+        data = "".join(self.pending).encode('utf-8')
+        self.pending = []
+        self.pending_size = 0
+        self.in_flight.append(self.pool.submit(self.compress, data))
+        while len(self.in_flight) > 2 * self.threads:
+            self.file.write(self.in_flight.popleft().result())
+        self._write_finished()
+
+    def _write_finished(self):
+        while self.in_flight and self.in_flight[0].done():
+            self.file.write(self.in_flight.popleft().result())
+
+    def flush(self):
+        self._write_finished()
+        self.file.flush()
+
+    def close(self):
+        if self.pending:
+            self._submit()
+        while self.in_flight:
+            self.file.write(self.in_flight.popleft().result())
+        self.pool.shutdown()
+        self.file.flush()
+        if self.close_file:
+            self.file.close()
+
+
+@contextmanager
+def open_output(path=None, compress=None, buffered=None):
+    """
+    A LineOutput for a tool, writing to path or to standard output. Output is compressed
+    when compress names a format or when the file name ends in .gz, .bz2, .xz or .zst.
+    """
+    format = compress or compression_for(path)
+    if format:
+        try:
+            compressor_for(format)
+        except ValueError as e:
+            raise click.UsageError(str(e))
+        if path:
+            file = CompressedOutput(open(path, 'wb'), format)
+        elif sys.stdout.isatty():
+            raise click.UsageError("refusing to write compressed data to a terminal")
+        else:
+            sys.stdout.flush()
+            file = CompressedOutput(sys.stdout.buffer, format, close_file=False)
+        buffered = True
+    else:
+        file = open(path, 'w') if path else sys.stdout
+    try:
+        with LineOutput(file, buffered) as output:
+            yield output
+    finally:
+        if file is not sys.stdout:
+            file.close()
+
+
+def expand_sources(sources):
+    """Replaces directories with the files in them and glob patterns with their matches."""
+    for source in sources:
+        if not isinstance(source, str) or re.match("(/dev/tty.*|https?://.*)", source):
+            yield source
+        elif os.path.isdir(source):
+            for directory, subdirectories, files in os.walk(source):
+                subdirectories[:] = sorted(d for d in subdirectories if not d.startswith('.'))
+                for file in sorted(files):
+                    if not file.startswith('.'):
+                        yield os.path.join(directory, file)
+        elif re.search(r"[*?[]", source):
+            yield from sorted(glob.glob(source, recursive=True)) or [source]
         else:
-            # noinspection PyArgumentList
-            print(output, flush=True)
+            yield source
 
 
-def sentences_from_sources(sources, log_errors=False):
-    if len(sources) > 0:
+def process_sources(sources, work, jobs=1, ordered=True):
+    """
+    Calls work(source) for each source, yielding (source, result) pairs. With more than
+    one job, sources are handled concurrently by worker processes, so work and its arguments
+    must be picklable. A failure with one source is logged and skipped, not fatal.
+    """
+    sources = list(expand_sources(sources))
+    if len(sources) == 0:
+        yield sys.stdin, work(sys.stdin)
+        return
+    failures = []
+    if jobs <= 1 or len(sources) == 1:
         for source in sources:
             try:
-                for sentence in sentences_from_source(source, log_errors):
-                    yield sentence
-            except:
+                yield source, work(source)
+            except Exception:
                 logging.exception("Unexpected failure with source {}; continuing".format(source))
+                failures.append(source)
     else:
-        for sentence in sentences_from_source(sys.stdin, log_errors):
+        with ProcessPoolExecutor(jobs) as executor:
+            remaining = iter(sources)
+            running = deque()
+            try:
+                yield from _gather(executor, work, remaining, running, jobs, ordered, failures)
+            finally:
+                for _, future in running:
+                    future.cancel()
+    if failures:
+        logging.error("{} of {} sources failed: {}".format(len(failures), len(sources),
+                                                             ", ".join(str(f) for f in failures)))
+
+
+def _gather(executor, work, remaining, running, jobs, ordered, failures):
+    while True:
+        while len(running) < 2 * jobs:
+            source = next(remaining, None)
+            if source is None:
+                break
+            running.append((source, executor.submit(work, source)))
+        if not running:
+            break
+        if ordered:
+            done = [running.popleft()]
+        else:
+            finished, _ = wait([f for _, f in running], return_when=FIRST_COMPLETED)
+            done = [(s, f) for s, f in running if f in finished]
+            for item in done:
+                running.remove(item)
+        for source, future in done:
+            try:
+                yield source, future.result()
+            except Exception:
+                logging.exception("Unexpected failure with source {}; continuing".format(source))
+                failures.append(source)
+
+
+class Shard:
+    """A whole source, or the part of a plain file completed within a byte range."""
+
+    def __init__(self, source, start=None, end=None):
+        self.source = source
+        self.start = start
+        self.end = end
+
+    def sentences(self, log_errors=False):
+        if self.start is None:
+            return sentences_from_source(self.source, log_errors)
+        return sentences_from_byte_range(self.source, self.start, self.end, log_errors)
+
+    def __str__(self):
+        if self.start is None:
+            return str(self.source)
+        return "{}[{}:{}]".format(self.source, self.start, self.end)
+
+
+def shards_for(sources, shard_size=64 * 1024 * 1024):
+    """Splits large plain files into byte ranges; other sources stay whole. No sources means stdin."""
+    result = []
+    for source in expand_sources(sources):
+        if isinstance(source, str) and not is_compressed(source) and os.path.isfile(source):
+            size = os.path.getsize(source)
+            if size > shard_size:
+                result.extend(Shard(source, start, min(size, start + shard_size))
+                              for start in range(0, size, shard_size))
+                continue
+        result.append(Shard(source))
+    return result or [Shard(sys.stdin)]
+
+
+def map_reduce(sources, mapper, reducer, result, jobs=1, shard_size=64 * 1024 * 1024):
+    """
+    Applies mapper to each shard of the sources, in worker processes if jobs > 1, and folds
+    each partial result into result with reducer(result, partial). Folding happens in shard
+    order, so a mergeable aggregate comes out the same as from a serial pass.
+    """
+    for shard, partial in process_sources(shards_for(sources, shard_size), mapper, jobs):
+        reducer(result, partial)
+    return result
+
+
+def sentences_from_sources(sources, log_errors=False, read_ahead=None, by_time=False, lateness=0.0, follow=False,
+                           sampler=None):
+    """
+    Yields sentences from each source in turn, or from stdin if there are none. With by_time,
+    interleaves the sources in time order instead. With follow, the last source is followed
+    as it grows, so older files can be given first. With a Sampler, yields only its sample.
+    """
+    if sampler:
+        sources = list(expand_sources(sources)) or [sys.stdin]
+        yield from sampler.select(sentence for source in sources for sentence in sampler.sentences(source, log_errors))
+    elif len(sources) > 0:
+        sources = list(expand_sources(sources))
+        streams = [_sentences_or_log(source, log_errors, read_ahead, follow and i == len(sources) - 1)
+                   for i, source in enumerate(sources)]
+        if by_time:
+            yield from merge_by_time(streams, lateness)
+        else:
+            for stream in streams:
+                yield from stream
+    elif by_time:
+        yield from merge_by_time([sentences_from_source(sys.stdin, log_errors, read_ahead)], lateness)
+    else:
+        for sentence in sentences_from_source(sys.stdin, log_errors, read_ahead):
+            yield sentence
+
+
+def _sentences_or_log(source, log_errors, read_ahead, follow=False):
+    try:
+        for sentence in sentences_from_source(source, log_errors, read_ahead, follow):
             yield sentence
+    except subprocess.CalledProcessError as e:
+        raise click.ClickException("{} failed with status {} for source {}".format(e.cmd[0], e.returncode, source))
+    except:
+        logging.exception("Unexpected failure with source {}; continuing".format(source))
 
 
 @click.command()
 @click.argument('sources', nargs=-1)
+@click.option('--by-time', is_flag=True)
+@click.option('--lateness', type=float, default=0.0)
+@click.option('--dedup', is_flag=True)
+@click.option('--window', type=float, default=10.0)
+@click.option('--follow', is_flag=True)
+@click.option('--buffered/--unbuffered', default=None)
+@click.option('--output', '-o', 'path', type=click.Path(dir_okay=False))
+@click.option('--compress', type=click.Choice(list(COMPRESSION_LEVELS)))
+@click.option('--read-ahead', type=click.IntRange(1), metavar='BATCHES')
 @click.option('--verbose', is_flag=True)
-def cat(sources, verbose):
+def cat(sources, by_time, lateness, dedup, window, follow, buffered, path, compress, read_ahead, verbose):
     """ Prints out all complete AIS transmissions.  """
-    for sentence in sentences_from_sources(sources, log_errors=verbose):
-        with wild_disregard_for(BrokenPipeError):
-            print_sentence_source(sentence)
+    _print_sources(sources, Deduplicator(window) if dedup else None, by_time, lateness, follow, buffered, path,
+                   compress, read_ahead, verbose)
+
+
+@click.command()
+@click.argument('sources', nargs=-1)
+@click.option('--by-time', is_flag=True)
+@click.option('--lateness', type=float, default=0.0)
+@click.option('--window', type=float, default=10.0)
+@click.option('--follow', is_flag=True)
+@click.option('--buffered/--unbuffered', default=None)
+@click.option('--output', '-o', 'path', type=click.Path(dir_okay=False))
+@click.option('--compress', type=click.Choice(list(COMPRESSION_LEVELS)))
+@click.option('--read-ahead', type=click.IntRange(1), metavar='BATCHES')
+@click.option('--verbose', is_flag=True)
+def dedup(sources, by_time, lateness, window, follow, buffered, path, compress, read_ahead, verbose):
+    """ Prints out AIS transmissions, skipping repeats heard within the window (in seconds). """
+    _print_sources(sources, Deduplicator(window), by_time, lateness, follow, buffered, path, compress, read_ahead,
+                   verbose)
+
+
+def _print_sources(sources, deduplicator, by_time, lateness, follow, buffered, path, compress, read_ahead, verbose):
+    sentences = sentences_from_sources(sources, log_errors=verbose, read_ahead=read_ahead, by_time=by_time,
+                                       lateness=lateness, follow=follow)
+    if deduplicator:
+        sentences = deduplicate(sentences, deduplicator=deduplicator)
+    with wild_disregard_for(BrokenPipeError), open_output(path, compress, buffered) as output:
+        for sentence in sentences:
+            output.write_sentence(sentence)
+    if deduplicator and verbose:
+        print("skipped {} duplicates of {} sentences".format(deduplicator.duplicate_count, deduplicator.seen_count),
+              file=sys.stderr)
 
 
 class Taster(object):
-    pass
+    """
+    Decides which sentences a filter likes. The criteria are compiled once into a single
+    function, available as likes, that tries the cheap checks first (type, time and
+    checksum, then MMSI, then location and other fields) and stops as soon as the
+    outcome is settled, in either mode.
+    """
+    VESSEL_CLASS_TYPES = {'a': frozenset([1, 2, 3, 5]), 'b': frozenset([18, 19, 24])}
 
     def __init__(self, mmsi=None, sentence_type=None, vessel_class=None, lon=None, lat=None, field=None, value=None,
-                 before=None, after=None, mode='and', checksum=None, invert_match=False):
+                 before=None, after=None, mode='and', checksum=None, invert_match=False, where=None, near=None,
+                 polygons=None):
+        self.args = (mmsi, sentence_type, vessel_class, lon, lat, field, value, before, after, mode, checksum,
+                     invert_match, where, near, polygons)
         self.mmsi = mmsi
         self.sentence_type = sentence_type
         self.vessel_class = vessel_class
@@ -86,51 +500,134 @@ class Taster(object):
         self.value = value
         self.before = before
         self.after = after
-        if mode == 'and' or mode is None:
-            self.default_result = [True]
-            self.reducer = lambda x, y: x and y
-        elif mode == 'or':
-            self.default_result = [False]
-            self.reducer = lambda x, y: x or y
-        else:
+        if mode is None:
+            mode = 'and'
+        if mode not in ('and', 'or'):
             raise ValueError("unknown mode {}".format(mode))
+        self.mode = mode
         self.checksum = checksum
         self.invert_match = invert_match
-
-    def likes(self, sentence):
-        factors = copy(self.default_result)
-        if self.mmsi:
-            factors.append(sentence['mmsi'] in self.mmsi)
+        self.where = where
+        self.near = near
+        self.polygons = polygons
+        self.areas = [area for area in (near, polygons) if area]
+        self.likes = self._compile(self.predicates())
+
+    def predicates(self, areas=True):
+        """The checks for each criterion, cheapest first."""
+        result = []
         if self.sentence_type:
-            factors.append(sentence.type_id() in self.sentence_type)
+            types = frozenset(self.sentence_type)
+            result.append(lambda s: s.type_id() in types)
         if self.vessel_class:
-            if self.vessel_class == 'a':
-                factors.append(sentence.type_id() in [1, 2, 3, 5])
-            elif self.vessel_class == 'b':
-                factors.append(sentence.type_id() in [18, 19, 24])
-        if self.lon or self.lat:
-            loc = sentence.location()
-            if self.lon:
-                factors.append(loc is not None and self.lon[0] <= loc[0] <= self.lon[1])
-            if self.lat:
-                factors.append(loc is not None and self.lat[0] <= loc[1] <= self.lat[1])
-        if self.field:
-            for f in self.field:
-                factors.append(sentence[f] is not None)
-        if self.value:
-            for f, v in self.value:
-                factors.append(sentence[f] == v or str(sentence[f]) == str(v))
+            class_types = self.VESSEL_CLASS_TYPES[self.vessel_class]
+            result.append(lambda s: s.type_id() in class_types)
         if self.before:
-            factors.append(sentence.time <= self.before)
+            before = self.before
+            result.append(lambda s: s.time is not None and s.time <= before)
         if self.after:
-            factors.append(self.after <= sentence.time)
+            after = self.after
+            result.append(lambda s: s.time is not None and after <= s.time)
         if self.checksum is not None:
-            factors.append(sentence.check() == self.checksum)
-        result = functools.reduce(self.reducer, factors)
-        if self.invert_match:
-            return not result
+            checksum = self.checksum
+            result.append(lambda s: s.check() == checksum)
+        if self.mmsi:
+            mmsi = self.mmsi if isinstance(self.mmsi, (set, frozenset)) else frozenset(self.mmsi)
+            result.append(lambda s: s['mmsi'] in mmsi)
+        if self.lon and self.lat and self.mode == 'and':
+            lon_min, lon_max = self.lon
+            lat_min, lat_max = self.lat
+
+            def in_box(s):
+                loc = s.location()
+                return loc is not None and lon_min <= loc[0] <= lon_max and lat_min <= loc[1] <= lat_max
+
+            result.append(in_box)
         else:
-            return result
+            if self.lon:
+                result.append(self._within(0, *self.lon))
+            if self.lat:
+                result.append(self._within(1, *self.lat))
+        if areas:
+            for area in self.areas:
+                result.append(lambda s, area=area: area.contains(s.location()))
+        for f in self.field or []:
+            result.append(functools.partial(self._has_field, f))
+        for f, v in self.value or []:
+            result.append(functools.partial(self._has_value, f, v, str(v)))
+        if self.where:
+            result.append(self.where.matches)
+        return result
+
+    @staticmethod
+    def _within(axis, low, high):
+        def check(s):
+            loc = s.location()
+            return loc is not None and low <= loc[axis] <= high
+
+        return check
+
+    @staticmethod
+    def _has_field(f, s):
+        return s[f] is not None
+
+    @staticmethod
+    def _has_value(f, v, text, s):
+        actual = s[f]
+        return actual == v or str(actual) == text
+
+    def likes_many(self, sentences):
+        """
+        The liked sentences from a batch. With radius or polygon criteria in 'and' mode, the
+        other criteria go first and the survivors' positions are then checked all at once.
+        """
+        if not self.areas or self.mode != 'and' or self.invert_match:
+            return [s for s in sentences if self.likes(s)]
+        candidates = list(filter(self._compile(self.predicates(areas=False)), sentences))
+        locations = [s.location() or (math.nan, math.nan) for s in candidates]
+        lons = numpy.fromiter((l[0] for l in locations), dtype=float, count=len(locations))
+        lats = numpy.fromiter((l[1] for l in locations), dtype=float, count=len(locations))
+        inside = numpy.ones(len(candidates), dtype=bool)
+        for area in self.areas:
+            inside &= area.mask(lons, lats)
+        return [s for s, wanted in zip(candidates, inside) if wanted]
+
+    def _compile(self, predicates):
+        if self.mode == 'and':
+            result = self._chain(predicates, lambda first, rest: lambda s: first(s) and rest(s), True)
+        else:
+            result = self._chain(predicates, lambda first, rest: lambda s: first(s) or rest(s), False)
+        if self.invert_match:
+            positive = result
+            return lambda s: not positive(s)
+        return result
+
+    @staticmethod
+    def _chain(predicates, join, empty):
+        if not predicates:
+            return lambda s: empty
+        result = predicates[-1]
+        for predicate in reversed(predicates[:-1]):
+            result = join(predicate, result)
+        return result
+
+    def __reduce__(self):
+        # the compiled closures can't be pickled, so worker processes rebuild from the arguments
+        return self.__class__, self.args
+
+
+def parse_expression(ctx, param, value):
+    try:
+        return Expression(value) if value else None
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def parse_sampler(ctx, param, value):
+    try:
+        return Sampler.from_text(value) if value else None
+    except ValueError as e:
+        raise click.BadParameter(str(e))
 
 
 def parse_date(string):
@@ -148,40 +645,93 @@ def parse_date(string):
 @click.option('--class', 'vessel_class', type=click.Choice(['a', 'b']))
 @click.option('--longitude', '--long', '--lon', 'lon', nargs=2, type=float)
 @click.option('--latitude', '--lat', 'lat', nargs=2, type=float)
+@click.option('--near', nargs=2, type=float, metavar='LON LAT')
+@click.option('--radius', type=float, metavar='KM')
+@click.option('--polygon', 'polygon_files', type=click.Path(exists=True, dir_okay=False), multiple=True)
 @click.option('--field', '-f', multiple=True)
 @click.option('--value', type=(str, str), multiple=True)
 @click.option('--before')
 @click.option('--after')
 @click.option('--checksum', type=click.Choice(['valid', 'invalid']))
+@click.option('--where', '-w', callback=parse_expression)
 @click.option('--mode', type=click.Choice(['and', 'or']))
 @click.option('--invert-match', '-v', is_flag=True)
 @click.option('--max-count', '-m', 'max', type=int)
+@click.option('--jobs', '-j', type=int, default=1)
+@click.option('--unordered', is_flag=True)
+@click.option('--follow', is_flag=True)
+@click.option('--buffered/--unbuffered', default=None)
+@click.option('--output', '-o', 'path', type=click.Path(dir_okay=False))
+@click.option('--compress', type=click.Choice(list(COMPRESSION_LEVELS)))
+@click.option('--read-ahead', type=click.IntRange(1), metavar='BATCHES')
 @click.option('--verbose', is_flag=True)
 def grep(sources, mmsi=None, mmsi_file=None, sentence_type=None, vessel_class=None, lon=None, lat=None,
-         value=None, before=None, after=None, field=None, checksum=None,
-         mode='and', invert_match=False, max=None, verbose=False):
+         near=None, radius=None, polygon_files=None, value=None, before=None, after=None, field=None, checksum=None,
+         where=None, mode='and', invert_match=False, max=None, jobs=1, unordered=False, follow=False, buffered=None,
+         path=None, compress=None, read_ahead=None, verbose=False):
     """ Filters AIS transmissions.  """
     if not mmsi:
         mmsi = frozenset()
     if mmsi_file:
         mmsi = frozenset(mmsi)
         mmsi = mmsi.union(read_mmsi_file(mmsi_file))
+    if bool(near) != bool(radius):
+        raise click.UsageError("--near and --radius go together")
+    if follow and jobs > 1:
+        raise click.UsageError("--jobs splits sources that are already complete, so it can't be combined with --follow")
+    polygons = None
+    if polygon_files:
+        polygons = PolygonIndex(read_polygon_files(polygon_files))
     if checksum is None:
         checksum_desire = None
     else:
         checksum_desire = checksum == "valid"
     taster = Taster(mmsi, sentence_type, vessel_class, lon, lat, field, value, parse_date(before), parse_date(after),
-                    mode, checksum_desire, invert_match)
-    with wild_disregard_for(BrokenPipeError):
+                    mode, checksum_desire, invert_match, where, Circle(near[0], near[1], radius) if near else None,
+                    polygons)
+    with wild_disregard_for(BrokenPipeError), open_output(path, compress, buffered) as output:
         matches = 0
-        for sentence in sentences_from_sources(sources, log_errors=verbose):
+        if jobs > 1:
+            work = functools.partial(_grep_shard, taster, max, verbose)
+            for shard, found in process_sources(shards_for(sources), work, jobs, ordered=not unordered):
+                for text in found:
+                    output.write(text)
+                    matches += 1
+                    if max and matches >= max:
+                        return
+            return
+        for sentence in sentences_from_sources(sources, log_errors=verbose, read_ahead=read_ahead, follow=follow):
             if taster.likes(sentence):
-                print_sentence_source(sentence)
+                output.write_sentence(sentence)
                 matches += 1
                 if max and matches >= max:
                     break
 
 
+def _grep_shard(taster, max, verbose, shard, batch_size=10000):
+    result = []
+    sentences = shard.sentences(log_errors=verbose)
+    while not max or len(result) < max:
+        batch = list(itertools.islice(sentences, batch_size))
+        if not batch:
+            break
+        for sentence in taster.likes_many(batch):
+            result.append("\n".join(source_lines_for(sentence)))
+    return result[:max] if max else result
+
+
+def read_polygon_files(paths):
+    result = []
+    for path in paths:
+        try:
+            result.extend(polygons_from_geojson(path))
+        except (ValueError, KeyError, TypeError) as e:
+            raise click.BadParameter("can't read polygons from {}: {}".format(path, e), param_hint='--polygon')
+    if not result:
+        raise click.BadParameter("no polygons found in {}".format(", ".join(paths)), param_hint='--polygon')
+    return result
+
+
 def read_mmsi_file(mmsi_file):
     with open(mmsi_file, "r") as f:
         return frozenset([l.strip() for l in f.readlines()])
@@ -189,13 +739,16 @@ def read_mmsi_file(mmsi_file):
 
 @click.command()
 @click.argument('sources', nargs=-1)
+@click.option('--read-ahead', type=click.IntRange(1), metavar='BATCHES')
 @click.option('--verbose', is_flag=True)
 @click.option('--raw', is_flag=True)
-def as_text(sources, verbose, raw):
+@click.option('--follow', is_flag=True)
+@click.option('--buffered/--unbuffered', default=None)
+def as_text(sources, verbose, raw, follow, buffered, read_ahead):
     """ Simple text display, one line per AIS sentence. """
-    for sentence in sentences_from_sources(sources, log_errors=verbose):
-        with wild_disregard_for(BrokenPipeError):
-            print(text_for(sentence, raw))
+    with wild_disregard_for(BrokenPipeError), LineOutput(buffered=buffered) as output:
+        for sentence in sentences_from_sources(sources, log_errors=verbose, read_ahead=read_ahead, follow=follow):
+            output.write(text_for(sentence, raw))
 
 
 def text_for(sentence, raw=False):
@@ -251,27 +804,136 @@ def dimensions_as_text(type_5_sentence):
             type_5_sentence['draught'])
 
 
+class WriterPool:
+    """
+    Writes text to many files while keeping at most max_open of them open. The least
+    recently used file is closed when another is needed, and reopened for appending if
+    it comes back. With batch_lines, text is gathered in memory and written in lumps of
+    that many lines per file, or sooner if max_batched lines are waiting overall. Files
+    ending in .gz are compressed.
+    """
+
+    def __init__(self, max_open=512, buffer_size=1 << 16, batch_lines=None, max_batched=1000000):
+        self.max_open = max_open
+        self.buffer_size = buffer_size
+        self.batch_lines = batch_lines
+        self.max_batched = max_batched
+        self.open_files = OrderedDict()
+        self.started = set()
+        self.batches = defaultdict(list)
+        self.batched_count = 0
+        self.open_count = 0
+
+    def write(self, path, text):
+        if not self.batch_lines:
+            self._file(path).write(text)
+            return
+        batch = self.batches[path]
+        batch.append(text)
+        self.batched_count += 1
+        if len(batch) >= self.batch_lines:
+            self._flush(path)
+        elif self.batched_count >= self.max_batched:
+            for waiting in list(self.batches):
+                self._flush(waiting)
+
+    def _flush(self, path):
+        batch = self.batches.pop(path, None)
+        if batch:
+            self._file(path).write("".join(batch))
+            self.batched_count -= len(batch)
+
+    def _file(self, path):
+        f = self.open_files.pop(path, None)
+        if f is None:
+            if len(self.open_files) >= self.max_open:
+                ignored, oldest = self.open_files.popitem(last=False)
+                oldest.close()
+            mode = 'at' if path in self.started else 'wt'
+            directory = os.path.dirname(path)
+            if directory and path not in self.started:
+                os.makedirs(directory, exist_ok=True)
+            format = compression_for(path)
+            if format:
+                f = open_compressed(path, mode, format, POOLED_COMPRESSION_LEVELS[format])
+            else:
+                f = open(path, mode, buffering=self.buffer_size)
+            self.started.add(path)
+            self.open_count += 1
+        self.open_files[path] = f
+        return f
+
+    def close(self):
+        for path in list(self.batches):
+            self._flush(path)
+        for f in self.open_files.values():
+            f.close()
+        self.open_files.clear()
+
+
+class BurstStage:
+    """Writes each sentence to a file for its sender, optionally in subdirectories by MMSI prefix."""
+
+    def __init__(self, dest, shard_digits=0, compress=None, **pool_options):
+        self.fname, self.ext = os.path.splitext(dest)
+        if compression_for(dest):
+            self.fname, ext = os.path.splitext(self.fname)
+            self.ext = ext + self.ext
+        elif compress:
+            self.ext += '.' + compress
+        self.shard_digits = shard_digits
+        self.writers = WriterPool(**pool_options)
+
+    def path_for(self, mmsi):
+        name = "{}-{}{}".format(self.fname, mmsi, self.ext)
+        if self.shard_digits:
+            directory, base = os.path.split(name)
+            return os.path.join(directory, mmsi[:self.shard_digits], base)
+        return name
+
+    def process(self, sentence):
+        mmsi = sentence['mmsi']
+        if not mmsi:
+            mmsi = 'other'
+        self.writers.write(self.path_for(mmsi), "".join(line + "\n" for line in source_lines_for(sentence)))
+
+    def finish(self):
+        self.writers.close()
+
+
 @click.command()
 @click.argument('source', nargs=1)
 @click.argument('dest', nargs=1, required=False)
+@click.option('--max-open', type=int, default=512)
+@click.option('--batch', 'batch_lines', type=int)
+@click.option('--gzip', 'use_gzip', is_flag=True)
+@click.option('--compress', type=click.Choice(list(COMPRESSION_LEVELS)))
+@click.option('--shard-digits', type=int, default=0)
+@click.option('--jobs', '-j', type=int, default=1)
 @click.option('--verbose', is_flag=True)
-def burst(source, dest, verbose):
+def burst(source, dest, max_open, batch_lines, use_gzip, compress, shard_digits, jobs, verbose):
     """ Takes large AIS files and splits them up by sender. """
     if not dest:
         dest = source
-    writers = {}
-    fname, ext = os.path.splitext(dest)
-
-    for sentence in sentences_from_source(source, log_errors=verbose):
-        mmsi = sentence['mmsi']
-        if not mmsi:
-            mmsi = 'other'
-        if mmsi not in writers:
-            writers[mmsi] = open("{}-{}{}".format(fname, mmsi, ext), "wt")
-        print_sentence_source(sentence, writers[mmsi])
-
-    for writer in writers.values():
-        writer.close()
+    if use_gzip and not compress:
+        compress = 'gz'
+    format = compress or compression_for(dest)
+    if format:
+        try:
+            compressor_for(format)
+        except ValueError as e:
+            raise click.UsageError(str(e))
+    stage_factory = functools.partial(BurstStage, dest, shard_digits, compress, max_open=max_open,
+                                      batch_lines=batch_lines)
+    sentences = sentences_from_source(source, log_errors=verbose)
+    if jobs > 1:
+        for ignored in VesselShards(stage_factory, jobs).run(sentences):
+            pass
+    else:
+        stage = stage_factory()
+        for sentence in sentences:
+            stage.process(sentence)
+        stage.finish()
 
 
 class FieldsHistory:
@@ -282,6 +944,8 @@ class FieldsHistory:
         return self.values[key]
 
     def __setitem__(self, key, value):
+        if value is None:
+            return
         value = value.strip()
         if key and value and len(value) > 0:
             if value not in (self.values[key]):
@@ -290,6 +954,11 @@ class FieldsHistory:
     def __iter__(self):
         return self.values.__iter__()
 
+    def merge(self, other):
+        for key in other:
+            for value in other[key]:
+                self[key] = value
+
 
 class SenderInfo:
     def __init__(self):
@@ -308,6 +977,14 @@ class SenderInfo:
             self.fields['destination'] = sentence['destination']
             self.fields['dimensions'] = dimensions_as_text(sentence)
 
+    def merge(self, other):
+        if not self.mmsi:
+            self.mmsi = other.mmsi
+        self.sentence_count += other.sentence_count
+        for type_id, count in other.type_counts.items():
+            self.type_counts[type_id] += count
+        self.fields.merge(other.fields)
+
     def report(self, file=sys.stdout):
         print("{}:".format(self.mmsi), file=file)
         print("    sentences: {}".format(self.sentence_count), file=file)
@@ -333,6 +1010,11 @@ class MaxMin:
         if value < self.min:
             self.min = value
 
+    def merge(self, other):
+        if other.valid():
+            self.add(other.min)
+            self.add(other.max)
+
     def range(self):
         if self.valid:
             return self.max - self.min
@@ -355,6 +1037,10 @@ class GeoInfo:
         self.lon.add(point[0])
         self.lat.add(point[1])
 
+    def merge(self, other):
+        self.lon.merge(other.lon)
+        self.lat.merge(other.lat)
+
     def report(self, indent="", file=sys.stdout):
         if not self.valid():
             return
@@ -368,7 +1054,7 @@ class GeoInfo:
         if self.lon.range() <= 180:
             return result
         else:
-            return _RADIUS_OF_EARTH * math.pi * 2 - result
+            return RADIUS_OF_EARTH * math.pi * 2 - result
 
     def height(self):
         return distance((self.lon.mid(), self.lat.min), (self.lon.mid(), self.lat.max))
@@ -381,31 +1067,19 @@ class GeoInfo:
         return self.lon.valid() and self.lat.valid()
 
 
-def distance(p1, p2):
-    lon1 = radians(p1[0])
-    lat1 = radians(p1[1])
-    lon2 = radians(p2[0])
-    lat2 = radians(p2[1])
-
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-
-    a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
-    c = 2 * atan2(sqrt(a), sqrt(1 - a))
-
-    d = _RADIUS_OF_EARTH * c
-    return d
-
-
 class SentencesInfo:
-    def __init__(self, by_type=False):
+    def __init__(self, by_type=False, approx=False):
         self.by_type = by_type
+        self.approx = approx
         self.sentence_count = 0
         self.bad_checksum_count = 0
         self.time_range = MaxMin()
         if by_type:
             self.type_counts = defaultdict(int)
-        self.sender_counts = defaultdict(int)
+        if approx:
+            self.senders = HyperLogLog()
+        else:
+            self.sender_counts = defaultdict(int)
 
     def add(self, sentence):
         self.sentence_count += 1
@@ -413,19 +1087,48 @@ class SentencesInfo:
             self.time_range.add(sentence.time)
         if self.by_type:
             self.type_counts[sentence.type_id()] += 1
-        self.sender_counts[sentence['mmsi']] += 1
+        if self.approx:
+            self.senders.add(sentence['mmsi'])
+        else:
+            self.sender_counts[sentence['mmsi']] += 1
+
+    def merge(self, other):
+        self.sentence_count += other.sentence_count
+        self.bad_checksum_count += other.bad_checksum_count
+        self.time_range.merge(other.time_range)
+        if self.by_type:
+            merge_counts(self.type_counts, other.type_counts)
+        if self.approx:
+            self.senders.merge(other.senders)
+        else:
+            merge_counts(self.sender_counts, other.sender_counts)
 
     def count_bad_checksum(self):
         self.bad_checksum_count += 1
 
-    def report(self, file=sys.stdout):
+    def report(self, file=sys.stdout, sampler=None):
         if self.sentence_count < 1:
             print("No sentences found.", file=file)
             return
+        scale = sampler.scale() if sampler else 1
+
+        def scaled(count):
+            return int(round(count * scale))
+
+        senders = self.senders.count() if self.approx else len(self.sender_counts)
+        if sampler and sampler.scales_senders():
+            senders = "about {}".format(scaled(senders))
+        elif sampler:
+            senders = "at least {}".format(senders)
+        elif self.approx:
+            senders = "about {}".format(senders)
+        if sampler:
+            print("Estimated from a sample of {}, scaled up {:.3g} times.".format(sampler.description(), scale),
+                  file=file)
         print("Found {} senders in {} good sentences with {} invalid ({:0.2f}%).".format(
-            len(self.sender_counts),
-            self.sentence_count,
-            self.bad_checksum_count,
+            senders,
+            scaled(self.sentence_count),
+            scaled(self.bad_checksum_count),
             100.0 * self.bad_checksum_count / (self.sentence_count + self.bad_checksum_count)
         ), file=file)
         if self.time_range.valid() and self.time_range.range() > 0:
@@ -439,7 +1142,7 @@ class SentencesInfo:
             if self.by_type:
                 print("   type counts:", file=file)
                 for i in sorted(self.type_counts):
-                    print("                {:2d} {:8d}".format(i, self.type_counts[i]), file=file)
+                    print("                {:2d} {:8d}".format(i, scaled(self.type_counts[i])), file=file)
                 print(file=file)
 
 
@@ -464,38 +1167,130 @@ class Bucketer:
             return self.max_buckets
         return result
 
+    def buckets(self, values):
+        return numpy.clip(numpy.digitize(values, self.bins) - 1, 0, self.max_buckets)
+
     def __str__(self, *args, **kwargs):
         return "Bucketer({}, {}, {}, {})".format(self.min_val, self.max_val, self.bucket_count, self.bins)
 
 
 class DensityMap:
-    def __init__(self, width=60, height_scale=0.5, indent=""):
+    """
+    A terminal map of where points are. Points are counted in batches of batch_size into
+    cells of a fixed lattice over the world, 360 / 2 ** level degrees of longitude by
+    180 / 2 ** level of latitude, starting about a meter across. Only occupied cells are
+    kept, and whenever there are more than resolution x resolution of them, the level
+    drops by one and each four cells become one. The level reached depends only on the
+    points, not on their order, so maps of separate shards merge into exactly the map of
+    all of them. Exact bounds are kept separately, and the cells are re-binned to the
+    map's size when it is drawn; until a batch has been counted, points are placed exactly.
+    """
+
+    finest_level = 24
+
+    def __init__(self, width=60, height_scale=0.5, indent="", resolution=1024, batch_size=1 << 16):
         self.desired_width = width
         self.height_scale = height_scale  # terminal characters are about 2x tall as they are wide
         self.indent = indent
+        self.max_cells = resolution * resolution
+        self.batch_size = batch_size
         self.geo_info = GeoInfo()
-        self.points = []
+        self.count = 0
+        self.pending = []
+        self.level = self.finest_level
+        self.keys = numpy.empty(0, dtype=numpy.int64)  # sorted cell numbers, x << 32 | y
+        self.counts = numpy.empty(0, dtype=numpy.int64)
+        self.chunks = []  # (keys, counts) at the current level, not yet folded in
+        self.chunk_size = 0
         self.marks = []
         self.cached_height = None
 
     def add(self, point):
-        self.points.append(point)
+        self.pending.append(point)
+        self.count += 1
         self.geo_info.add(point)
         if self.cached_height is not None:
             self.cached_height = None
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Counts the pending points into cells."""
+        if self.pending:
+            points = numpy.array(self.pending, dtype=float).reshape(-1, 2)
+            self.pending = []
+            points = points[numpy.isfinite(points).all(axis=1)]
+            self._add_cells(*self._combine(self._keys_for(points), numpy.ones(len(points), dtype=numpy.int64)))
+
+    def merge(self, other):
+        self.pending.extend(other.pending)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        if other.chunks or len(other.keys):
+            other._compact()
+            self._compact()
+            if other.level < self.level:
+                self._coarsen(other.level)
+            elif other.level > self.level:
+                other._coarsen(self.level)
+            self._add_cells(other.keys, other.counts)
+            self._compact()
+        self.count += other.count
+        self.marks.extend(other.marks)
+        self.geo_info.merge(other.geo_info)
+        self.cached_height = None
+
+    def _keys_for(self, points):
+        # scaling by a power of two is exact, so a coarser level's cell is always a finer one's, halved
+        scale = 1 << self.level
+        x = numpy.clip(numpy.floor((points[:, 0] + 180) / 360 * scale), 0, scale - 1).astype(numpy.int64)
+        y = numpy.clip(numpy.floor((points[:, 1] + 90) / 180 * scale), 0, scale - 1).astype(numpy.int64)
+        return (x << 32) | y
+
+    @staticmethod
+    def _combine(keys, counts):
+        keys, inverse = numpy.unique(keys, return_inverse=True)
+        return keys, numpy.bincount(inverse.ravel(), counts, minlength=len(keys)).astype(numpy.int64)
+
+    def _add_cells(self, keys, counts):
+        self.chunks.append((keys, counts))
+        self.chunk_size += len(keys)
+        if self.chunk_size >= max(len(self.keys), self.batch_size):
+            self._compact()
+
+    def _compact(self):
+        """Folds the chunks into the cells, then drops levels until few enough cells are occupied."""
+        if self.chunks:
+            self.keys, self.counts = self._combine(numpy.concatenate([self.keys] + [k for k, c in self.chunks]),
+                                                   numpy.concatenate([self.counts] + [c for k, c in self.chunks]))
+            self.chunks = []
+            self.chunk_size = 0
+        while len(self.keys) > self.max_cells:
+            self._coarsen(self.level - 1)
+
+    def _coarsen(self, level):
+        shift = self.level - level
+        x, y = (self.keys >> 32) >> shift, (self.keys & 0xffffffff) >> shift
+        self.keys, self.counts = self._combine((x << 32) | y, self.counts)
+        self.level = level
+
+    def _cells(self):
+        """The centers of the occupied cells, and their counts."""
+        self.flush()
+        self._compact()
+        scale = 1 << self.level
+        x, y = self.keys >> 32, self.keys & 0xffffffff
+        centers = numpy.column_stack([(x + 0.5) / scale * 360 - 180, (y + 0.5) / scale * 180 - 90])
+        return centers, self.counts
 
     def valid(self):
-        return len(self.points) > 0 and self.geo_info.valid()
+        return self.count > 0 and self.geo_info.valid()
 
     def bucket(self, points):
+        points = numpy.asarray(points, dtype=float).reshape(-1, 2)
         xb = Bucketer(self.geo_info.lon.min, self.geo_info.lon.max, self.width())
         yb = Bucketer(self.geo_info.lat.min, self.geo_info.lat.max, self.height())
-        result = []
-        for point in points:
-            x = xb.bucket(point[0])
-            y = self.height() - 1 - yb.bucket(point[1])
-            result.append((x, y))
-        return result
+        return xb.buckets(points[:, 0]), self.height() - 1 - yb.buckets(points[:, 1])
 
     def height(self):
         if self.cached_height is None:
@@ -510,14 +1305,20 @@ class DensityMap:
         return self.desired_width
 
     def to_counts(self):
-        # noinspection PyUnusedLocal
-        results = [[0 for ignored in range(self.width())] for ignored in range(self.height())]
+        results = numpy.zeros((self.height(), self.width()), dtype=numpy.int64)
         if self.geo_info.valid():
-            for x, y in self.bucket(self.points):
-                results[y][x] += 1
-            for x, y in self.bucket(self.marks):
-                results[y][x] = -1
-        return results
+            if self.chunks or len(self.keys):
+                # once anything is in cells, everything is, so the map doesn't depend on batching
+                centers, counts = self._cells()
+                x, y = self.bucket(centers)
+                numpy.add.at(results, (y, x), counts)
+            elif self.pending:
+                x, y = self.bucket(self.pending)
+                numpy.add.at(results, (y, x), 1)
+            if self.marks:
+                x, y = self.bucket(self.marks)
+                results[y, x] = -1
+        return results.tolist()
 
     def to_text(self):
         counts = self.to_counts()
@@ -554,56 +1355,98 @@ class DensityMap:
         self.geo_info.add(point)
 
 
-@click.command()
-@click.argument('sources', nargs=-1)
-@click.option('--individual', '-i', is_flag=True)
-@click.option('--map', '-m', "show_map", is_flag=True)
-@click.option('--by-type', '-t', is_flag=True)
-@click.option('--point', '-p', type=(float, float), multiple=True)
-@click.option('--verbose', is_flag=True)
-def info(sources, individual, by_type, show_map, point, verbose):
-    """ Summarizes AIS transmissions. """
-    sentences_info = SentencesInfo(by_type)
-    sender_info = defaultdict(SenderInfo)
-    geo_info = GeoInfo()
+class InfoSummary:
+    """Everything aisinfo reports on, kept so that summaries of separate sources can be merged."""
 
-    map_info = DensityMap()
-    if point:
-        for p in point:
-            map_info.mark(p)
+    def __init__(self, by_type=False, individual=False, show_map=False, approx=False):
+        self.individual = individual
+        self.show_map = show_map
+        self.sentences_info = SentencesInfo(by_type, approx)
+        self.sender_info = defaultdict(SenderInfo)
+        self.geo_info = GeoInfo()
+        self.map_info = DensityMap()
 
-    for sentence in sentences_from_sources(sources, log_errors=verbose):
+    def add(self, sentence):
         try:
             if not sentence.check():
-                sentences_info.count_bad_checksum()
-                continue
+                self.sentences_info.count_bad_checksum()
+                return
 
-            sentences_info.add(sentence)
+            self.sentences_info.add(sentence)
 
             loc = sentence.location()
             if loc:
-                geo_info.add(loc)
-                if show_map:
-                    map_info.add(loc)
+                self.geo_info.add(loc)
+                if self.show_map:
+                    self.map_info.add(loc)
 
-            if individual:
-                sender_info[sentence['mmsi']].add(sentence)
+            if self.individual:
+                self.sender_info[sentence['mmsi']].add(sentence)
         except:
             print("Unexpected failure for sentence", sentence.text, file=sys.stderr)
             raise
 
-    with wild_disregard_for(BrokenPipeError):
-        sentences_info.report(file=sys.stdout)
+    def merge(self, other):
+        self.sentences_info.merge(other.sentences_info)
+        self.geo_info.merge(other.geo_info)
+        self.map_info.merge(other.map_info)
+        for mmsi, sender in other.sender_info.items():
+            self.sender_info[mmsi].merge(sender)
+
+    def report(self, file=sys.stdout, sampler=None):
+        self.sentences_info.report(file=file, sampler=sampler)
+
+        if self.geo_info.valid():
+            self.geo_info.report("  ", file=file)
 
-        if geo_info.valid():
-            geo_info.report("  ", file=sys.stdout)
+        if self.show_map and self.map_info.valid():
+            self.map_info.show(file=file)
+
+        if self.individual:
+            for mmsi in sorted(self.sender_info):
+                self.sender_info[mmsi].report(file=file)
+
+
+def _info_for_shard(by_type, individual, show_map, approx, verbose, shard):
+    summary = InfoSummary(by_type, individual, show_map, approx)
+    for sentence in shard.sentences(log_errors=verbose):
+        summary.add(sentence)
+    return summary
+
+
+@click.command()
+@click.argument('sources', nargs=-1)
+@click.option('--individual', '-i', is_flag=True)
+@click.option('--map', '-m', "show_map", is_flag=True)
+@click.option('--by-type', '-t', is_flag=True)
+@click.option('--point', '-p', type=(float, float), multiple=True)
+@click.option('--approx', is_flag=True)
+@click.option('--sample', 'sampler', metavar='KIND:AMOUNT', callback=parse_sampler)
+@click.option('--jobs', '-j', type=int, default=1)
+@click.option('--read-ahead', type=click.IntRange(1), metavar='BATCHES')
+@click.option('--verbose', is_flag=True)
+def info(sources, individual, by_type, show_map, point, approx, sampler, jobs, read_ahead, verbose):
+    """ Summarizes AIS transmissions. """
+    if approx and individual:
+        raise click.UsageError("--individual reports on every sender, so it can't be combined with --approx")
+    if sampler and jobs > 1:
+        raise click.UsageError("--sample reads sources in one pass, so it can't be combined with --jobs")
+    if read_ahead and (sampler or jobs > 1):
+        raise click.UsageError("--read-ahead only applies to reading sources in one pass, without --sample or --jobs")
+    summary = InfoSummary(by_type, individual, show_map, approx)
+    if point:
+        for p in point:
+            summary.map_info.mark(p)
 
-        if show_map and map_info.valid():
-            map_info.show(file=sys.stdout)
+    if jobs > 1:
+        work = functools.partial(_info_for_shard, by_type, individual, show_map, approx, verbose)
+        map_reduce(sources, work, InfoSummary.merge, summary, jobs)
+    else:
+        for sentence in sentences_from_sources(sources, log_errors=verbose, read_ahead=read_ahead, sampler=sampler):
+            summary.add(sentence)
 
-        if individual:
-            for mmsi in sorted(sender_info):
-                sender_info[mmsi].report(file=sys.stdout)
+    with wild_disregard_for(BrokenPipeError):
+        summary.report(file=sys.stdout, sampler=sampler)
 
 
 def chunks(l, n):
@@ -615,30 +1458,33 @@ def chunks(l, n):
 @click.command()
 @click.argument('sources', nargs=-1)
 @click.option('--bits', '-b', is_flag=True)
+@click.option('--buffered/--unbuffered', default=None)
+@click.option('--read-ahead', type=click.IntRange(1), metavar='BATCHES')
 @click.option('--verbose', is_flag=True)
-def dump(sources, bits, verbose):
+def dump(sources, bits, buffered, read_ahead, verbose):
     """ Gives a detailed dump of each AIS sentence. """
     sentence_count = 0
-    for sentence in sentences_from_sources(sources, log_errors=verbose):
-        with wild_disregard_for(BrokenPipeError):
+    with wild_disregard_for(BrokenPipeError), LineOutput(buffered=buffered) as output:
+        for sentence in sentences_from_sources(sources, log_errors=verbose, read_ahead=read_ahead):
             if sentence_count != 0:
-                print()
+                output.write()
             sentence_count += 1
-            print("Sentence {}:".format(sentence_count))
+            output.write("Sentence {}:".format(sentence_count))
             if sentence.time:
-                print("          time: {}".format(time_to_text(sentence.time)))
+                output.write("          time: {}".format(time_to_text(sentence.time)))
             for t in sentence.text:
-                print("          text: {}".format(re.search("!.*", t).group(0)))
-            print("        length: {}".format(len(sentence.message_bits())))
+                output.write("          text: {}".format(re.search("!.*", t).group(0)))
+            output.write("        length: {}".format(len(sentence.message_bits())))
             if bits:
                 bit_lumps = list(chunks(str(sentence.message_bits()), 6))
                 groups = chunks(bit_lumps, 8)
                 pos = 0
-                print("         check: {}".format(", ".join([str(c) for c in sentence.fragment_checksum_validity()])))
-                print("          bits: {:3d} {}".format(pos, " ".join(groups.__next__())))
+                output.write("         check: {}".format(
+                    ", ".join([str(c) for c in sentence.fragment_checksum_validity()])))
+                output.write("          bits: {:3d} {}".format(pos, " ".join(groups.__next__())))
                 for group in groups:
                     pos += 48
-                    print("          bits: {:3d} {}".format(pos, " ".join(group)))
+                    output.write("          bits: {:3d} {}".format(pos, " ".join(group)))
 
             for field in sentence.fields():
                 value = '-'
@@ -647,9 +1493,9 @@ def dump(sources, bits, verbose):
                     if field.name() == 'time':
                         value = time_to_text(value)
                 if bits:
-                    print("  {:>12}: {} ({})".format(field.name(), value, field.bits()))
+                    output.write("  {:>12}: {} ({})".format(field.name(), value, field.bits()))
                 else:
-                    print("  {:>12}: {}".format(field.name(), value))
+                    output.write("  {:>12}: {}".format(field.name(), value))
 
 
 def value_for(field, sentence):
@@ -660,6 +1506,8 @@ def value_for(field, sentence):
             return strftime("%H", localtime(sentence.time))
         elif field == 'time-minute':
             return strftime("%M", localtime(sentence.time))
+    elif field == 'channel':
+        return sentence.radio_channel or None
     elif field in ('geo-degree', 'geo-tenth', 'geo-hundredth'):
         lon = sentence['lon']
         lat = sentence['lat']
@@ -678,6 +1526,150 @@ def value_tuple_for(fields, sentence):
         return result
 
 
+def count_values(fields, sentences):
+    counts = defaultdict(int)
+    for sentence in sentences:
+        val = value_tuple_for(fields, sentence)
+        if val:
+            counts[val] += 1
+    return counts
+
+
+def merge_counts(counts, other):
+    for key, value in other.items():
+        counts[key] += value
+    return counts
+
+
+def count_values_approximately(fields, sentences, top=100):
+    counts = ApproximateCounts(top)
+    for sentence in sentences:
+        val = value_tuple_for(fields, sentence)
+        if val:
+            counts.add(val)
+    return counts
+
+
+def _stat_shard(fields, verbose, where, shard):
+    sentences = shard.sentences(log_errors=verbose)
+    return count_values(fields, where.filter(sentences) if where else sentences)
+
+
+def _approximate_stat_shard(fields, verbose, where, top, shard):
+    sentences = shard.sentences(log_errors=verbose)
+    return count_values_approximately(fields, where.filter(sentences) if where else sentences, top)
+
+
+QUANTILE_COLUMNS = [(0, 'min'), (0.05, '5%'), (0.25, '25%'), (0.5, '50%'), (0.75, '75%'), (0.95, '95%'), (1, 'max')]
+
+
+# values at or above these mean "not available", as text_for treats them
+NOT_AVAILABLE_FROM = {'speed': 102.3, 'course': 360, 'heading': 360, 'lat': 91, 'lon': 181}
+
+
+def _number(value, field=None):
+    if value is None:
+        return None
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    if field in NOT_AVAILABLE_FROM and value >= NOT_AVAILABLE_FROM[field]:
+        return None
+    return value
+
+
+def summarize_values(field, group_fields, sentences, histogram=None, batch_size=1 << 16):
+    """
+    A NumericSummary of a numeric field for each distinct value tuple of the group fields.
+    The field "interval" is the time in seconds since the sender's previous sentence.
+    Values that stand for "not available", like a speed of 102.3, are left out.
+    Values are collected and handed over in NumPy batches.
+    """
+    summaries = {}
+    pending = defaultdict(list)
+    pending_count = 0
+    last_seen = {}
+
+    def flush():
+        for key, values in pending.items():
+            if key not in summaries:
+                summaries[key] = NumericSummary(histogram=histogram)
+            summaries[key].add_many(values)
+        pending.clear()
+
+    for sentence in sentences:
+        if field == 'interval':
+            mmsi, value = sentence['mmsi'], None
+            if sentence.time is not None:
+                if mmsi in last_seen:
+                    value = sentence.time - last_seen[mmsi]
+                last_seen[mmsi] = sentence.time
+        else:
+            value = _number(sentence[field], field)
+        if value is None:
+            continue
+        key = value_tuple_for(group_fields, sentence) if group_fields else ()
+        if key is None:
+            continue
+        pending[key].append(value)
+        pending_count += 1
+        if pending_count >= batch_size:
+            flush()
+            pending_count = 0
+    flush()
+    return summaries
+
+
+def merge_summaries(summaries, other):
+    for key, summary in other.items():
+        if key in summaries:
+            summaries[key].merge(summary)
+        else:
+            summaries[key] = summary
+    return summaries
+
+
+def _summary_shard(field, fields, histogram, verbose, where, shard):
+    sentences = shard.sentences(log_errors=verbose)
+    return summarize_values(field, fields, where.filter(sentences) if where else sentences, histogram)
+
+
+def print_summaries(summaries, fields, output, scale=1):
+    def scaled(count):
+        return int(round(count * scale))
+
+    def number(value):
+        return "" if value is None else "{:.6g}".format(value)
+
+    rows = [["+".join(fields) if fields else "", "count", "mean"] + [name for ignored, name in QUANTILE_COLUMNS]]
+    for key in sorted(summaries):
+        summary = summaries[key]
+        quantiles = summary.quantiles([fraction for fraction, ignored in QUANTILE_COLUMNS])
+        rows.append([tuple_display(key) if key else "all", str(scaled(summary.count)), number(summary.mean())] +
+                    [number(q) for q in quantiles])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print("  ".join([row[0].ljust(widths[0])] + [cell.rjust(w) for cell, w in zip(row[1:], widths[1:])]))
+
+    if output == 'hist':
+        for key in sorted(summaries):
+            histogram = summaries[key].histogram
+            print()
+            print("{}:".format(tuple_display(key) if key else "all"))
+            bins = [("{:g} to {:g}".format(low, high), scaled(count)) for low, high, count in histogram.bins()]
+            if histogram.below:
+                bins.insert(0, ("below {:g}".format(histogram.low), scaled(histogram.below)))
+            if histogram.above:
+                bins.append(("above {:g}".format(histogram.high), scaled(histogram.above)))
+            label_width = max(len(label) for label, ignored in bins)
+            count_width = max(len(str(count)) for ignored, count in bins)
+            largest = max(count for ignored, count in bins) or 1
+            for label, count in bins:
+                print("  {:>{}}  {:{}}  {}".format(label, label_width, count, count_width,
+                                                   "*" * int(40 * count // largest + (1 if count else 0))))
+
+
 def tuple_display(t):
     if len(t) == 1:
         return str(t[0])
@@ -697,15 +1689,64 @@ def tuple_display(t):
 @click.option('--hundredth', 'fields', flag_value='geo-hundredth', multiple=True)
 @click.option('--count', '-c', 'output', flag_value='count', default=True)
 @click.option('--hist', '-h', 'output', flag_value='hist')
+@click.option('--where', '-w', callback=parse_expression)
+@click.option('--approx', is_flag=True)
+@click.option('--top', type=click.IntRange(1), default=100)
+@click.option('--quantiles', '-q', 'quantile_field', metavar='FIELD')
+@click.option('--range', 'value_range', type=(float, float), metavar='LOW HIGH')
+@click.option('--bins', type=click.IntRange(1), default=20)
+@click.option('--sample', 'sampler', metavar='KIND:AMOUNT', callback=parse_sampler)
+@click.option('--jobs', '-j', type=int, default=1)
+@click.option('--read-ahead', type=click.IntRange(1), metavar='BATCHES')
 @click.option('--verbose', is_flag=True)
-def stat(sources, fields, output, verbose):
+def stat(sources, fields, output, where, approx, top, quantile_field, value_range, bins, sampler, jobs, read_ahead,
+         verbose):
+    """ Counts sentences by field values, or with --quantiles summarizes a numeric field. """
+    if sampler and jobs > 1:
+        raise click.UsageError("--sample reads sources in one pass, so it can't be combined with --jobs")
+    if read_ahead and (sampler or jobs > 1):
+        raise click.UsageError("--read-ahead only applies to reading sources in one pass, without --sample or --jobs")
+    if quantile_field:
+        if output == 'hist' and not value_range:
+            raise click.UsageError("--hist with --quantiles needs a --range to put the bins in")
+        histogram = (value_range[0], value_range[1], bins) if output == 'hist' else None
+        if histogram and not value_range[0] < value_range[1]:
+            raise click.UsageError("--range LOW HIGH needs LOW below HIGH")
+        if quantile_field == 'interval':
+            # each gap needs the sender's previous sentence, which may be in another shard or left out
+            if jobs > 1:
+                raise click.UsageError("-q interval follows each sender in order, so it can't be combined with --jobs")
+            if sampler and not sampler.scales_senders():
+                raise click.UsageError("-q interval needs every sentence from a sender; sample with vessels:AMOUNT")
+        if jobs > 1:
+            work = functools.partial(_summary_shard, quantile_field, fields, histogram, verbose, where)
+            summaries = map_reduce(sources, work, merge_summaries, {}, jobs)
+        else:
+            sentences = sentences_from_sources(sources, log_errors=verbose, read_ahead=read_ahead, sampler=sampler)
+            summaries = summarize_values(quantile_field, fields, where.filter(sentences) if where else sentences,
+                                         histogram)
+        print_summaries(summaries, fields, output, sampler.scale() if sampler else 1)
+        _report_sample(sampler)
+        return
     if not fields or len(fields) < 1:
         raise click.UsageError("at least one field required; try --hour or -f type")
-    counts = defaultdict(int)
-    for sentence in sentences_from_sources(sources, log_errors=verbose):
-        val = value_tuple_for(fields, sentence)
-        if val:
-            counts[val] += 1
+    approximate = None
+    if approx and jobs > 1:
+        approximate = map_reduce(sources, functools.partial(_approximate_stat_shard, fields, verbose, where, top),
+                                 ApproximateCounts.merge, ApproximateCounts(top), jobs)
+    elif approx:
+        sentences = sentences_from_sources(sources, log_errors=verbose, read_ahead=read_ahead, sampler=sampler)
+        approximate = count_values_approximately(fields, where.filter(sentences) if where else sentences, top)
+    elif jobs > 1:
+        counts = map_reduce(sources, functools.partial(_stat_shard, fields, verbose, where), merge_counts,
+                            defaultdict(int), jobs)
+    else:
+        sentences = sentences_from_sources(sources, log_errors=verbose, read_ahead=read_ahead, sampler=sampler)
+        counts = count_values(fields, where.filter(sentences) if where else sentences)
+    if approximate:
+        counts = dict(approximate.most_common())
+    if sampler:
+        counts = {key: int(round(count * sampler.scale())) for key, count in counts.items()}
 
     key_width = max([len(str(tuple_display(k))) for k in counts.keys()], default=0)
     val_width = max([len(str(v)) for v in counts.values()], default=0)
@@ -723,6 +1764,16 @@ def stat(sources, fields, output, verbose):
                 key_width=key_width, val_width=val_width,
                 hist="*" * int(1 + 40 * counts[key] // largest))
             )
+    if approximate:
+        print("about {} distinct values in {} sentences; counts of the {} most common are at most {} too high".format(
+            approximate.distinct.count(), approximate.total(), len(counts), approximate.error_bound()))
+    _report_sample(sampler)
+
+
+def _report_sample(sampler):
+    if sampler:
+        print("counts estimated from a sample of {}, scaled up {:.3g} times".format(
+            sampler.description(), sampler.scale()), file=sys.stderr)
 
 
 class RefineFilter:
@@ -801,25 +1852,1031 @@ class RefineFilter:
             self.recorded_voyage = self.voyage_tuple(sentence)
 
 
+class RefineStage:
+    """Keeps a RefineFilter per sender, returning the text of the sentences worth keeping."""
+
+    def __init__(self):
+        self.filters = defaultdict(RefineFilter)
+
+    def process(self, sentence):
+        filter = self.filters[sentence['mmsi']]
+        if filter.wants(sentence):
+            filter.mark(sentence)
+            return "\n".join(source_lines_for(sentence))
+
+    def finish(self):
+        pass
+
+
+def _run_vessel_stage(stage_factory, inbox, outbox):
+    # noinspection PyBroadException
+    try:
+        stage = stage_factory()
+        while True:
+            item = inbox.get()
+            if item is None:
+                stage.finish()
+                outbox.put(('done', []))
+                break
+            results = []
+            for seq, lines in item:
+                result = stage.process(parse_many(lines)[0])
+                if result is not None:
+                    results.append((seq, result))
+            outbox.put(('results', results))
+    except Exception:
+        logging.exception("vessel stage failed")
+        outbox.put(('failed', []))
+
+
+class VesselShards:
+    """
+    Runs a stateful per-vessel stage in worker processes. Sentences are routed by MMSI,
+    so each worker sees all of its vessels' sentences in their original order and owns
+    their state. A stage has process(sentence), returning a result or None, and finish();
+    results come back in input order, just as from a single stage.
+    """
+
+    def __init__(self, stage_factory, jobs, chunk_size=10000, in_flight=4, max_delay=1.0):
+        self.stage_factory = stage_factory
+        self.jobs = jobs
+        self.chunk_size = chunk_size
+        self.in_flight = in_flight
+        self.max_delay = max_delay
+        self.workers = []
+
+    def shard_for(self, sentence):
+        mmsi = sentence['mmsi']
+        return int(mmsi) % self.jobs if mmsi else 0
+
+    def run(self, sentences):
+        for ignored in range(self.jobs):
+            inbox, outbox = multiprocessing.Queue(), multiprocessing.Queue()
+            process = multiprocessing.Process(target=_run_vessel_stage, args=(self.stage_factory, inbox, outbox),
+                                              daemon=True)
+            process.start()
+            self.workers.append((process, inbox, outbox))
+        try:
+            chunk = [[] for ignored in range(self.jobs)]
+            chunk_count = 0
+            sent = 0
+            last_send = time.time()
+            for seq, sentence in enumerate(sentences):
+                chunk[self.shard_for(sentence)].append((seq, list(source_lines_for(sentence))))
+                chunk_count += 1
+                if chunk_count >= self.chunk_size or time.time() - last_send > self.max_delay:
+                    self._send(chunk)
+                    sent += 1
+                    chunk = [[] for ignored in range(self.jobs)]
+                    chunk_count = 0
+                    last_send = time.time()
+                    if sent >= self.in_flight:
+                        yield from self._collect()
+                        sent -= 1
+            self._send(chunk)
+            sent += 1
+            for ignored in range(sent):
+                yield from self._collect()
+            self._send([None] * self.jobs)
+            for ignored in self._collect():
+                pass
+        finally:
+            for process, inbox, outbox in self.workers:
+                process.join(1)
+                if process.is_alive():
+                    process.terminate()
+            self.workers = []
+
+    def _send(self, chunk):
+        for (process, inbox, outbox), items in zip(self.workers, chunk):
+            inbox.put(items)
+
+    def _collect(self):
+        results = []
+        for process, inbox, outbox in self.workers:
+            status, worker_results = outbox.get()
+            if status == 'failed':
+                raise RuntimeError("vessel stage failed in worker {}".format(process.pid))
+            results.append(worker_results)
+        for seq, result in heapq.merge(*results):
+            yield result
+
+
 @click.command()
 @click.argument('sources', nargs=-1)
-def refine(sources):
-    filters = defaultdict(RefineFilter)
-    for sentence in sentences_from_sources(sources):
-        with wild_disregard_for(BrokenPipeError):
-            filter = filters[sentence['mmsi']]
-            if filter.wants(sentence):
-                print_sentence_source(sentence)
-                filter.mark(sentence)
+@click.option('--by-time', is_flag=True)
+@click.option('--lateness', type=float, default=0.0)
+@click.option('--jobs', '-j', type=int, default=1)
+@click.option('--follow', is_flag=True)
+@click.option('--buffered/--unbuffered', default=None)
+@click.option('--output', '-o', 'path', type=click.Path(dir_okay=False))
+@click.option('--compress', type=click.Choice(list(COMPRESSION_LEVELS)))
+@click.option('--read-ahead', type=click.IntRange(1), metavar='BATCHES')
+def refine(sources, by_time, lateness, jobs, follow, buffered, path, compress, read_ahead):
+    if follow and jobs > 1:
+        # workers hand back their vessels' results only at the end of the input
+        raise click.UsageError("--jobs reports once the input ends, so it can't be combined with --follow")
+    sentences = sentences_from_sources(sources, read_ahead=read_ahead, by_time=by_time, lateness=lateness,
+                                       follow=follow)
+    if jobs > 1:
+        results = VesselShards(RefineStage, jobs).run(sentences)
+    else:
+        stage = RefineStage()
+        results = (stage.process(sentence) for sentence in sentences)
+    with wild_disregard_for(BrokenPipeError), open_output(path, compress, buffered) as output:
+        for result in results:
+            if result is not None:
+                output.write(result)
 
 
 @click.command()
 @click.argument('sources', nargs=-1)
-def to_json(sources):
+@click.option('--where', '-w', callback=parse_expression)
+@click.option('--jobs', '-j', type=int, default=1)
+@click.option('--unordered', is_flag=True)
+@click.option('--buffered/--unbuffered', default=None)
+@click.option('--read-ahead', type=click.IntRange(1), metavar='BATCHES')
+def to_json(sources, where, jobs, unordered, buffered, read_ahead):
     """ Prints out all complete AIS transmissions.  """
-    for sentence in sentences_from_sources(sources):
-        with wild_disregard_for(BrokenPipeError):
-            print(sentence.as_json())
+    if read_ahead and jobs > 1:
+        raise click.UsageError("--read-ahead only applies to reading sources in one pass, without --jobs")
+    with wild_disregard_for(BrokenPipeError), LineOutput(buffered=buffered) as output:
+        if jobs > 1:
+            work = functools.partial(_json_for_shard, where)
+            for shard, texts in process_sources(shards_for(sources), work, jobs, ordered=not unordered):
+                for text in texts:
+                    output.write(text)
+        else:
+            sentences = sentences_from_sources(sources, read_ahead=read_ahead)
+            for sentence in where.filter(sentences) if where else sentences:
+                output.write(sentence.as_json())
+
+
+def _json_for_shard(where, shard):
+    sentences = shard.sentences()
+    return [sentence.as_json() for sentence in (where.filter(sentences) if where else sentences)]
+
+
+class ClientFeed:
+    """
+    One connected relay client. The ingest side offers data without ever blocking; a
+    per-client thread drains the bounded buffer to the socket. When the buffer is full,
+    the policy decides whether to drop the oldest data, the newest data, or the client.
+    """
+    POLICIES = ('drop-oldest', 'drop-newest', 'disconnect')
+
+    def __init__(self, connection, address=None, buffer_size=10000, policy='drop-oldest'):
+        if policy not in self.POLICIES:
+            raise ValueError("unknown policy {}".format(policy))
+        self.connection = connection
+        self.address = address
+        self.buffer_size = buffer_size
+        self.policy = policy
+        self.buffer = deque()
+        self.condition = threading.Condition()
+        self.open = True
+        self.sent_count = 0
+        self.dropped_count = 0
+        self.lag = 0.0
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="client {}".format(self.address), daemon=True)
+        self.thread.start()
+
+    def offer(self, data):
+        with self.condition:
+            if not self.open:
+                return False
+            if len(self.buffer) >= self.buffer_size:
+                if self.policy == 'drop-newest':
+                    self.dropped_count += 1
+                    return False
+                elif self.policy == 'disconnect':
+                    self.dropped_count += len(self.buffer) + 1
+                    self.buffer.clear()
+                    self.open = False
+                    self.condition.notify()
+                    self._hang_up()
+                    return False
+                else:
+                    self.buffer.popleft()
+                    self.dropped_count += 1
+            self.buffer.append((time.time(), data))
+            self.condition.notify()
+            return True
+
+    def _hang_up(self):
+        # wakes the drain thread if it is stuck sending to a client that stopped reading
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.connection.close()
+
+    def pending(self):
+        return len(self.buffer)
+
+    def run(self):
+        try:
+            while True:
+                with self.condition:
+                    while self.open and not self.buffer:
+                        self.condition.wait()
+                    if not self.buffer:
+                        break
+                    batch = list(self.buffer)
+                    self.buffer.clear()
+                self.connection.sendall(b"".join(data for _, data in batch))
+                self.sent_count += len(batch)
+                self.lag = time.time() - batch[0][0]
+        except OSError:
+            logging.getLogger().info("client {} went away".format(self.address))
+        finally:
+            self.open = False
+            self.connection.close()
+
+    def finish(self, timeout=None):
+        """Stops accepting data, letting whatever is buffered drain first."""
+        with self.condition:
+            self.open = False
+            self.condition.notify()
+        if self.thread:
+            self.thread.join(timeout)
+
+    def stats(self):
+        return {'address': self.address, 'sent': self.sent_count, 'dropped': self.dropped_count,
+                'pending': self.pending(), 'lag': self.lag}
+
+
+class FanOutServer:
+    """
+    Accepts TCP clients and relays each published sentence, in its original text form,
+    to all of them. An optional Taster limits what gets relayed.
+    """
+
+    def __init__(self, host='localhost', port=0, buffer_size=10000, policy='drop-oldest', taster=None,
+                 send_timeout=30):
+        self.host = host
+        self.port = port
+        self.buffer_size = buffer_size
+        self.policy = policy
+        self.taster = taster
+        self.send_timeout = send_timeout
+        self.listener = None
+        self.address = None
+        self.clients = []
+        self.departed = []
+        self.lock = threading.Lock()
+        self.received_count = 0
+        self.published_count = 0
+        self.disconnected_count = 0
+        self.started = time.time()
+
+    def start(self):
+        self.listener = socket.create_server((self.host, self.port))
+        self.address = self.listener.getsockname()
+        threading.Thread(target=self._accept, name="accept", daemon=True).start()
+        return self
+
+    def _accept(self):
+        while True:
+            try:
+                connection, address = self.listener.accept()
+            except OSError:
+                break
+            connection.settimeout(self.send_timeout)  # so a stalled client can't block its sender forever
+            client = ClientFeed(connection, address, self.buffer_size, self.policy)
+            client.start()
+            with self.lock:
+                self.clients.append(client)
+
+    def _live_clients(self):
+        with self.lock:
+            live = [c for c in self.clients if c.open]
+            self.disconnected_count += len(self.clients) - len(live)
+            # keep hold of departed clients until their threads end, so close() can join them
+            self.departed = [c for c in self.departed + self.clients
+                             if not c.open and c.thread and c.thread.is_alive()]
+            self.clients = live
+            return live
+
+    def publish(self, sentence):
+        self.received_count += 1
+        if self.taster and not self.taster.likes(sentence):
+            return
+        self.published_count += 1
+        data = "".join(line + "\n" for line in source_lines_for(sentence)).encode('utf-8')
+        for client in self._live_clients():
+            client.offer(data)
+
+    def close(self, timeout=5):
+        if self.listener:
+            self.listener.close()
+        with self.lock:
+            clients = self.clients + self.departed
+        for client in clients:
+            client.finish(timeout)
+
+    def stats(self):
+        with self.lock:
+            clients = [c.stats() for c in self.clients]
+        return {'received': self.received_count, 'published': self.published_count,
+                'disconnected': self.disconnected_count, 'elapsed': time.time() - self.started,
+                'clients': clients}
+
+    def report(self, file=sys.stdout):
+        stats = self.stats()
+        rate = stats['published'] / stats['elapsed'] if stats['elapsed'] > 0 else 0.0
+        print("relayed {} of {} sentences ({:.1f}/s) to {} clients ({} disconnected)".format(
+            stats['published'], stats['received'], rate, len(stats['clients']), stats['disconnected']), file=file)
+        for client in stats['clients']:
+            print("  {}: sent {}, dropped {}, pending {}, lag {:.3f}s".format(
+                client['address'], client['sent'], client['dropped'], client['pending'], client['lag']), file=file)
+
+
+@click.command()
+@click.argument('sources', nargs=-1)
+@click.option('--host', default='localhost')
+@click.option('--port', '-p', type=int, default=10110)
+@click.option('--mmsi', '-m', multiple=True)
+@click.option('--type', '-t', 'sentence_type', type=int, multiple=True)
+@click.option('--class', 'vessel_class', type=click.Choice(['a', 'b']))
+@click.option('--longitude', '--long', '--lon', 'lon', nargs=2, type=float)
+@click.option('--latitude', '--lat', 'lat', nargs=2, type=float)
+@click.option('--buffer', 'buffer_size', type=int, default=10000)
+@click.option('--policy', type=click.Choice(ClientFeed.POLICIES), default='drop-oldest')
+@click.option('--stats', 'stats_interval', type=float)
+@click.option('--follow', is_flag=True)
+@click.option('--read-ahead', type=click.IntRange(1), metavar='BATCHES')
+@click.option('--verbose', is_flag=True)
+def serve(sources, host, port, mmsi, sentence_type, vessel_class, lon, lat, buffer_size, policy, stats_interval,
+          follow, read_ahead, verbose):
+    """ Relays AIS transmissions to any number of TCP clients. """
+    taster = None
+    if mmsi or sentence_type or vessel_class or lon or lat:
+        taster = Taster(frozenset(mmsi), sentence_type, vessel_class, lon, lat)
+    server = FanOutServer(host, port, buffer_size, policy, taster).start()
+    print("serving on {}:{}".format(*server.address[:2]), file=sys.stderr)
+
+    done = threading.Event()
+    if stats_interval:
+        def report_stats():
+            while not done.wait(stats_interval):
+                server.report(file=sys.stderr)
+
+        threading.Thread(target=report_stats, name="stats", daemon=True).start()
+
+    try:
+        for sentence in sentences_from_sources(sources, log_errors=verbose, read_ahead=read_ahead, follow=follow):
+            server.publish(sentence)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        done.set()
+        server.close()
+        if stats_interval:
+            server.report(file=sys.stderr)
+
+
+SHARED_RECORD = numpy.dtype([('type', 'u1'), ('mmsi', 'u4'), ('lon', 'f8'), ('lat', 'f8'), ('speed', 'f4'),
+                             ('course', 'f4'), ('time', 'f8'), ('offset', 'i8')])
+
+_created_rings = set()
+
+
+def _none_to_nan(value):
+    return math.nan if value is None else value
+
+
+def shared_record_values(sentence, offset=-1):
+    mmsi = sentence['mmsi']
+    return (sentence.type_id(), int(mmsi) if mmsi else 0,
+            _none_to_nan(sentence['lon']), _none_to_nan(sentence['lat']),
+            _none_to_nan(sentence['speed']), _none_to_nan(sentence['course']),
+            _none_to_nan(sentence.time), offset)
+
+
+class SentenceRing:
+    """
+    A ring buffer of fixed-layout sentence records (see SHARED_RECORD) in shared memory.
+    One process decodes and publishes; any number of local processes attach and read the
+    records in place. Readers that fall more than a ring's worth behind lose the oldest
+    records, which they see as overruns. Published records are written in batches, but a
+    timer writes out a partial batch after max_delay seconds, so a quiet feed isn't held up.
+    """
+    MAGIC = 0x52534941  # "AISR"
+    HEADER = numpy.dtype([('magic', 'u8'), ('capacity', 'u8'), ('reserved', 'u8'), ('written', 'u8'),
+                          ('closed', 'u8')])
+
+    def __init__(self, memory, owner=False, batch_size=1000, max_delay=0.1, before_flush=None):
+        self.memory = memory
+        self.owner = owner
+        self.header = numpy.ndarray((), self.HEADER, memory.buf)
+        if int(self.header['magic']) != self.MAGIC:
+            raise ValueError("{} is not a sentence ring".format(memory.name))
+        self.capacity = int(self.header['capacity'])
+        self.records = numpy.ndarray((self.capacity,), SHARED_RECORD, memory.buf, offset=self.HEADER.itemsize)
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.before_flush = before_flush
+        self.pending = []
+        self.lock = threading.Lock()
+        self.timer = None
+        self.position = self.written()
+        self.batch_start = self.position
+        self.overrun_count = 0
+
+    @classmethod
+    def create(cls, name=None, capacity=1 << 20, **kwargs):
+        from multiprocessing import shared_memory
+        size = cls.HEADER.itemsize + capacity * SHARED_RECORD.itemsize
+        memory = shared_memory.SharedMemory(name, create=True, size=size)
+        _created_rings.add(memory.name)
+        header = numpy.ndarray((), cls.HEADER, memory.buf)
+        header['capacity'] = capacity
+        header['magic'] = cls.MAGIC
+        del header
+        return cls(memory, owner=True, **kwargs)
+
+    @classmethod
+    def attach(cls, name, from_start=False):
+        from multiprocessing import resource_tracker, shared_memory
+        try:
+            memory = shared_memory.SharedMemory(name, track=False)
+        except TypeError:
+            # before Python 3.13, attaching registers the memory for removal when this process exits
+            memory = shared_memory.SharedMemory(name)
+            if memory.name not in _created_rings:
+                # noinspection PyProtectedMember
+                resource_tracker.unregister(memory._name, 'shared_memory')
+        ring = cls(memory)
+        if from_start:
+            ring.position = ring.batch_start = max(0, ring.written() - ring.capacity)
+        return ring
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def written(self):
+        return int(self.header['written'])
+
+    def closed(self):
+        return bool(self.header['closed'])
+
+    def publish(self, sentence, offset=-1):
+        values = shared_record_values(sentence, offset)
+        with self.lock:
+            self.pending.append(values)
+            if len(self.pending) >= self.batch_size:
+                self._flush()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.max_delay, self._timed_flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _timed_flush(self):
+        try:
+            self.flush()
+        except (OSError, ValueError):
+            pass  # the ring or raw file was closed meanwhile
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.pending:
+            if self.before_flush:
+                self.before_flush()
+            self.write(numpy.array(self.pending, dtype=SHARED_RECORD))
+            self.pending = []
+
+    def write(self, records):
+        written = self.written()
+        if len(records) > self.capacity:
+            written += len(records) - self.capacity
+            records = records[-self.capacity:]
+        count = len(records)
+        start = written % self.capacity
+        first = min(count, self.capacity - start)
+        self.header['reserved'] = written + count
+        self.records[start:start + first] = records[:first]
+        self.records[:count - first] = records[first:]
+        self.header['written'] = written + count
+
+    def read(self, max_records=None):
+        """Returns a view of the next unread records; check intact() once done with it."""
+        reserved = int(self.header['reserved'])
+        if reserved - self.position > self.capacity:
+            self.overrun_count += reserved - self.position - self.capacity
+            self.position = reserved - self.capacity
+        start = self.position % self.capacity
+        count = min(self.written() - self.position, self.capacity - start)
+        if max_records is not None:
+            count = min(count, max_records)
+        self.batch_start = self.position
+        self.position += count
+        return self.records[start:start + count]
+
+    def intact(self):
+        """True if the records from the last read() weren't overwritten while in use."""
+        return int(self.header['reserved']) <= self.batch_start + self.capacity
+
+    def lag(self):
+        return self.written() - self.position
+
+    def follow(self, poll_interval=0.01):
+        """Yields batches of records as they arrive, until the publisher closes the ring."""
+        while True:
+            closed = self.closed()
+            batch = self.read()
+            if len(batch) > 0:
+                yield batch
+            elif closed:
+                break
+            else:
+                time.sleep(poll_interval)
+
+    def close(self):
+        if self.owner:
+            self.flush()
+            self.header['closed'] = 1
+        del self.header, self.records
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+            _created_rings.discard(self.memory.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+@click.command()
+@click.argument('sources', nargs=-1)
+@click.option('--name', '-n', default='simpleais')
+@click.option('--capacity', type=int, default=1 << 20)
+@click.option('--raw', 'raw_file', type=click.Path())
+@click.option('--follow', is_flag=True)
+@click.option('--read-ahead', type=click.IntRange(1), metavar='BATCHES')
+@click.option('--verbose', is_flag=True)
+def share(sources, name, capacity, raw_file, follow, read_ahead, verbose):
+    """ Decodes AIS transmissions once, sharing the records with local processes. """
+    raw = open(raw_file, 'ab') if raw_file else None
+    # raw text must be on disk before the records pointing at it are visible
+    with SentenceRing.create(name, capacity, before_flush=raw.flush if raw else None) as ring:
+        print("sharing {} records as {}".format(capacity, ring.name), file=sys.stderr)
+        sentences = sentences_from_sources(sources, log_errors=verbose, read_ahead=read_ahead, follow=follow)
+        try:
+            for count, sentence in enumerate(sentences):
+                if raw:
+                    offset = raw.tell()
+                    raw.write("".join(line + "\n" for line in source_lines_for(sentence)).encode('utf-8'))
+                else:
+                    offset = count
+                ring.publish(sentence, offset)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            ring.flush()
+            if raw:
+                raw.close()
+
+
+class ExternalSorter:
+    """
+    Sorts sentences by time, or by sender and then time, in bounded memory. Sorted runs
+    of up to run_size sentences are spilled to temporary files, optionally compressed, and
+    then merged; a multi-fragment message travels as one record. Sentences without a time
+    take the time of the one before, and ties keep their input order.
+    """
+
+    def __init__(self, by='time', run_size=1000000, directory=None, compress=False, merge_width=128):
+        if by not in ('time', 'mmsi'):
+            raise ValueError("unknown sort order {}".format(by))
+        self.by = by
+        self.run_size = run_size
+        self.directory = directory
+        self.compress = compress
+        self.merge_width = merge_width
+        self.buffer = []
+        self.runs = []
+        self.run_count = 0
+        self.count = 0
+        self.last_time = float('-inf')
+        self.temp = None
+
+    def add(self, sentence):
+        if sentence.time is not None:
+            self.last_time = sentence.time
+        if self.by == 'mmsi':
+            key = (sentence['mmsi'] or '', self.last_time, self.count)
+        else:
+            key = (self.last_time, self.count)
+        self.buffer.append((key, list(source_lines_for(sentence))))
+        self.count += 1
+        if len(self.buffer) >= self.run_size:
+            self._spill()
+
+    def _open(self, path, mode):
+        if self.compress:
+            return gzip.open(path, mode, compresslevel=1)
+        return open(path, mode)
+
+    def _new_run_path(self):
+        if self.temp is None:
+            self.temp = tempfile.TemporaryDirectory(prefix='aissort-', dir=self.directory)
+        path = os.path.join(self.temp.name, "run-{}{}".format(self.run_count, ".gz" if self.compress else ""))
+        self.run_count += 1
+        self.runs.append(path)
+        return path
+
+    def _write_run(self, records):
+        with self._open(self._new_run_path(), 'wt') as f:
+            for key, lines in records:
+                f.write("\t".join([repr(k) if isinstance(k, float) else str(k) for k in key] + lines))
+                f.write("\n")
+
+    def _read_run(self, path):
+        with self._open(path, 'rt') as f:
+            for record in f:
+                fields = record.rstrip("\n").split("\t")
+                if self.by == 'mmsi':
+                    yield (fields[0], float(fields[1]), int(fields[2])), fields[3:]
+                else:
+                    yield (float(fields[0]), int(fields[1])), fields[2:]
+
+    def _spill(self):
+        self.buffer.sort(key=itemgetter(0))
+        self._write_run(self.buffer)
+        self.buffer = []
+
+    def _merge_runs(self, runs):
+        return heapq.merge(*[self._read_run(run) for run in runs], key=itemgetter(0))
+
+    def sorted(self):
+        """Yields the source lines of each sentence in order."""
+        try:
+            if not self.runs:
+                self.buffer.sort(key=itemgetter(0))
+                records = self.buffer
+            else:
+                if self.buffer:
+                    self._spill()
+                while len(self.runs) > self.merge_width:
+                    group, self.runs = self.runs[:self.merge_width], self.runs[self.merge_width:]
+                    self._write_run(self._merge_runs(group))
+                    for run in group:
+                        os.remove(run)
+                records = self._merge_runs(self.runs)
+            for key, lines in records:
+                yield lines
+        finally:
+            self.close()
+
+    def close(self):
+        self.buffer = []
+        self.runs = []
+        if self.temp is not None:
+            self.temp.cleanup()
+            self.temp = None
+
+
+@click.command()
+@click.argument('sources', nargs=-1)
+@click.option('--by', type=click.Choice(['time', 'mmsi']), default='time')
+@click.option('--run-size', type=int, default=1000000)
+@click.option('--temp-dir', type=click.Path(exists=True, file_okay=False))
+@click.option('--compress-runs', is_flag=True)
+@click.option('--buffered/--unbuffered', default=None)
+@click.option('--read-ahead', type=click.IntRange(1), metavar='BATCHES')
+@click.option('--verbose', is_flag=True)
+def sort(sources, by, run_size, temp_dir, compress_runs, buffered, read_ahead, verbose):
+    """ Sorts AIS transmissions by time, or by sender and time, using temporary files as needed. """
+    sorter = ExternalSorter(by, run_size, temp_dir, compress_runs)
+    for sentence in sentences_from_sources(sources, log_errors=verbose, read_ahead=read_ahead):
+        sorter.add(sentence)
+    with wild_disregard_for(BrokenPipeError), LineOutput(buffered=buffered) as output:
+        for lines in sorter.sorted():
+            for line in lines:
+                output.write(line)
+
+
+class FenceEvent:
+    ENTER = 'enter'
+    EXIT = 'exit'
+    DWELL = 'dwell'
+
+    def __init__(self, time, mmsi, kind, zone, duration=None):
+        self.time = time
+        self.mmsi = mmsi
+        self.kind = kind
+        self.zone = zone
+        self.duration = duration
+
+    def text(self):
+        result = "{} {:9} {:5} {}".format(time_to_text(self.time), self.mmsi, self.kind, self.zone)
+        if self.duration is not None:
+            result += " after {:.0f}s".format(self.duration)
+        return result
+
+    def __eq__(self, other):
+        return isinstance(other, FenceEvent) and vars(self) == vars(other)
+
+    def __repr__(self):
+        return "FenceEvent({}, {}, {}, {!r}, {})".format(self.time, self.mmsi, self.kind, self.zone, self.duration)
+
+
+class GeofenceMonitor:
+    """
+    Tracks which zones each vessel is in and reports when one enters or leaves a zone, and,
+    if dwell is set, when it has stayed in one for that many seconds. Each position is
+    checked only against the zones indexed near it. Only vessels currently inside some zone
+    need any state, and at most max_vessels of those are kept, dropping the ones heard
+    from least recently.
+    """
+
+    def __init__(self, zones, dwell=None, max_vessels=100000):
+        self.zones = zones
+        self.dwell = dwell
+        self.max_vessels = max_vessels
+        self.inside = OrderedDict()  # mmsi -> {zone number: [time entered, dwell reported]}
+        self.forgotten_count = 0
+
+    def process(self, sentence):
+        """The events this sentence sets off, as a list."""
+        location = sentence.location()
+        mmsi = sentence['mmsi']
+        if location is None or mmsi is None:
+            return []
+        now = sentence.time if sentence.time is not None else time.time()
+        previous = self.inside.pop(mmsi, None)
+        numbers = self.zones.numbers_containing(location)
+        if not numbers and not previous:
+            return []
+
+        events = []
+        current = {}
+        for number in numbers:
+            if previous and number in previous:
+                current[number] = stay = previous[number]
+                if self.dwell is not None and not stay[1] and now - stay[0] >= self.dwell:
+                    stay[1] = True
+                    events.append(FenceEvent(now, mmsi, FenceEvent.DWELL, self._name(number), now - stay[0]))
+            else:
+                current[number] = [now, False]
+                events.append(FenceEvent(now, mmsi, FenceEvent.ENTER, self._name(number)))
+        for number, (entered, reported) in (previous or {}).items():
+            if number not in current:
+                events.append(FenceEvent(now, mmsi, FenceEvent.EXIT, self._name(number), now - entered))
+
+        if current:
+            self.inside[mmsi] = current
+            if len(self.inside) > self.max_vessels:
+                self.inside.popitem(last=False)
+                self.forgotten_count += 1
+        return events
+
+    def _name(self, number):
+        return self.zones.polygons[number].name
+
+    def vessels_inside(self):
+        return len(self.inside)
+
+
+@click.command()
+@click.argument('fences', type=click.Path(exists=True, dir_okay=False))
+@click.argument('sources', nargs=-1)
+@click.option('--dwell', type=float, metavar='SECONDS')
+@click.option('--max-vessels', type=int, default=100000)
+@click.option('--follow', is_flag=True)
+@click.option('--buffered/--unbuffered', default=None)
+@click.option('--read-ahead', type=click.IntRange(1), metavar='BATCHES')
+@click.option('--verbose', is_flag=True)
+def fence(fences, sources, dwell, max_vessels, follow, buffered, read_ahead, verbose):
+    """ Reports vessels entering, leaving and dwelling in the zones of a GeoJSON file. """
+    monitor = GeofenceMonitor(PolygonIndex(read_polygon_files([fences])), dwell, max_vessels)
+    with wild_disregard_for(BrokenPipeError), LineOutput(buffered=buffered) as output:
+        for sentence in sentences_from_sources(sources, log_errors=verbose, read_ahead=read_ahead, follow=follow):
+            for event in monitor.process(sentence):
+                output.write(event.text())
+    if verbose:
+        print("{} vessels inside zones at the end; {} forgotten to stay within --max-vessels".format(
+            monitor.vessels_inside(), monitor.forgotten_count), file=sys.stderr)
+
+
+class TilePyramid:
+    """
+    Counts positions into Web-Mercator map tiles, saved as tile_size x tile_size NumPy
+    arrays of counts in directory/zoom/x/y.npy, with row 0 at the north edge. Positions
+    are counted at max_zoom in batches; at most max_tiles tiles are kept in memory, and the
+    least recently used are added into their files to make room, so the whole world can be
+    mapped in bounded memory. finish() then builds each coarser level from the one below it
+    by adding up 2 x 2 blocks of pixels.
+
+    With a dedup period in seconds, each vessel counts at most once per max_zoom pixel per
+    period, so that a vessel sitting in port doesn't outweigh the traffic passing by. Only
+    the current and previous periods are remembered, so input should be roughly in time
+    order.
+    """
+
+    def __init__(self, directory, max_zoom=10, min_zoom=0, tile_size=256, dedup=None, max_tiles=256,
+                 batch_size=1 << 16):
+        if tile_size < 2 or tile_size & (tile_size - 1):
+            raise ValueError("tile size must be a power of two, not {}".format(tile_size))
+        if not 0 <= min_zoom <= max_zoom:
+            raise ValueError("zoom levels must run from 0 or more up to max_zoom")
+        self.directory = directory
+        self.max_zoom = max_zoom
+        self.min_zoom = min_zoom
+        self.tile_size = tile_size
+        self.dedup = dedup
+        self.max_tiles = max_tiles
+        self.batch_size = batch_size
+        self.tiles = OrderedDict()  # (x, y) -> flat array of counts
+        self.pending = []
+        self.seen = OrderedDict()  # dedup period -> set of (mmsi, pixel)
+        self.position_count = 0
+        self.duplicate_count = 0
+        self.spill_count = 0
+
+    def add(self, sentence):
+        location = sentence.location()
+        if location:
+            mmsi = sentence['mmsi'] if self.dedup else None
+            self.pending.append((location[0], location[1], mmsi, sentence.time))
+            if len(self.pending) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        """Counts the pending positions into tiles."""
+        if not self.pending:
+            return
+        lons, lats, mmsis, times = zip(*self.pending)
+        self.pending = []
+        x, y = web_mercator_pixels(lons, lats, self.max_zoom, self.tile_size)
+        if self.dedup:
+            keep = self._first_sightings(mmsis, times, y * (self.tile_size << self.max_zoom) + x)
+            x, y = x[keep], y[keep]
+        self.position_count += len(x)
+
+        size = self.tile_size
+        tile_ids = (x // size) * (1 << self.max_zoom) + y // size
+        pixels = (y % size) * size + x % size
+        order = numpy.argsort(tile_ids, kind='stable')
+        tile_ids, pixels = tile_ids[order], pixels[order]
+        starts = numpy.concatenate([[0], numpy.flatnonzero(numpy.diff(tile_ids)) + 1, [len(tile_ids)]])
+        for start, end in zip(starts[:-1], starts[1:]):
+            if start < end:
+                tile_x, tile_y = divmod(int(tile_ids[start]), 1 << self.max_zoom)
+                self._tile(tile_x, tile_y)[:] += numpy.bincount(pixels[start:end], minlength=size * size)
+
+    def _first_sightings(self, mmsis, times, pixels):
+        keep = numpy.ones(len(pixels), dtype=bool)
+        for i, (mmsi, when, pixel) in enumerate(zip(mmsis, times, pixels.tolist())):
+            if when is None:
+                continue
+            period = int(when // self.dedup)
+            if period not in self.seen:
+                self.seen[period] = set()
+                for old in [p for p in self.seen if p < period - 1]:
+                    del self.seen[old]
+            seen = self.seen[period]
+            if (mmsi, pixel) in seen:
+                keep[i] = False
+                self.duplicate_count += 1
+            else:
+                seen.add((mmsi, pixel))
+        return keep
+
+    def _tile(self, x, y):
+        key = (x, y)
+        if key in self.tiles:
+            self.tiles.move_to_end(key)
+            return self.tiles[key]
+        while len(self.tiles) >= self.max_tiles:
+            self._spill(*self.tiles.popitem(last=False))
+        counts = self.tiles[key] = numpy.zeros(self.tile_size * self.tile_size, dtype=numpy.int64)
+        return counts
+
+    def path(self, zoom, x, y):
+        return os.path.join(self.directory, str(zoom), str(x), "{}.npy".format(y))
+
+    def _spill(self, key, counts):
+        path = self.path(self.max_zoom, *key)
+        counts = counts.reshape(self.tile_size, self.tile_size)
+        if os.path.exists(path):
+            counts = counts + numpy.load(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        numpy.save(path, counts)
+        self.spill_count += 1
+
+    def saved_tiles(self, zoom):
+        """The (x, y) of every tile saved at a zoom level."""
+        level = os.path.join(self.directory, str(zoom))
+        if not os.path.isdir(level):
+            return []
+        return sorted((int(x), int(name[:-4])) for x in os.listdir(level)
+                      for name in os.listdir(os.path.join(level, x)) if name.endswith('.npy'))
+
+    def finish(self):
+        self.flush()
+        while self.tiles:
+            self._spill(*self.tiles.popitem(last=False))
+        for zoom in range(self.max_zoom, self.min_zoom, -1):
+            self._downsample(zoom)
+
+    def _downsample(self, zoom):
+        """Builds the tiles at zoom - 1 from those at zoom, reading one parent's children at a time."""
+        size, half = self.tile_size, self.tile_size // 2
+        children = defaultdict(list)
+        for x, y in self.saved_tiles(zoom):
+            children[(x // 2, y // 2)].append((x, y))
+        for (parent_x, parent_y), tiles in children.items():
+            counts = numpy.zeros((size, size), dtype=numpy.int64)
+            for x, y in tiles:
+                child = numpy.load(self.path(zoom, x, y)).reshape(half, 2, half, 2).sum(axis=(1, 3))
+                counts[(y % 2) * half:(y % 2 + 1) * half, (x % 2) * half:(x % 2 + 1) * half] = child
+            path = self.path(zoom - 1, parent_x, parent_y)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            numpy.save(path, counts)
+
+
+@click.command()
+@click.argument('dest', type=click.Path(file_okay=False))
+@click.argument('sources', nargs=-1)
+@click.option('--zoom', '-z', 'max_zoom', type=click.IntRange(0, 24), default=10)
+@click.option('--min-zoom', type=click.IntRange(0, 24), default=0)
+@click.option('--tile-size', type=int, default=256)
+@click.option('--dedup', is_flag=True)
+@click.option('--period', type=float, default=3600, metavar='SECONDS')
+@click.option('--max-tiles', type=click.IntRange(1), default=256)
+@click.option('--append', is_flag=True)
+@click.option('--read-ahead', type=click.IntRange(1), metavar='BATCHES')
+@click.option('--verbose', is_flag=True)
+def heatmap(dest, sources, max_zoom, min_zoom, tile_size, dedup, period, max_tiles, append, read_ahead, verbose):
+    """ Counts positions into a pyramid of Web-Mercator map tiles saved as NumPy arrays. """
+    if os.path.isdir(dest) and os.listdir(dest) and not append:
+        raise click.UsageError("{} already has tiles in it; use --append to add to them".format(dest))
+    try:
+        pyramid = TilePyramid(dest, max_zoom, min_zoom, tile_size, period if dedup else None, max_tiles)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    for sentence in sentences_from_sources(sources, log_errors=verbose, read_ahead=read_ahead):
+        pyramid.add(sentence)
+    pyramid.finish()
+    if verbose:
+        print("{} positions counted, {} duplicates dropped, {} tiles at zoom {}".format(
+            pyramid.position_count, pyramid.duplicate_count, len(pyramid.saved_tiles(max_zoom)), max_zoom),
+            file=sys.stderr)
+
+
+@click.command()
+@click.argument('sources', nargs=-1)
+@click.option('--size', type=float, default=60, metavar='SECONDS')
+@click.option('--slide', type=float, metavar='SECONDS')
+@click.option('--lateness', type=float, default=0.0, metavar='SECONDS')
+@click.option('--field', '-f', 'fields', multiple=True)
+@click.option('--degree', 'fields', flag_value='geo-degree', multiple=True)
+@click.option('--tenth', 'fields', flag_value='geo-tenth', multiple=True)
+@click.option('--senders', is_flag=True)
+@click.option('--follow', is_flag=True)
+@click.option('--buffered/--unbuffered', default=None)
+@click.option('--read-ahead', type=click.IntRange(1), metavar='BATCHES')
+@click.option('--verbose', is_flag=True)
+def window(sources, size, slide, lateness, fields, senders, follow, buffered, read_ahead, verbose):
+    """ Counts sentences in windows of time, reporting each window as soon as it is over. """
+    factories = {'all': SentenceCount}
+    if fields:
+        factories['groups'] = lambda: CountBy(functools.partial(value_tuple_for, fields))
+    if senders:
+        factories['senders'] = DistinctSenders
+    try:
+        windows = Windows(lambda: Aggregators(factories), size, slide, lateness)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+    sentences = sentences_from_sources(sources, log_errors=verbose, read_ahead=read_ahead, follow=follow)
+    with wild_disregard_for(BrokenPipeError), LineOutput(buffered=buffered) as output:
+        # a followed feed may go quiet, so then the wall clock ends windows
+        for result in windows.windows(sentences, clock=time.time if follow else None):
+            start = time_to_text(result.start)
+            output.write("{}  all  {}".format(start, result.value['all']))
+            if senders:
+                output.write("{}  senders  {}".format(start, result.value['senders']))
+            groups = result.value.get('groups', {})
+            for key in sorted(groups, key=lambda k: groups[k], reverse=True):
+                output.write("{}  {}  {}".format(start, tuple_display(key), groups[key]))
+    if verbose:
+        print("{} sentences came too late for their windows".format(windows.late_count), file=sys.stderr)
 
 
 # used for profiling; call with something like "grep ../tests/sample.ais -t 20"
@@ -0,0 +1,241 @@
+"""
+Aggregates over windows of time, for counts per minute, per hour and the like, from live
+feeds and archives alike.
+
+Windows are size seconds long and start every slide seconds; when slide equals size they
+are tumbling windows, and when it is smaller they overlap. Each sentence is added to one
+pane, a stretch of the greatest common divisor of size and slide, and a window's result
+is its panes merged together, so a sentence costs the same however many windows it falls
+in. Times are handled as whole milliseconds, so window edges are exact.
+
+A window is finished once the watermark, the newest time seen less the allowed lateness,
+passes its end. Its result is given out then and its panes are dropped once no open window
+needs them, so memory depends on the window size and lateness, not the length of the input.
+A sentence older than every open window is too late and is only counted. On a live feed,
+a clock can move the watermark along while nothing arrives, so windows end on time.
+
+Aggregators are anything with add(sentence), merge(other) and result(); the window engine
+gets a fresh one from a factory for every pane and window.
+"""
+import math
+import queue
+import threading
+
+from simpleais.sketches import HyperLogLog
+
+MILLISECONDS = 1000
+
+
+class SentenceCount:
+    def __init__(self):
+        self.count = 0
+
+    def add(self, sentence):
+        self.count += 1
+
+    def merge(self, other):
+        self.count += other.count
+
+    def result(self):
+        return self.count
+
+
+class CountBy:
+    """Counts of sentences by key(sentence), leaving out those whose key is None."""
+
+    def __init__(self, key):
+        self.key = key
+        self.counts = {}
+
+    def add(self, sentence):
+        value = self.key(sentence)
+        if value is not None:
+            self.counts[value] = self.counts.get(value, 0) + 1
+
+    def merge(self, other):
+        for value, count in other.counts.items():
+            self.counts[value] = self.counts.get(value, 0) + count
+
+    def result(self):
+        return self.counts
+
+
+class DistinctSenders:
+    """An estimate of the number of different MMSIs, in fixed memory."""
+
+    def __init__(self, precision=12):
+        self.senders = HyperLogLog(precision)
+
+    def add(self, sentence):
+        mmsi = sentence['mmsi']
+        if mmsi is not None:
+            self.senders.add(mmsi)
+
+    def merge(self, other):
+        self.senders.merge(other.senders)
+
+    def result(self):
+        return self.senders.count()
+
+
+class Aggregators:
+    """Several aggregators under names, whose result is a dict of their results."""
+
+    def __init__(self, factories):
+        self.aggregators = {name: factory() for name, factory in factories.items()}
+
+    def add(self, sentence):
+        for aggregator in self.aggregators.values():
+            aggregator.add(sentence)
+
+    def merge(self, other):
+        for name, aggregator in self.aggregators.items():
+            aggregator.merge(other.aggregators[name])
+
+    def result(self):
+        return {name: aggregator.result() for name, aggregator in self.aggregators.items()}
+
+
+class WindowResult:
+    def __init__(self, start, end, value):
+        self.start = start
+        self.end = end
+        self.value = value
+
+    def __eq__(self, other):
+        return isinstance(other, WindowResult) and \
+               (self.start, self.end, self.value) == (other.start, other.end, other.value)
+
+    def __repr__(self):
+        return "WindowResult({}, {}, {!r})".format(self.start, self.end, self.value)
+
+
+class Windows:
+    """
+    Windows of size seconds starting every slide seconds (default: size) from origin, with
+    results from aggregators made by factory. Sentences without a time count as arriving
+    at the newest time seen so far.
+    """
+
+    def __init__(self, factory, size, slide=None, lateness=0.0, origin=0.0):
+        self.factory = factory
+        self.size = int(round(size * MILLISECONDS))
+        self.slide = int(round((slide or size) * MILLISECONDS))
+        if self.size <= 0 or self.slide <= 0:
+            raise ValueError("windows need a positive size and slide")
+        if self.slide > self.size:
+            raise ValueError("a slide longer than the window would leave gaps between windows")
+        self.pane = math.gcd(self.size, self.slide)
+        self.lateness = int(round(lateness * MILLISECONDS))
+        self.origin = int(round(origin * MILLISECONDS))
+        self.panes = {}  # pane number -> aggregator
+        self.newest = None  # milliseconds after origin
+        self.next_start = None  # start of the earliest window not yet finished
+        self.late_count = 0
+
+    def process(self, sentence):
+        """Adds a sentence, returning the results of any windows it finished, oldest first."""
+        if sentence.time is not None:
+            t = int(math.floor(sentence.time * MILLISECONDS)) - self.origin
+        elif self.newest is not None:
+            t = self.newest
+        else:
+            return []
+        if self.next_start is None:
+            self.next_start = self._first_start(t)
+        if t < self.next_start:
+            self.late_count += 1
+            return []
+        pane = t // self.pane
+        if pane not in self.panes:
+            self.panes[pane] = self.factory()
+        self.panes[pane].add(sentence)
+        if self.newest is None or t > self.newest:
+            self.newest = t
+            return self._finish_until(t - self.lateness)
+        return []
+
+    def advance(self, time):
+        """Moves the watermark up to a time, as a clock would on a quiet feed."""
+        t = int(math.floor(time * MILLISECONDS)) - self.origin
+        if self.newest is None or t > self.newest:
+            self.newest = t
+        return self._finish_until(t - self.lateness) if self.next_start is not None else []
+
+    def flush(self):
+        """Finishes every window that has anything in it, as at the end of the input."""
+        results = self._finish_until(None)
+        self.next_start = None
+        return results
+
+    def _first_start(self, t):
+        """The start of the earliest window that includes t."""
+        return ((t - self.size) // self.slide + 1) * self.slide
+
+    def _finish_until(self, watermark):
+        results = []
+        while self.panes and (watermark is None or self.next_start + self.size <= watermark):
+            first_pane = min(self.panes)
+            if first_pane * self.pane >= self.next_start + self.size:
+                # nothing in this window; skip ahead to the first with something in it or still open
+                skip_to = self._first_start(first_pane * self.pane)
+                if watermark is not None:
+                    skip_to = min(skip_to, self._first_start(watermark))
+                self.next_start = skip_to
+                continue
+            result = self.factory()
+            for pane in range(self.next_start // self.pane, (self.next_start + self.size) // self.pane):
+                if pane in self.panes:
+                    result.merge(self.panes[pane])
+            results.append(WindowResult((self.origin + self.next_start) / MILLISECONDS,
+                                        (self.origin + self.next_start + self.size) / MILLISECONDS,
+                                        result.result()))
+            self.next_start += self.slide
+            for pane in [p for p in self.panes if p < self.next_start // self.pane]:
+                del self.panes[pane]
+        if not self.panes and watermark is not None:
+            # the empty windows the watermark has passed are over too
+            self.next_start = max(self.next_start, self._first_start(watermark))
+        return results
+
+    def windows(self, sentences, clock=None, idle_interval=1.0):
+        """
+        Yields the results of windows over sentences as they finish, then the rest at the end.
+        With a clock, such as time.time, sentences are read on a separate thread, and whenever
+        none arrive for idle_interval seconds the watermark advances to the clock's time.
+        """
+        if clock is not None:
+            sentences = _with_idle_ticks(sentences, idle_interval)
+        for sentence in sentences:
+            if sentence is None:
+                yield from self.advance(clock())
+            else:
+                yield from self.process(sentence)
+        yield from self.flush()
+
+
+def _with_idle_ticks(items, interval, depth=1024):
+    """Yields items read on a separate thread, and None whenever interval seconds pass without one."""
+    handoff = queue.Queue(depth)
+
+    def read():
+        try:
+            for item in items:
+                handoff.put(('item', item))
+        except Exception as e:
+            handoff.put(('error', e))
+        handoff.put(('done', None))
+
+    threading.Thread(target=read, name="window-reader", daemon=True).start()
+    while True:
+        try:
+            kind, item = handoff.get(timeout=interval)
+        except queue.Empty:
+            yield None
+            continue
+        if kind == 'item':
+            yield item
+        elif kind == 'error':
+            raise item
+        else:
+            break
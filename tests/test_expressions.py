@@ -0,0 +1,86 @@
+import os
+import re
+from unittest import TestCase
+
+import numpy
+
+from simpleais import sentences_from_source, parse
+from simpleais.expressions import KNOWN_FIELDS, Expression, _getter
+
+
+def columns_for(sentences, fields):
+    """Columns of the given fields, numeric ones as floats with NaN for missing values."""
+    result = {}
+    for name in fields:
+        column = [_getter(name)(s) for s in sentences]
+        if all(v is None or (isinstance(v, (int, float)) and not isinstance(v, bool)) for v in column):
+            result[name] = numpy.array([numpy.nan if v is None else v for v in column], dtype=float)
+        else:
+            result[name] = numpy.empty(len(column), dtype=object)
+            result[name][:] = column
+    return result
+
+
+class TestExpressions(TestCase):
+    sentences = list(sentences_from_source(os.path.join(os.path.dirname(__file__), 'sample.ais')))
+    type_1 = parse("!AIVDM,1,1,,A,15Mw0GP01SG?W>PE`laU<TJj0L20,0*67")
+    type_5 = parse(["!WSVDM,2,1,0,A,5=JklSl00003UHDs:20l4E9<f04i@4U:22222217,0*4C",
+                    "!WSVDM,2,2,0,A,05B0dl0HtS000000000000000000008,2*00"])[0]
+
+    def check(self, text, expected):
+        expression = Expression(text)
+        matches = [s for s in self.sentences if expression.matches(s)]
+        self.assertEqual(expected, len(matches))
+        fields = {word for word in re.findall(r"[a-z_]+", text) if word in KNOWN_FIELDS}
+        mask = expression.mask(columns_for(self.sentences, fields))
+        self.assertEqual([expression.matches(s) for s in self.sentences], list(mask))
+
+    def test_comparisons(self):
+        self.check("type in (1, 2, 3) and speed > 20", 929)
+        self.check("20 < speed and type <= 3", 929)
+        self.check("type = 18 and speed >= 20", 7)
+        self.check("type != 1", 2635)
+
+    def test_between(self):
+        self.check("lat between 32 and 34", 7683)
+        self.check("not lat between 32 and 34", 1788)
+
+    def test_presence_and_text(self):
+        self.check("shiptype", 666)
+        self.check("shiptype = 'Tug'", 48)
+        self.check("shiptype in (52, 'Pilot Vessel')", 63)
+
+    def test_mmsi_as_number_or_text(self):
+        self.check("mmsi = 367192970", 413)
+        self.check("mmsi = '367192970'", 413)
+
+    def test_precedence(self):
+        self.check("type = 5 or type = 1 and speed > 20", 1254)
+        self.check("(type = 5 or type = 1) and speed > 20", 915)
+
+    def test_missing_values_never_match(self):
+        self.assertFalse(Expression("shiptype != 'Tug'").matches(self.type_1))
+        self.assertFalse(Expression("speed < 1000").matches(self.type_5))
+        self.assertTrue(Expression("not speed").matches(self.type_5))
+
+    def test_structured_arrays(self):
+        records = numpy.array([(1, 12.5, 33.0), (5, numpy.nan, numpy.nan), (18, 2.0, 51.0)],
+                              dtype=[('type', 'u1'), ('speed', 'f4'), ('lat', 'f8')])
+        self.assertEqual([True, False, False], list(Expression("speed > 10").mask(records)))
+        self.assertEqual([False, True, True], list(Expression("not lat between 30 and 40").mask(records)))
+        self.assertEqual([True, False, True], list(Expression("type in (1, 18) and speed").mask(records)))
+
+    def test_errors(self):
+        for text in ["type in", "sped > 2", "type >", "(type = 1", "type = 1 1", "type ~ 1", "type not 1"]:
+            self.assertRaises(ValueError, Expression, text)
+
+    def test_mixed_types(self):
+        for text in ["speed between 1 and '5'", "shiptype between 'A' and 5", "speed > '5'", "'5' < speed",
+                     "type in (1, 'two')"]:
+            self.assertRaises(ValueError, Expression, text)
+
+    def test_survives_pickling(self):
+        import pickle
+        expression = pickle.loads(pickle.dumps(Expression("type = 5")))
+        self.assertTrue(expression.matches(self.type_5))
+        self.assertFalse(expression.matches(self.type_1))
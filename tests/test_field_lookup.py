@@ -153,6 +153,8 @@ class TestEnumLookup(TestCase):
         self.assertEqual(101, decoded_101.key)
         self.assertEqual("enum-unknown-101", decoded_101.value)
         self.assertEqual("enum-unknown-101", str(decoded_101))
+        self.assertIs(decoded_101, enum_decoder(self.fake_payload(101)))
+        self.assertNotIn(101, ENUM_LOOKUPS['shiptype'])
 
     def test_navigation_status(self):
         enum_decoder = self.decoder_for_enum(1, 'status')
@@ -0,0 +1,114 @@
+from unittest import TestCase
+
+import numpy
+
+from simpleais.geo import *
+
+fort_point = (-122.4775, 37.8108)
+fort_mason = (-122.4321, 37.8065)
+
+
+class TestDistances(TestCase):
+    def test_single_pair(self):
+        self.assertAlmostEqual(4.02, distance(fort_point, fort_mason), 2)
+        self.assertAlmostEqual(111.23, distance((0, 0), (1, 0)), 2)
+
+    def test_arrays_agree_with_single_pairs(self):
+        lons = numpy.array([fort_mason[0], 0, 179.5, numpy.nan])
+        lats = numpy.array([fort_mason[1], 0, -10, 0])
+        result = distances(fort_point[0], fort_point[1], lons, lats)
+        for i in range(3):
+            self.assertAlmostEqual(distance(fort_point, (lons[i], lats[i])), result[i], 6)
+        self.assertTrue(numpy.isnan(result[3]))
+
+    def test_bearings(self):
+        self.assertAlmostEqual(0, bearing((0, 0), (0, 1)))
+        self.assertAlmostEqual(90, bearing((0, 0), (1, 0)))
+        self.assertAlmostEqual(270, bearing((0, 0), (-1, 0)))
+        numpy.testing.assert_allclose([0, 90, 180, 270], bearings(0, 0, [0, 1, 0, -1], [1, 0, -1, 0]), atol=1e-9)
+
+    def test_web_mercator_pixels(self):
+        x, y = web_mercator_pixels([0, -180, 180, -122.4775], [0, 90, -90, 37.8108], 0)
+        self.assertEqual([128, 0, 255, 40], list(x))
+        self.assertEqual([128, 0, 255, 98], list(y))
+        x, y = web_mercator_pixels([-122.4775], [37.8108], 12)
+        self.assertEqual((654, 1582), (x[0] // 256, y[0] // 256))
+
+
+class TestCircle(TestCase):
+    def test_contains(self):
+        circle = Circle(fort_point[0], fort_point[1], 5)
+        self.assertTrue(circle.contains(fort_mason))
+        self.assertFalse(Circle(fort_point[0], fort_point[1], 3).contains(fort_mason))
+        self.assertFalse(circle.contains(None))
+
+    def test_across_the_dateline(self):
+        circle = Circle(179.9, 0, 50)
+        self.assertTrue(circle.contains((-179.9, 0.1)))
+        self.assertFalse(circle.contains((179, 0)))
+
+    def test_around_a_pole(self):
+        circle = Circle(0, 89.9, 50)
+        self.assertTrue(circle.contains((120, 89.95)))
+        self.assertTrue(circle.contains((180, 89.9)))
+
+    def test_mask_agrees_with_contains(self):
+        circle = Circle(-118.25, 33.73, 5)
+        lons = numpy.linspace(-118.4, -118.1, 31)
+        lats = numpy.linspace(33.6, 33.9, 31)
+        expected = [circle.contains((lon, lat)) for lon, lat in zip(lons, lats)]
+        self.assertEqual(expected, list(circle.mask(lons, lats)))
+        self.assertIn(True, expected)
+        self.assertIn(False, expected)
+
+
+class TestPolygon(TestCase):
+    square = [[0, 0], [4, 0], [4, 4], [0, 4], [0, 0]]
+    hole = [[1, 1], [3, 1], [3, 3], [1, 3], [1, 1]]
+    triangle = [[10, 10], [12, 10], [11, 12], [10, 10]]
+
+    def test_contains(self):
+        polygon = Polygon([self.square, self.hole], name="frame")
+        self.assertTrue(polygon.contains((0.5, 0.5)))
+        self.assertTrue(polygon.contains((3.5, 2)))
+        self.assertFalse(polygon.contains((2, 2)))
+        self.assertFalse(polygon.contains((5, 2)))
+        self.assertFalse(polygon.contains(None))
+
+    def test_grid_agrees_with_exact_test(self):
+        angles = numpy.linspace(0, 2 * numpy.pi, 200, endpoint=False)
+        radii = 1 + 0.5 * numpy.sin(7 * angles)
+        star = numpy.c_[10 + radii * numpy.cos(angles), 50 + radii * numpy.sin(angles)]
+        polygon = Polygon([star], resolution=16)
+        self.assertIn(INSIDE, polygon.cells)
+        self.assertIn(OUTSIDE, polygon.cells)
+        random = numpy.random.RandomState(1)
+        lons = random.uniform(8, 12, 5000)
+        lats = random.uniform(48, 52, 5000)
+        exact = polygon._exact(lons, lats)
+        self.assertEqual(list(exact), list(polygon.mask(lons, lats)))
+        self.assertEqual(list(exact), [polygon.contains(p) for p in zip(lons, lats)])
+
+    def test_index(self):
+        index = PolygonIndex([Polygon([self.square], "square"), Polygon([self.triangle], "triangle")], cell_size=3)
+        self.assertEqual(["square"], [p.name for p in index.containing((2, 2))])
+        self.assertEqual(["triangle"], [p.name for p in index.containing((11, 11))])
+        self.assertFalse(index.contains((8, 8)))
+        lons = numpy.array([2, 11, 8, numpy.nan])
+        lats = numpy.array([2, 11, 8, numpy.nan])
+        self.assertEqual([True, True, False, False], list(index.mask(lons, lats)))
+
+    def test_geojson(self):
+        collection = {"type": "FeatureCollection", "features": [
+            {"type": "Feature", "properties": {"name": "frame"},
+             "geometry": {"type": "Polygon", "coordinates": [self.square, self.hole]}},
+            {"type": "Feature", "properties": {},
+             "geometry": {"type": "MultiPolygon", "coordinates": [[self.triangle], [self.hole]]}},
+            {"type": "Feature", "properties": {"name": "a point"},
+             "geometry": {"type": "Point", "coordinates": [1, 1]}},
+        ]}
+        polygons = polygons_from_geojson(collection)
+        self.assertEqual(["frame", "1"], [p.name for p in polygons])
+        self.assertFalse(polygons[0].contains((2, 2)))
+        self.assertTrue(polygons[1].contains((2, 2)))
+        self.assertTrue(polygons[1].contains((11, 11)))
@@ -0,0 +1,104 @@
+import random
+from collections import Counter
+from unittest import TestCase
+
+import numpy
+
+from simpleais.sketches import *
+
+
+def zipf_values(count, seed=1):
+    r = random.Random(seed)
+    return [int(r.paretovariate(1.1)) for ignored in range(count)]
+
+
+class TestHyperLogLog(TestCase):
+    def test_counts(self):
+        for n in (0, 10, 1000, 100000):
+            sketch = HyperLogLog()
+            for i in range(n):
+                sketch.add(i)
+                sketch.add(i)
+            self.assertAlmostEqual(n, sketch.count(), delta=3 * sketch.relative_error() * n)
+
+    def test_merge(self):
+        first, second = HyperLogLog(10), HyperLogLog(10)
+        for i in range(5000):
+            first.add(i)
+            second.add(i + 2500)
+        first.merge(second)
+        self.assertAlmostEqual(7500, first.count(), delta=3 * first.relative_error() * 7500)
+        self.assertRaises(ValueError, first.merge, HyperLogLog(12))
+
+
+class TestCountMinSketch(TestCase):
+    def test_never_too_low(self):
+        values = zipf_values(20000)
+        sketch = CountMinSketch(width=64)
+        for value in values:
+            sketch.add(value)
+        self.assertEqual(20000, sketch.total)
+        for value, count in Counter(values).items():
+            self.assertLessEqual(count, sketch.estimate(value))
+
+
+class TestApproximateCounts(TestCase):
+    def test_most_common(self):
+        values = zipf_values(50000)
+        counts = ApproximateCounts(5)
+        for value in values:
+            counts.add(value)
+        self.assertEqual(Counter(values).most_common(5), counts.most_common())
+        self.assertAlmostEqual(len(set(values)), counts.distinct.count(), delta=5)
+
+    def test_merge_matches_a_single_pass(self):
+        values = zipf_values(50000, seed=2)
+        whole, first, second = ApproximateCounts(10), ApproximateCounts(10), ApproximateCounts(10)
+        for i, value in enumerate(values):
+            whole.add(value)
+            (first if i < 20000 else second).add(value)
+        first.merge(second)
+        self.assertEqual(whole.most_common(), first.most_common())
+        self.assertEqual(whole.distinct.count(), first.distinct.count())
+        self.assertEqual(50000, first.total())
+
+
+class TestQuantiles(TestCase):
+    values = numpy.random.RandomState(0).lognormal(1, 1, 200000)
+
+    def check(self, sketch, values, tolerance=0.01):
+        ordered = numpy.sort(values)
+        fractions = [0.01, 0.25, 0.5, 0.75, 0.99]
+        for fraction, estimate in zip(fractions, sketch.quantiles(fractions)):
+            self.assertAlmostEqual(fraction, numpy.searchsorted(ordered, estimate) / len(values), delta=tolerance)
+
+    def test_batches(self):
+        sketch = QuantileSketch()
+        for start in range(0, len(self.values), 1000):
+            sketch.add_many(self.values[start:start + 1000])
+        self.assertEqual(len(self.values), sketch.count)
+        self.assertLess(sketch.size(), 1000)
+        self.check(sketch, self.values)
+
+    def test_one_at_a_time_and_merged(self):
+        first, second = QuantileSketch(), QuantileSketch(seed=1)
+        for value in self.values[:5000]:
+            first.add(value)
+        second.add_many(self.values[5000:20000])
+        first.merge(second)
+        self.assertEqual(20000, first.count)
+        self.check(first, self.values[:20000])
+
+    def test_summary(self):
+        summary = NumericSummary(histogram=(0, 10, 5))
+        summary.add_many([1, 2, numpy.nan, 3, 10, 12, -1])
+        other = NumericSummary(histogram=(0, 10, 5))
+        other.add_many([4.5])
+        summary.merge(other)
+        self.assertEqual(7, summary.count)
+        self.assertEqual(-1, summary.min)
+        self.assertEqual(12, summary.max)
+        self.assertAlmostEqual(31.5 / 7, summary.mean())
+        self.assertEqual([-1, 3, 12], summary.quantiles([0, 0.5, 1]))
+        self.assertEqual([1, 2, 1, 0, 1], [count for low, high, count in summary.histogram.bins()])
+        self.assertEqual((1, 1), (summary.histogram.below, summary.histogram.above))
@@ -1,4 +1,10 @@
+import bz2
+import lzma
+import shutil
+import subprocess
+import sys
 import tempfile
+import threading
 from gzip import GzipFile
 from unittest import TestCase
 
@@ -56,6 +62,69 @@ class TestSourceHandling(TestCase):
 
             logs.check(('root', 'WARNING', 'skipped: "garbage data"'))
 
+    def test_other_compressed_sources(self):
+        for suffix, opener in [('.bz2', bz2.open), ('.xz', lzma.open)]:
+            with tempfile.TemporaryDirectory() as directory:
+                path = self.write_compressed_sample_data(directory, suffix, opener)
+                self.assertTrue(is_compressed(path))
+                sentences = list(sentences_from_source(path))
+                self.assertEqual([8, 1], [s.type_id() for s in sentences])
+
+    def test_external_decompressor(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = self.write_compressed_sample_data(directory, '.xz', lzma.open)
+            commands = EXTERNAL_DECOMPRESSORS.copy()
+            try:
+                EXTERNAL_DECOMPRESSORS['.xz'] = [['no-such-decompressor', '-dc']]
+                self.assertEqual(5, len(list(lines_from_source(path))))
+                if shutil.which('xz'):
+                    EXTERNAL_DECOMPRESSORS['.xz'] = [['no-such-decompressor', '-dc'], ['xz', '-dc']]
+                    self.assertEqual(5, len(list(lines_from_source(path))))
+            finally:
+                EXTERNAL_DECOMPRESSORS.clear()
+                EXTERNAL_DECOMPRESSORS.update(commands)
+
+    def test_external_decompressor_takes_any_file_name(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.write_compressed_sample_data(directory, '.xz', lzma.open)
+            os.rename(os.path.join(directory, 'sample.xz'), os.path.join(directory, '-sample.xz'))
+            commands = EXTERNAL_DECOMPRESSORS.copy()
+            cwd = os.getcwd()
+            try:
+                os.chdir(directory)
+                EXTERNAL_DECOMPRESSORS['.xz'] = [[sys.executable, '-c', 'import sys; print(sys.argv[1:])']]
+                self.assertEqual(["['--', '-sample.xz']\n"], list(lines_from_source('-sample.xz')))
+            finally:
+                os.chdir(cwd)
+                EXTERNAL_DECOMPRESSORS.clear()
+                EXTERNAL_DECOMPRESSORS.update(commands)
+
+    def test_external_decompressor_failure(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = self.write_compressed_sample_data(directory, '.xz', lzma.open)
+            commands = EXTERNAL_DECOMPRESSORS.copy()
+            try:
+                EXTERNAL_DECOMPRESSORS['.xz'] = [[sys.executable, '-c', 'print("partial"); raise SystemExit(3)']]
+                lines = lines_from_source(path)
+                self.assertEqual("partial\n", next(lines))
+                with self.assertRaises(subprocess.CalledProcessError) as failure:
+                    next(lines)
+                self.assertEqual(3, failure.exception.returncode)
+            finally:
+                EXTERNAL_DECOMPRESSORS.clear()
+                EXTERNAL_DECOMPRESSORS.update(commands)
+
+    def test_zstd_source(self):
+        if not shutil.which('zstd'):
+            self.skipTest("zstd is not installed")
+        with tempfile.TemporaryDirectory() as directory:
+            plain = os.path.join(directory, 'sample.txt')
+            with open(plain, 'wb') as file:
+                self.write_sample_data(file)
+            subprocess.check_call(['zstd', '-q', plain, '-o', plain + '.zst'])
+            sentences = list(sentences_from_source(plain + '.zst'))
+            self.assertEqual([8, 1], [s.type_id() for s in sentences])
+
     def test_io_source_by_sentence(self):
         with LogCapture() as logs:
             with tempfile.NamedTemporaryFile() as file:
@@ -67,8 +136,122 @@ class TestSourceHandling(TestCase):
                     self.assertRaises(StopIteration, sentences.__next__)
             logs.check(('root', 'WARNING', 'skipped: "garbage data"'))
 
+    def test_read_ahead_by_sentence(self):
+        with tempfile.NamedTemporaryFile(suffix='.gz', delete=False) as file:
+            self.write_sample_data(file, compress=True)
+            file.close()
+
+            sentences = list(sentences_from_source(file.name, read_ahead=2))
+            self.assertEqual([8, 1], [s.type_id() for s in sentences])
+            os.unlink(file.name)
+
+    def test_read_ahead_stats(self):
+        reader = ReadAhead(iter(["line {}".format(i) for i in range(25)]), depth=2, batch_size=10)
+        self.assertEqual(25, len(list(lines_from_source(reader))))
+        stats = reader.stats()
+        self.assertEqual(25, stats['lines'])
+        self.assertEqual(0, stats['depth'])
+        self.assertLessEqual(stats['max_depth'], 2)
+
+    def test_read_ahead_hands_over_lines_as_they_arrive(self):
+        more = threading.Event()
+
+        def live_lines():
+            yield "first"
+            more.wait(5)
+            yield "second"
+
+        lines = iter(ReadAhead(live_lines(), depth=2, batch_size=1000))
+        self.assertEqual("first", next(lines))
+        more.set()
+        self.assertEqual(["second"], list(lines))
+
+    def test_read_ahead_passes_along_errors(self):
+        def failing_lines():
+            yield "one"
+            raise IOError("disk on fire")
+
+        reader = ReadAhead(failing_lines())
+        with self.assertRaises(IOError):
+            list(reader)
+
+    def test_read_ahead_stops_reader_when_abandoned(self):
+        reader = ReadAhead(iter(["line"] * 100000), depth=1, batch_size=10)
+        lines = iter(reader)
+        next(lines)
+        lines.close()
+        reader.thread.join(1)
+        self.assertFalse(reader.thread.is_alive())
+
+    def test_byte_ranges_cover_file(self):
+        with tempfile.NamedTemporaryFile() as file:
+            self.write_sample_data(file)
+            size = os.path.getsize(file.name)
+            whole = [s.text for s in sentences_from_source(file.name)]
+            for cut in range(0, size + 1, 7):
+                pieces = list(sentences_from_byte_range(file.name, 0, cut)) + \
+                         list(sentences_from_byte_range(file.name, cut, size))
+                self.assertEqual(whole, [s.text for s in pieces], "cut at {}".format(cut))
+
+    def test_follow_growth_truncation_and_rotation(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'live.ais')
+            with open(path, 'w') as f:
+                f.write("one\n")
+            lines = follow_file(path, poll_interval=0.001, max_poll_interval=0.01)
+            self.assertEqual("one\n", next(lines))
+
+            with open(path, 'a') as f:
+                f.write("tw")
+                f.flush()
+                f.write("o\n")
+            self.assertEqual("two\n", next(lines))
+
+            with open(path, 'w') as f:
+                f.write("new\n")
+            self.assertEqual("new\n", next(lines))
+
+            with open(path, 'a') as f:
+                os.rename(path, path + '.1')
+                f.write("last\n")
+            with open(path, 'w') as f:
+                f.write("rotated\n")
+            self.assertEqual("last\n", next(lines))
+            self.assertEqual("rotated\n", next(lines))
+
+    def test_follow_survives_bad_bytes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'live.ais')
+            with open(path, 'wb') as f:
+                f.write(b"bad \xff byte\ngood\n")
+            lines = follow_file(path, poll_interval=0.001, max_poll_interval=0.01)
+            self.assertEqual("bad \ufffd byte\n", next(lines))
+            self.assertEqual("good\n", next(lines))
+
+    def test_follow_keeps_fragments_across_rotation(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'live.ais')
+            with open(path, 'w') as f:
+                f.write(fragmented_message_type_8[0] + "\n")
+                f.write(fragmented_message_type_8[1] + "\n")
+            lines = follow_file(path, poll_interval=0.001, max_poll_interval=0.01)
+            parser = StreamParser()
+            parser.add(next(lines))
+            parser.add(next(lines))
+            os.rename(path, path + '.1')
+            with open(path, 'w') as f:
+                f.write(fragmented_message_type_8[2] + "\n")
+            parser.add(next(lines))
+            self.assertEqual(8, parser.next_sentence().type_id())
+
     # TODO: figure out how to test serial and url sources effectively
 
+    def write_compressed_sample_data(self, directory, suffix, opener):
+        path = os.path.join(directory, 'sample' + suffix)
+        with opener(path, 'wb') as file:
+            self.write_sample_data(file)
+        return path
+
     def write_sample_data(self, file, compress=False):
         if compress:
             file = GzipFile(mode='w', fileobj=file)
@@ -80,3 +263,112 @@ class TestSourceHandling(TestCase):
         file.write(bytes(message_type_1, "ascii"))
         file.write(newline)
         file.flush()
+
+
+class TestDeduplication(TestCase):
+    def test_repeats_from_other_receivers_are_dropped(self):
+        sentences = parse(["1452468552.981 !ABVDM,1,1,,B,15N2Wl?P02oRV=nCBrNn3gvJ2@7T,0*12",
+                           "1452468552.992 !AIVDM,1,1,,A,15N2Wl?P02oRV=nCBrNn3gvJ2@7T,0*1A",
+                           "1452468553.005 !ABVDM,1,1,,B,403OthQv0EGM<oV9DFC5hdg020S:,0*6A"])
+        deduplicator = Deduplicator(window=1)
+        unique = list(deduplicate(sentences, deduplicator=deduplicator))
+        self.assertEqual([sentences[0], sentences[2]], unique)
+        self.assertEqual(3, deduplicator.seen_count)
+        self.assertEqual(1, deduplicator.duplicate_count)
+
+    def test_repeats_outside_window_are_kept(self):
+        sentences = parse(["100.0 !ABVDM,1,1,,B,15N2Wl?P02oRV=nCBrNn3gvJ2@7T,0*12",
+                           "105.0 !AIVDM,1,1,,A,15N2Wl?P02oRV=nCBrNn3gvJ2@7T,0*1A",
+                           "125.0 !AIVDM,1,1,,A,15N2Wl?P02oRV=nCBrNn3gvJ2@7T,0*1A"])
+        self.assertEqual([sentences[0], sentences[2]], list(deduplicate(sentences, window=10)))
+
+    def test_memory_is_bounded(self):
+        deduplicator = Deduplicator(window=10)
+        for t in range(100):
+            deduplicator.is_duplicate(parse("{} !ABVDM,1,1,,B,15N2Wl?P02oRV=nCBrNn3gvJ2@7T,0*12".format(t)))
+            deduplicator.is_duplicate(parse("{} !ABVDM,1,1,,B,403OthQv0EGM<oV9DFC5hdg020S:,0*6A".format(t)))
+        self.assertLessEqual(len(deduplicator.current) + len(deduplicator.previous), 4)
+
+
+def _at(*times):
+    return parse(["{} !ABVDM,1,1,,B,15N2Wl?P02oRV=nCBrNn3gvJ2@7T,0*12".format(t) for t in times])
+
+
+class TestTimeOrdering(TestCase):
+    def test_merge(self):
+        merged = merge_by_time([_at(1, 4, 5), _at(2, 3, 6), _at()])
+        self.assertEqual([1, 2, 3, 4, 5, 6], [s.time for s in merged])
+
+    def test_ties_keep_stream_order(self):
+        first, second = _at(1, 2), _at(1, 2)
+        merged = list(merge_by_time([first, second]))
+        self.assertEqual([first[0], second[0], first[1], second[1]], merged)
+
+    def test_lateness(self):
+        self.assertEqual([1, 3, 2, 4], [s.time for s in reorder_by_time(_at(1, 3, 2, 4))])
+        self.assertEqual([1, 2, 3, 4], [s.time for s in reorder_by_time(_at(1, 3, 2, 4), lateness=1)])
+        self.assertEqual([1, 2, 3, 4, 5, 6],
+                         [s.time for s in merge_by_time([_at(1, 4, 3), _at(2, 6, 5)], lateness=1.5)])
+
+    def test_untimed_sentences_stay_put(self):
+        untimed = parse("!ABVDM,1,1,,B,15N2Wl?P02oRV=nCBrNn3gvJ2@7T,0*12")
+        merged = list(merge_by_time([_at(1) + [untimed] + _at(3), _at(2)]))
+        self.assertEqual([1, None, 2, 3], [s.time for s in merged])
+
+
+class TestSampling(TestCase):
+    sample = os.path.join(os.path.dirname(__file__), 'sample.ais')
+    everything = list(sentences_from_source(sample))
+
+    def sampled(self, sampler, source=None):
+        return list(sampler.select(sampler.sentences(source or self.sample)))
+
+    def test_lines_keep_fragments_together(self):
+        sampler = Sampler('lines', 3)
+        sentences = self.sampled(sampler)
+        self.assertEqual(3, round(sampler.scale()))
+        self.assertAlmostEqual(len(self.everything) / 3, len(sentences), delta=5)
+        type_5_count = len([s for s in self.everything if s.type_id() == 5])
+        self.assertAlmostEqual(type_5_count / 3, len([s for s in sentences if s.type_id() == 5]), delta=2)
+        self.assertEqual([s.text for s in sentences], [s.text for s in self.sampled(Sampler('lines', 3))])
+
+    def test_lines_counts_truncated_lines(self):
+        sampler = Sampler('lines', 1)
+        lines = ["!AIVDM", "!AIVDM,2,1,3,B,x,0*00", "!AIVDM,2,2,3,B,y,0*00", "!AIV"]
+        self.assertEqual(lines, list(sampler._sample_lines(lines)))
+        self.assertEqual(3, sampler.seen)
+
+    def test_blocks(self):
+        sampler = Sampler('blocks', 0.25, block_size=40000)
+        sentences = self.sampled(sampler)
+        self.assertEqual(sampler.seen / sampler.kept, sampler.scale())
+        self.assertAlmostEqual(len(self.everything), len(sentences) * sampler.scale(), delta=len(self.everything) / 4)
+        texts = [s.text for s in self.everything]
+        self.assertTrue(all(s.text in texts for s in sentences))
+
+        with open(self.sample) as stream:
+            sampler = Sampler('blocks', 0.25, lines_per_block=100)
+            sentences = self.sampled(sampler, stream)
+        self.assertEqual(4, sampler.scale())
+        self.assertAlmostEqual(len(self.everything) / 4, len(sentences), delta=150)
+
+    def test_vessels_keep_whole_tracks(self):
+        sentences = self.sampled(Sampler('vessels', 0.1))
+        senders = {s['mmsi'] for s in sentences}
+        self.assertEqual([s.text for s in self.everything if s['mmsi'] in senders], [s.text for s in sentences])
+        self.assertAlmostEqual(36, len(senders), delta=15)
+
+    def test_reservoir(self):
+        sampler = Sampler('reservoir', 100)
+        sentences = self.sampled(sampler)
+        self.assertEqual(100, len(sentences))
+        self.assertEqual(len(self.everything) / 100, sampler.scale())
+        texts = [s.text for s in self.everything]
+        positions = [texts.index(s.text) for s in sentences]
+        self.assertEqual(sorted(positions), positions)
+        self.assertGreater(positions[-1] - positions[0], len(self.everything) / 2)
+
+    def test_from_text(self):
+        self.assertEqual(('lines', 100), (Sampler.from_text("lines:100").kind, Sampler.from_text("lines:100").amount))
+        for text in ["lines", "lines:0", "lines:1.5", "blocks:2", "vessels:0", "sometimes:3"]:
+            self.assertRaises(ValueError, Sampler.from_text, text)
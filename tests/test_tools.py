@@ -1,5 +1,10 @@
+import socket
+import time
 from unittest import TestCase
 
+import numpy
+from testfixtures import LogCapture
+
 from simpleais import parse
 from simpleais.tools import *
 
@@ -217,6 +222,51 @@ class TestDensityMap(TestCase):
             '+----+',
         ], m.to_text())
 
+    def test_many_points_go_to_a_fixed_grid(self):
+        random = numpy.random.RandomState(3)
+        points = [tuple(p) for p in numpy.c_[random.normal(-122, 0.3, 50000), random.normal(37.8, 0.2, 50000)]]
+        exact = DensityMap(20, batch_size=len(points) + 1)
+        gridded = DensityMap(20, batch_size=1000)
+        for point in points:
+            exact.add(point)
+            gridded.add(point)
+
+        self.assertLess(len(gridded.pending), 1000)
+        self.assertEqual(0, len(exact.keys))
+        expected = numpy.array(exact.to_counts())
+        counts = numpy.array(gridded.to_counts())
+        self.assertEqual(expected.shape, counts.shape)
+        self.assertEqual(len(points), counts.sum())
+        # cells straddling a bucket edge land on one side of it
+        self.assertLess(abs(expected - counts).sum() / 2, 0.001 * len(points))
+
+    def test_merged_shards_match_one_map(self):
+        random = numpy.random.RandomState(5)
+        points = [tuple(p) for p in numpy.c_[random.normal(-118, 2, 20000), random.normal(34, 1, 20000)]]
+        serial = DensityMap(40, resolution=64, batch_size=1000)
+        shards = [DensityMap(40, resolution=64, batch_size=size) for size in (700, 1000, 3000, 9000)]
+        for i, point in enumerate(points):
+            serial.add(point)
+            shards[i * len(shards) // len(points)].add(point)
+        merged = shards[0]
+        for shard in shards[1:]:
+            merged.merge(shard)
+
+        self.assertLess(serial.level, DensityMap.finest_level)
+        self.assertEqual(serial.to_counts(), merged.to_counts())
+        self.assertEqual(serial.level, merged.level)
+        self.assertEqual(serial.to_text(), merged.to_text())
+
+    def test_cells_coarsen_to_fit(self):
+        m = DensityMap(3, height_scale=1, resolution=2, batch_size=2)
+        for point in [(0, 0), (1, 1), (-10, 0.5), (1, -10), (-10, -10)]:
+            m.add(point)
+        m.flush()
+        m._compact()
+        self.assertLessEqual(len(m.keys), 4)
+        self.assertEqual(5, m.counts.sum())
+        self.assertEqual(5, sum(sum(row) for row in m.to_counts()))
+
 
 class TestBucketer(TestCase):
     def test_basics(self):
@@ -347,6 +397,56 @@ class TestTaster(TestCase):
         self.assertFalse(taster.likes(self.type_1_la))
         self.assertTrue(taster.likes(self.type_1_sf))
 
+    def test_or_mode(self):
+        taster = Taster(sentence_type=[5], lat=(32, 35), mode='or')
+        self.assertTrue(taster.likes(self.type_1_la))
+        self.assertFalse(taster.likes(self.type_1_sf))
+        self.assertTrue(taster.likes(self.type_5))
+        self.assertFalse(Taster(mode='or').likes(self.type_5))
+        self.assertTrue(Taster().likes(self.type_5))
+
+    def test_cheap_checks_settle_it_first(self):
+        class Untouchable:
+            time = None
+
+            def type_id(self):
+                return 5
+
+            def location(self):
+                raise AssertionError("location should not be needed")
+
+            def __getitem__(self, key):
+                raise AssertionError("fields should not be needed")
+
+        sentence = Untouchable()
+        taster = Taster(mmsi={'366985310'}, sentence_type=[1], lat=(32, 35), field=['shiptype'])
+        self.assertFalse(taster.likes(sentence))
+        self.assertTrue(Taster(mmsi={'366985310'}, sentence_type=[5], lat=(32, 35), mode='or').likes(sentence))
+
+    def test_sentences_without_time_fail_time_criteria(self):
+        self.assertFalse(Taster(before=1460000000).likes(self.type_1_sf))
+        self.assertFalse(Taster(after=1460000000).likes(self.type_1_sf))
+
+    def test_radius_filtering(self):
+        from simpleais.geo import Circle
+        taster = Taster(near=Circle(-119.5, 32.6, 100))  # LA
+        self.assertTrue(taster.likes(self.type_1_la))
+        self.assertFalse(taster.likes(self.type_1_sf))
+        self.assertFalse(taster.likes(self.type_5))
+
+    def test_liking_in_batches(self):
+        from simpleais.geo import Circle
+        sentences = [self.type_1_la, self.type_1_sf, self.type_5, self.type_17]
+        for taster in [Taster(near=Circle(-119.5, 32.6, 100)), Taster(near=Circle(-119.5, 32.6, 100), mode='or'),
+                       Taster(sentence_type=[1], near=Circle(-122.4, 37.8, 50))]:
+            self.assertEqual([s for s in sentences if taster.likes(s)], taster.likes_many(sentences))
+
+    def test_survives_pickling(self):
+        import pickle
+        taster = pickle.loads(pickle.dumps(Taster(lat=(32, 35), mode='or', invert_match=True)))
+        self.assertFalse(taster.likes(self.type_1_la))
+        self.assertTrue(taster.likes(self.type_1_sf))
+
 
 from click.testing import CliRunner
 
@@ -391,3 +491,735 @@ class TestRefineFilter(TestCase):
         self.assertEqual(45, filter._angle_difference(45, 0))
         self.assertEqual(45, filter._angle_difference(359, 44))
         self.assertEqual(45, filter._angle_difference(44, 359))
+
+
+class FakeConnection:
+    def __init__(self):
+        self.received = []
+        self.closed = False
+        self.shut_down = False
+
+    def sendall(self, data):
+        self.received.append(data)
+
+    def shutdown(self, how):
+        self.shut_down = True
+
+    def close(self):
+        self.closed = True
+
+
+class TestClientFeed(TestCase):
+    def test_drop_oldest(self):
+        feed = ClientFeed(FakeConnection(), buffer_size=2, policy='drop-oldest')
+        for data in [b'1', b'2', b'3']:
+            feed.offer(data)
+        self.assertEqual(1, feed.dropped_count)
+        self.assertEqual([b'2', b'3'], [data for _, data in feed.buffer])
+
+    def test_drop_newest(self):
+        feed = ClientFeed(FakeConnection(), buffer_size=2, policy='drop-newest')
+        for data in [b'1', b'2', b'3']:
+            feed.offer(data)
+        self.assertEqual(1, feed.dropped_count)
+        self.assertEqual([b'1', b'2'], [data for _, data in feed.buffer])
+
+    def test_disconnect(self):
+        connection = FakeConnection()
+        feed = ClientFeed(connection, buffer_size=2, policy='disconnect')
+        for data in [b'1', b'2', b'3']:
+            feed.offer(data)
+        self.assertFalse(feed.open)
+        self.assertTrue(connection.shut_down)
+        self.assertFalse(feed.offer(b'4'))
+        feed.start()
+        feed.finish(1)
+        self.assertTrue(connection.closed)
+        self.assertEqual([], connection.received)
+
+    def test_drains_on_finish(self):
+        connection = FakeConnection()
+        feed = ClientFeed(connection)
+        feed.start()
+        feed.offer(b'1\n')
+        feed.offer(b'2\n')
+        feed.finish(1)
+        self.assertEqual(b'1\n2\n', b''.join(connection.received))
+        self.assertEqual(2, feed.sent_count)
+        self.assertTrue(connection.closed)
+
+
+class TestFanOutServer(TestCase):
+    def test_relays_filtered_sentences(self):
+        server = FanOutServer(taster=Taster(sentence_type=[1])).start()
+        try:
+            client = socket.create_connection(server.address[:2])
+            while len(server.stats()['clients']) < 1:
+                time.sleep(0.01)
+            server.publish(TestTaster.type_1_la)
+            server.publish(TestTaster.type_5)
+        finally:
+            server.close()
+        with client.makefile('r') as f:
+            lines = f.readlines()
+        client.close()
+        self.assertEqual(["1452468552.938 !AIVDM,1,1,,B,14Wtnn002SGLde:BbrBmdTLF0Vql,0*6E\n"], lines)
+        self.assertEqual(2, server.stats()['received'])
+        self.assertEqual(1, server.stats()['published'])
+
+    def test_disconnects_stalled_client(self):
+        server = FanOutServer(buffer_size=1000, policy='disconnect').start()
+        client = socket.create_connection(server.address[:2])
+        try:
+            while len(server.stats()['clients']) < 1:
+                time.sleep(0.01)
+            feed = server.clients[0]
+            for i in range(1000):
+                for j in range(500):
+                    server.publish(TestTaster.type_1_la)
+                if not feed.open:
+                    break
+                time.sleep(0.01)  # lets the sender fill the socket until it blocks
+            self.assertFalse(feed.open)
+            feed.thread.join(5)
+            self.assertFalse(feed.thread.is_alive())
+            self.assertEqual(-1, feed.connection.fileno())
+        finally:
+            server.close()
+            client.close()
+
+
+class TestSentenceRing(TestCase):
+    def test_quiet_feed_is_flushed(self):
+        with SentenceRing.create(capacity=4, max_delay=0.01) as ring:
+            with SentenceRing.attach(ring.name) as reader:
+                ring.publish(TestTaster.type_1_la, 17)
+                deadline = time.time() + 5
+                while reader.lag() == 0 and time.time() < deadline:
+                    time.sleep(0.01)
+                self.assertEqual(1, reader.lag())
+
+    def test_publish_and_read(self):
+        with SentenceRing.create(capacity=4) as ring:
+            with SentenceRing.attach(ring.name) as reader:
+                ring.publish(TestTaster.type_1_la, 17)
+                ring.publish(TestTaster.type_5, 18)
+                self.assertEqual(0, reader.lag())
+                ring.flush()
+                self.assertEqual(2, reader.lag())
+
+                records = reader.read()
+                self.assertTrue(reader.intact())
+                self.assertEqual([1, 5], list(records['type']))
+                self.assertEqual([17, 18], list(records['offset']))
+                self.assertEqual(int(TestTaster.type_1_la['mmsi']), records[0]['mmsi'])
+                self.assertEqual([True, False], list(Expression("type = 1 and lon < 0").mask(records)))
+                self.assertAlmostEqual(TestTaster.type_1_la['lon'], records[0]['lon'])
+                self.assertAlmostEqual(1452468552.938, records[0]['time'])
+                self.assertTrue(math.isnan(records[1]['lat']))
+                del records
+                self.assertEqual(0, reader.lag())
+
+    def test_overrun(self):
+        with SentenceRing.create(capacity=4, batch_size=1) as ring:
+            with SentenceRing.attach(ring.name) as reader:
+                for offset in range(6):
+                    ring.publish(TestTaster.type_1_la, offset)
+                records = reader.read()
+                self.assertEqual(2, reader.overrun_count)
+                self.assertEqual([2, 3], list(records['offset']))  # wraps, so the rest comes next read
+                self.assertEqual([4, 5], list(reader.read()['offset']))
+                del records
+
+    def test_follow_until_closed(self):
+        ring = SentenceRing.create(capacity=4, batch_size=1)
+        reader = SentenceRing.attach(ring.name, from_start=True)
+        ring.publish(TestTaster.type_1_la, 1)
+        ring.close()
+        self.assertEqual([[1]], [list(b['offset']) for b in reader.follow()])
+        reader.close()
+
+
+def _count_lines(source):
+    with open(source) as f:
+        return len(f.readlines())
+
+
+class TestSourceExpansion(TestCase):
+    def test_directories_and_globs(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as directory:
+            os.makedirs(os.path.join(directory, 'b'))
+            for name in ['a.ais', 'c.ais.gz', os.path.join('b', 'a.ais'), '.hidden']:
+                open(os.path.join(directory, name), 'w').close()
+
+            self.assertEqual([os.path.join(directory, n) for n in ['a.ais', 'c.ais.gz', os.path.join('b', 'a.ais')]],
+                             list(expand_sources([directory])))
+            self.assertEqual([os.path.join(directory, 'a.ais')],
+                             list(expand_sources([os.path.join(directory, '*.ais')])))
+            self.assertEqual(['http://example.com/*.ais', 'missing*.ais'],
+                             list(expand_sources(['http://example.com/*.ais', 'missing*.ais'])))
+
+    def test_parallel_processing_isolates_failures(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as directory:
+            sources = []
+            for lines in range(1, 5):
+                sources.append(os.path.join(directory, "{}.ais".format(lines)))
+                with open(sources[-1], 'w') as f:
+                    f.write("line\n" * lines)
+            sources.insert(2, os.path.join(directory, "missing.ais"))
+
+            expected = [(s, n) for s, n in zip(sources[:2] + sources[3:], [1, 2, 3, 4])]
+            with LogCapture() as logs:
+                self.assertEqual(expected, list(process_sources(sources, _count_lines, jobs=1)))
+                self.assertEqual(expected, list(process_sources(sources, _count_lines, jobs=2)))
+                self.assertEqual(sorted(expected),
+                                 sorted(process_sources(sources, _count_lines, jobs=2, ordered=False)))
+            self.assertEqual(6, len(logs.records))
+
+    def test_parallel_info_matches_serial(self):
+        import tempfile
+        sample = os.path.join(os.path.dirname(__file__), 'sample.ais')
+        with open(sample) as f:
+            lines = f.readlines()[:600]
+        runner = CliRunner()
+        with tempfile.TemporaryDirectory() as directory:
+            for i in range(3):
+                with open(os.path.join(directory, "part{}.ais".format(i)), 'w') as f:
+                    f.writelines(lines[i * 200:(i + 1) * 200])
+            for command, args in [(info, ['-i', '-t']), (stat, ['-f', 'type']), (grep, ['-t', '5'])]:
+                serial = runner.invoke(command, args + [directory])
+                parallel = runner.invoke(command, args + ['--jobs', '2', directory])
+                self.assertEqual(serial.output, parallel.output, "for {}".format(command.name))
+
+    def test_failed_decompressor_fails_the_command(self):
+        import lzma
+        import tempfile
+        from unittest import mock
+        failing = {'.xz': [[sys.executable, '-c', 'raise SystemExit(3)']]}
+        with tempfile.TemporaryDirectory() as directory, mock.patch.dict('simpleais.EXTERNAL_DECOMPRESSORS', failing):
+            path = os.path.join(directory, 'sample.ais.xz')
+            with lzma.open(path, 'wt') as f:
+                f.write("1452468552.938 !AIVDM,1,1,,B,14Wtnn002SGLde:BbrBmdTLF0Vql,0*6E\n")
+            result = CliRunner().invoke(cat, [path])
+            self.assertEqual(1, result.exit_code)
+            self.assertIn("failed with status 3 for source {}".format(path), result.output)
+
+
+def _mmsi_counts(shard):
+    return count_values(['mmsi'], shard.sentences())
+
+
+class TestMapReduce(TestCase):
+    sample = os.path.join(os.path.dirname(__file__), 'sample.ais')
+
+    def test_shards(self):
+        shards = shards_for([self.sample], shard_size=300000)
+        self.assertEqual(["{}[0:300000]".format(self.sample), "{}[300000:600000]".format(self.sample),
+                          "{}[600000:{}]".format(self.sample, os.path.getsize(self.sample))],
+                         [str(s) for s in shards])
+
+    def test_matches_serial(self):
+        serial = count_values(['mmsi'], sentences_from_source(self.sample))
+        parallel = map_reduce([self.sample], _mmsi_counts, merge_counts, defaultdict(int), jobs=3, shard_size=100000)
+        self.assertEqual(list(serial.items()), list(parallel.items()))
+
+
+class TestReadAheadOption(TestCase):
+    sample = os.path.join(os.path.dirname(__file__), 'sample.ais')
+
+    def test_reports_stats_when_verbose(self):
+        runner = CliRunner()
+        plain = runner.invoke(cat, [self.sample])
+        with LogCapture() as logs:
+            result = runner.invoke(cat, ['--read-ahead', '4', '--verbose', self.sample])
+        self.assertEqual(0, result.exit_code)
+        self.assertEqual(plain.output, result.output)
+        reports = [r for r in logs.records if r.getMessage().startswith("read-ahead for")]
+        self.assertEqual(['WARNING'], [r.levelname for r in reports])
+        self.assertIn("peak depth", reports[0].getMessage())
+
+    def test_refuses_jobs(self):
+        result = CliRunner().invoke(info, ['--read-ahead', '4', '-j', '2', self.sample])
+        self.assertEqual(2, result.exit_code)
+        self.assertIn("--read-ahead only applies", result.output)
+
+
+class TestVesselShards(TestCase):
+    def test_matches_single_stage(self):
+        sample = os.path.join(os.path.dirname(__file__), 'sample.ais')
+        sentences = list(sentences_from_source(sample))[:2000]
+        stage = RefineStage()
+        expected = [r for r in (stage.process(s) for s in sentences) if r is not None]
+
+        shards = VesselShards(RefineStage, jobs=3, chunk_size=100, in_flight=2)
+        self.assertEqual(expected, list(shards.run(sentences)))
+
+    def test_refine_refuses_follow_with_jobs(self):
+        sample = os.path.join(os.path.dirname(__file__), 'sample.ais')
+        result = CliRunner().invoke(refine, ['-j', '2', '--follow', sample])
+        self.assertEqual(2, result.exit_code)
+        self.assertIn("can't be combined with --follow", result.output)
+
+
+class TestExternalSorter(TestCase):
+    sentences = parse(["3.0 !AIVDM,1,1,,A,15Mw0GP01SG?W>PE`laU<TJj0L20,0*67",
+                       "1.0 !WSVDM,2,1,0,A,5=JklSl00003UHDs:20l4E9<f04i@4U:22222217,0*4C",
+                       "1.0 !WSVDM,2,2,0,A,05B0dl0HtS000000000000000000008,2*00",
+                       "2.0 !AIVDM,1,1,,B,14Wtnn002SGLde:BbrBmdTLF0Vql,0*6E",
+                       "!AIVDM,1,1,,A,Auju3sUbv8u`:JBCIf?vOeCSWmp:JOGeRN@?iD=I,0*61",
+                       "1.5 !AIVDM,1,1,,A,15Mw0GP01SG?W>PE`laU<TJj0L20,0*67"])
+
+    def sort(self, **kwargs):
+        sorter = ExternalSorter(**kwargs)
+        for sentence in self.sentences:
+            sorter.add(sentence)
+        return [[line.split(' ')[0] for line in lines] for lines in sorter.sorted()]
+
+    def test_by_time(self):
+        expected = [['1.000', '1.000'], ['1.500'], ['2.000'],
+                    ['!AIVDM,1,1,,A,Auju3sUbv8u`:JBCIf?vOeCSWmp:JOGeRN@?iD=I,0*61'], ['3.000']]
+        self.assertEqual(expected, self.sort())
+        self.assertEqual(expected, self.sort(run_size=2))
+        self.assertEqual(expected, self.sort(run_size=1, merge_width=2, compress=True))
+
+    def test_by_mmsi(self):
+        # senders are 366985310, 900527247, 310327000, 925844462, and 366985310 again
+        expected = [['2.000'], ['1.500'], ['3.000'], ['1.000', '1.000'],
+                    ['!AIVDM,1,1,,A,Auju3sUbv8u`:JBCIf?vOeCSWmp:JOGeRN@?iD=I,0*61']]
+        self.assertEqual(expected, self.sort(by='mmsi'))
+        self.assertEqual(expected, self.sort(by='mmsi', run_size=2))
+
+    def test_cleans_up(self):
+        sorter = ExternalSorter(run_size=1)
+        for sentence in self.sentences:
+            sorter.add(sentence)
+        directory = sorter.temp.name
+        self.assertEqual(5, len(os.listdir(directory)))
+        list(sorter.sorted())
+        self.assertFalse(os.path.exists(directory))
+
+
+class TestWriterPool(TestCase):
+    def test_reopens_for_append(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as directory:
+            pool = WriterPool(max_open=2)
+            paths = [os.path.join(directory, name) for name in ['a', 'b', 'c.gz']]
+            for i in range(3):
+                for path in paths:
+                    pool.write(path, "{}\n".format(i))
+                self.assertLessEqual(len(pool.open_files), 2)
+            pool.close()
+            self.assertEqual(9, pool.open_count)
+            with open(paths[0]) as f:
+                self.assertEqual("0\n1\n2\n", f.read())
+            import gzip
+            with gzip.open(paths[2], 'rt') as f:
+                self.assertEqual("0\n1\n2\n", f.read())
+
+    def test_batching(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as directory:
+            pool = WriterPool(batch_lines=2, max_batched=3)
+            a, b = os.path.join(directory, 'a'), os.path.join(directory, 'b')
+            pool.write(a, "1\n")
+            self.assertEqual(0, pool.open_count)
+            pool.write(a, "2\n")
+            self.assertEqual(1, pool.open_count)
+            pool.write(a, "3\n")
+            pool.write(b, "1\n")
+            pool.write(os.path.join(directory, 'c'), "1\n")
+            self.assertEqual(0, pool.batched_count)
+            pool.close()
+            with open(a) as f:
+                self.assertEqual("1\n2\n3\n", f.read())
+
+
+class TestBurst(TestCase):
+    def test_few_open_files(self):
+        import tempfile
+        sample = os.path.join(os.path.dirname(__file__), 'sample.ais')
+        runner = CliRunner()
+        with tempfile.TemporaryDirectory() as plain, tempfile.TemporaryDirectory() as pooled:
+            runner.invoke(burst, [sample, os.path.join(plain, 'out.ais')])
+            result = runner.invoke(burst, ['--max-open', '3', '--batch', '10', '--shard-digits', '2', sample,
+                                           os.path.join(pooled, 'out.ais')])
+            self.assertEqual(0, result.exit_code)
+            names = sorted(os.listdir(plain))
+            self.assertEqual(361, len(names))
+            for name in names:
+                mmsi = name[len('out-'):-len('.ais')]
+                with open(os.path.join(plain, name)) as expected, \
+                        open(os.path.join(pooled, mmsi[:2], name)) as actual:
+                    self.assertEqual(expected.read(), actual.read())
+
+    def test_compressed_by_extension(self):
+        import tempfile
+        sample = os.path.join(os.path.dirname(__file__), 'sample.ais')
+        runner = CliRunner()
+        with tempfile.TemporaryDirectory() as plain, tempfile.TemporaryDirectory() as packed:
+            runner.invoke(burst, [sample, os.path.join(plain, 'out.ais')])
+            result = runner.invoke(burst, [sample, os.path.join(packed, 'out.ais.xz')])
+            self.assertEqual(0, result.exit_code)
+            for name in os.listdir(plain):
+                with open(os.path.join(plain, name)) as expected, \
+                        lzma.open(os.path.join(packed, name + '.xz'), 'rt') as actual:
+                    self.assertEqual(expected.read(), actual.read())
+
+
+    def test_missing_compressor(self):
+        import tempfile
+        from unittest import mock
+        sample = os.path.join(os.path.dirname(__file__), 'sample.ais')
+
+        def missing():
+            raise ValueError("zstd output needs the zstandard module")
+
+        with tempfile.TemporaryDirectory() as packed, mock.patch('simpleais.tools._zstd_module', missing):
+            result = CliRunner().invoke(burst, ['--compress', 'zst', sample, os.path.join(packed, 'out.ais')])
+            self.assertEqual(2, result.exit_code)
+            self.assertIn("needs the zstandard module", result.output)
+            self.assertEqual([], os.listdir(packed))
+
+
+class TestWhere(TestCase):
+    sample = os.path.join(os.path.dirname(__file__), 'sample.ais')
+
+    def test_grep(self):
+        result = CliRunner().invoke(grep, ['--where', 'type in (1, 2, 3) and speed > 20', self.sample])
+        self.assertEqual(0, result.exit_code)
+        self.assertEqual(929, len(result.output.splitlines()))
+
+    def test_stat(self):
+        result = CliRunner().invoke(stat, ['-f', 'type', '-w', 'speed > 20', '-j', '2', self.sample])
+        self.assertEqual(["1   915", "3    14", "18    7"], result.output.splitlines())
+
+    def test_near(self):
+        args = ['--near', '-118.25', '33.73', '--radius', '5', self.sample]
+        serial = CliRunner().invoke(grep, args)
+        self.assertEqual(3208, len(serial.output.splitlines()))
+        self.assertEqual(serial.output, CliRunner().invoke(grep, ['-j', '2'] + args).output)
+        self.assertEqual(2, CliRunner().invoke(grep, ['-j', '2', '--follow'] + args).exit_code)
+
+    def test_polygon(self):
+        import json
+        import tempfile
+        port = {"type": "Polygon", "coordinates": [[[-118.4, 33.6], [-118.1, 33.6], [-118.1, 33.8], [-118.4, 33.8]]]}
+        with tempfile.NamedTemporaryFile('w', suffix='.geojson') as f:
+            json.dump(port, f)
+            f.flush()
+            serial = CliRunner().invoke(grep, ['--polygon', f.name, self.sample])
+            parallel = CliRunner().invoke(grep, ['--polygon', f.name, '-j', '2', self.sample])
+            boxed = CliRunner().invoke(grep, ['--lon', '-118.4', '-118.1', '--lat', '33.6', '33.8', self.sample])
+        self.assertEqual(0, serial.exit_code)
+        self.assertLess(0, len(serial.output))
+        self.assertEqual(boxed.output, serial.output)
+        self.assertEqual(serial.output, parallel.output)
+
+    def test_bad_expression(self):
+        result = CliRunner().invoke(to_json, ['--where', 'sped > 20', self.sample])
+        self.assertEqual(2, result.exit_code)
+        self.assertIn("unknown field 'sped'", result.output)
+        result = CliRunner().invoke(grep, ['--where', "speed between 1 and '5'", self.sample])
+        self.assertEqual(2, result.exit_code)
+        self.assertIn("two numbers or two strings", result.output)
+
+
+class Position:
+    def __init__(self, time, mmsi, lon, lat):
+        self.time = time
+        self.values = {'mmsi': mmsi, 'lon': lon, 'lat': lat}
+
+    def location(self):
+        return self.values['lon'], self.values['lat']
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+
+class TestGeofenceMonitor(TestCase):
+    def monitor(self, **options):
+        from simpleais.geo import Polygon, PolygonIndex
+        zones = PolygonIndex([Polygon([[[0, 0], [2, 0], [2, 2], [0, 2]]], "west"),
+                              Polygon([[[1, 0], [3, 0], [3, 2], [1, 2]]], "east")])
+        return GeofenceMonitor(zones, **options)
+
+    def kinds(self, events):
+        return [(e.kind, e.zone) for e in events]
+
+    def test_enter_and_exit(self):
+        monitor = self.monitor()
+        self.assertEqual([], monitor.process(Position(100, '1', -1, 1)))
+        self.assertEqual([('enter', 'west')], self.kinds(monitor.process(Position(110, '1', 0.5, 1))))
+        self.assertEqual([('enter', 'east')], self.kinds(monitor.process(Position(120, '1', 1.5, 1))))
+        self.assertEqual([], monitor.process(Position(125, '1', 1.6, 1)))
+        events = monitor.process(Position(130, '1', 2.5, 1))
+        self.assertEqual([('exit', 'west')], self.kinds(events))
+        self.assertEqual(20, events[0].duration)
+        self.assertEqual([('exit', 'east')], self.kinds(monitor.process(Position(140, '1', 5, 1))))
+        self.assertEqual(0, monitor.vessels_inside())
+
+    def test_dwell_is_reported_once(self):
+        monitor = self.monitor(dwell=60)
+        monitor.process(Position(0, '1', 0.5, 1))
+        self.assertEqual([], monitor.process(Position(30, '1', 0.5, 1)))
+        self.assertEqual([('dwell', 'west')], self.kinds(monitor.process(Position(61, '1', 0.5, 1))))
+        self.assertEqual([], monitor.process(Position(90, '1', 0.5, 1)))
+
+    def test_state_is_bounded(self):
+        monitor = self.monitor(max_vessels=2)
+        for mmsi in ['1', '2', '3']:
+            monitor.process(Position(0, mmsi, 0.5, 1))
+        self.assertEqual(2, monitor.vessels_inside())
+        self.assertEqual(1, monitor.forgotten_count)
+        self.assertEqual([('enter', 'west')], self.kinds(monitor.process(Position(10, '1', 0.5, 1))))
+
+    def test_command(self):
+        import json
+        import tempfile
+        sample = os.path.join(os.path.dirname(__file__), 'sample.ais')
+        zones = {"type": "Feature", "properties": {"name": "LA approach"}, "geometry": {
+            "type": "Polygon", "coordinates": [[[-118.4, 33.6], [-118.1, 33.6], [-118.1, 33.8], [-118.4, 33.8]]]}}
+        with tempfile.NamedTemporaryFile('w', suffix='.geojson') as f:
+            json.dump(zones, f)
+            f.flush()
+            result = CliRunner().invoke(fence, [f.name, sample])
+        self.assertEqual(0, result.exit_code)
+        lines = result.output.splitlines()
+        self.assertLess(0, len(lines))
+        self.assertTrue(all(line.split()[3:5] in (['enter', 'LA'], ['exit', 'LA']) for line in lines))
+
+
+class TestCompressedOutput(TestCase):
+    lines = ["{} line {}".format(i, "x" * (i % 50)) for i in range(5000)]
+
+    def round_trip(self, format, opener):
+        from io import BytesIO
+        file = BytesIO()
+        output = CompressedOutput(file, format, threads=3, block_size=1000, close_file=False)
+        for line in self.lines:
+            output.write(line + "\n")
+        output.close()
+        with opener(BytesIO(file.getvalue()), 'rt') as f:
+            self.assertEqual(self.lines, f.read().splitlines())
+
+    def test_formats(self):
+        self.round_trip('gz', gzip.open)
+        self.round_trip('bz2', bz2.open)
+        self.round_trip('xz', lzma.open)
+
+    def test_format_by_name(self):
+        self.assertEqual('gz', compression_for('out.ais.gz'))
+        self.assertEqual('zst', compression_for('out.ZST'))
+        self.assertIsNone(compression_for('out.ais'))
+        self.assertIsNone(compression_for(None))
+
+    def test_cat_to_compressed_file(self):
+        import tempfile
+        sample = os.path.join(os.path.dirname(__file__), 'sample.ais')
+        runner = CliRunner()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'out.ais.gz')
+            plain = runner.invoke(cat, [sample])
+            result = runner.invoke(cat, ['-o', path, sample])
+            self.assertEqual(0, result.exit_code)
+            with gzip.open(path, 'rt') as f:
+                self.assertEqual(plain.output, f.read())
+
+    def test_grep_to_compressed_stdout(self):
+        sample = os.path.join(os.path.dirname(__file__), 'sample.ais')
+        runner = CliRunner()
+        plain = runner.invoke(grep, ['-t', '5', sample])
+        result = runner.invoke(grep, ['-t', '5', '--compress', 'xz', sample])
+        self.assertEqual(0, result.exit_code)
+        self.assertEqual(plain.output, lzma.decompress(result.stdout_bytes).decode())
+
+
+class TestLineOutput(TestCase):
+    def test_unbuffered(self):
+        from io import StringIO
+        file = StringIO()
+        output = LineOutput(file, buffered=False)
+        output.write("one")
+        self.assertEqual("one\n", file.getvalue())
+
+    def test_buffered_by_size(self):
+        from io import StringIO
+        file = StringIO()
+        output = LineOutput(file, buffered=True, block_size=8, flush_interval=60)
+        output.write("one")
+        self.assertEqual("", file.getvalue())
+        output.write("two")
+        self.assertEqual("one\ntwo\n", file.getvalue())
+        output.write("three")
+        output.close()
+        self.assertEqual("one\ntwo\nthree\n", file.getvalue())
+
+    def test_buffered_by_time(self):
+        from io import StringIO
+        file = StringIO()
+        output = LineOutput(file, buffered=True, flush_interval=0.01)
+        output.write_sentence(TestTaster.type_5)
+        time.sleep(0.2)
+        self.assertEqual(2, len(file.getvalue().splitlines()))
+        output.close()
+
+    def test_buffered_by_default_when_not_a_terminal(self):
+        from io import StringIO
+        self.assertTrue(LineOutput(StringIO()).buffered)
+
+
+class TestTilePyramid(TestCase):
+    def build(self, directory, positions, **options):
+        pyramid = TilePyramid(directory, **options)
+        for position in positions:
+            pyramid.add(position)
+        pyramid.finish()
+        return pyramid
+
+    def test_levels_add_up(self):
+        import tempfile
+        positions = [Position(i, '1', -122.4 + (i % 50) / 10, 37.8 - (i % 30) / 10) for i in range(1000)]
+        with tempfile.TemporaryDirectory() as directory:
+            pyramid = self.build(directory, positions, max_zoom=6, tile_size=16, max_tiles=1, batch_size=100)
+            self.assertGreater(pyramid.spill_count, len(pyramid.saved_tiles(6)))
+            self.assertGreater(len(pyramid.saved_tiles(6)), 1)
+            self.assertEqual([(0, 0)], pyramid.saved_tiles(0))
+            for zoom in range(7):
+                total = sum(numpy.load(pyramid.path(zoom, x, y)).sum() for x, y in pyramid.saved_tiles(zoom))
+                self.assertEqual(1000, total)
+            world = numpy.load(pyramid.path(0, 0, 0))
+            self.assertEqual((16, 16), world.shape)
+            self.assertEqual(1000, world[6, 2])
+
+    def test_dedup(self):
+        import tempfile
+        positions = [Position(t, mmsi, 0 if t < 5000 else 1, 0) for t in range(0, 7200, 10) for mmsi in '12']
+        with tempfile.TemporaryDirectory() as directory:
+            pyramid = self.build(directory, positions, max_zoom=10, dedup=3600)
+            # two vessels, two hours, and a move to another pixel during the second hour
+            self.assertEqual(6, pyramid.position_count)
+            self.assertEqual(len(positions) - 6, pyramid.duplicate_count)
+
+    def test_refuses_to_overwrite(self):
+        import tempfile
+        sample = os.path.join(os.path.dirname(__file__), 'sample.ais')
+        with tempfile.TemporaryDirectory() as directory:
+            result = CliRunner().invoke(heatmap, [directory, sample, '-z', '4', '--tile-size', '64'])
+            self.assertEqual(0, result.exit_code, result.output)
+            self.assertEqual((64, 64), numpy.load(os.path.join(directory, '4', '2', '6.npy')).shape)
+            self.assertNotEqual(0, CliRunner().invoke(heatmap, [directory, sample]).exit_code)
+            self.assertEqual(0, CliRunner().invoke(heatmap, [directory, sample, '-z', '4', '--tile-size', '64', '--append']).exit_code)
+
+
+class TestApproximate(TestCase):
+    sample = os.path.join(os.path.dirname(__file__), 'sample.ais')
+
+    def test_stat(self):
+        exact = CliRunner().invoke(stat, ['-f', 'mmsi', self.sample]).output.splitlines()
+        result = CliRunner().invoke(stat, ['-f', 'mmsi', '--approx', '--top', '3', '-j', '2', self.sample])
+        self.assertEqual(0, result.exit_code, result.output)
+        lines = result.output.splitlines()
+        self.assertEqual(exact[:3], lines[:3])
+        self.assertTrue(lines[3].startswith("about 361 distinct values in 9471 sentences"))
+
+    def test_info(self):
+        result = CliRunner().invoke(info, ['--approx', self.sample])
+        self.assertTrue(result.output.startswith("Found about 361 senders in 9471 good sentences"))
+        self.assertNotEqual(0, CliRunner().invoke(info, ['--approx', '--individual', self.sample]).exit_code)
+
+    def test_quantiles(self):
+        result = CliRunner().invoke(stat, ['-q', 'speed', '-f', 'type', '-j', '2', self.sample])
+        self.assertEqual(0, result.exit_code, result.output)
+        lines = result.output.splitlines()
+        self.assertEqual("type  count     mean  min  5%  25%  50%  75%   95%   max", lines[0])
+        self.assertEqual(["1", "6663", "5.05304", "0"], lines[1].split()[:4])
+        self.assertEqual(["18", "440", "2.89818", "0"], lines[3].split()[:4])
+        self.assertEqual("28.1", lines[3].split()[-1])
+
+    def test_interval_quantiles(self):
+        result = CliRunner().invoke(stat, ['-q', 'interval', self.sample])
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertEqual("all", result.output.splitlines()[1].split()[0])
+        for options in [['-j', '2'], ['--sample', 'lines:10']]:
+            self.assertNotEqual(0, CliRunner().invoke(stat, ['-q', 'interval'] + options + [self.sample]).exit_code)
+        result = CliRunner().invoke(stat, ['-q', 'interval', '--sample', 'vessels:0.5', self.sample])
+        self.assertEqual(0, result.exit_code, result.output)
+
+    def test_quantiles_leave_out_not_available(self):
+        sentences = list(sentences_from_source(self.sample))
+        unknown_speed = [s for s in sentences if s['speed'] == 102.3][0]
+        self.assertEqual({}, summarize_values('speed', [], [unknown_speed]))
+        summary = summarize_values('speed', [], sentences)[()]
+        self.assertLess(summary.max, 102.3)
+        self.assertAlmostEqual(4.64, summary.mean(), 2)
+        self.assertLess(summarize_values('course', [], sentences)[()].max, 360)
+
+    def test_quantile_histogram(self):
+        result = CliRunner().invoke(stat, ['-q', 'speed', '-h', '--range', '0', '30', '--bins', '6', self.sample])
+        self.assertEqual(0, result.exit_code, result.output)
+        lines = result.output.splitlines()
+        self.assertEqual("all:", lines[3])
+        self.assertEqual(["0", "to", "5", "5636"], lines[4].split()[:4])
+        self.assertEqual(["25", "to", "30", "735"], lines[-1].split()[:4])  # unknown speeds aren't above it
+        self.assertNotEqual(0, CliRunner().invoke(stat, ['-q', 'speed', '-h', self.sample]).exit_code)
+
+    def test_sample(self):
+        result = CliRunner().invoke(info, ['--sample', 'lines:10', '-t', self.sample])
+        self.assertEqual(0, result.exit_code, result.output)
+        lines = result.output.splitlines()
+        self.assertEqual("Estimated from a sample of 954 of 9543 lines, scaled up 10 times.", lines[0])
+        self.assertTrue(lines[1].startswith("Found at least "))
+        result = CliRunner().invoke(stat, ['-f', 'type', '--sample', 'vessels:0.5', self.sample])
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertTrue(all(int(line.split()[1]) % 2 == 0 for line in result.output.splitlines() if line[0].isdigit()))
+        self.assertNotEqual(0, CliRunner().invoke(info, ['--sample', 'lines:10', '-j', '2', self.sample]).exit_code)
+        self.assertNotEqual(0, CliRunner().invoke(stat, ['-f', 'type', '--sample', 'lines', self.sample]).exit_code)
+
+
+class TestWindowCommand(TestCase):
+    sample = os.path.join(os.path.dirname(__file__), 'sample.ais')
+
+    def test_counts(self):
+        result = CliRunner().invoke(window, ['--size', '120', self.sample])
+        self.assertEqual(0, result.exit_code, result.output)
+        counts = [int(line.split()[-1]) for line in result.output.splitlines()]
+        self.assertEqual(9471, sum(counts))
+        self.assertEqual(5, len(counts))
+
+    def test_sliding_by_channel(self):
+        result = CliRunner().invoke(window, ['--size', '120', '--slide', '60', '-f', 'channel', '--senders',
+                                             self.sample])
+        self.assertEqual(0, result.exit_code, result.output)
+        lines = [line.split() for line in result.output.splitlines()]
+        first = [line[2:] for line in lines if line[1] == lines[0][1]]
+        self.assertEqual('all', first[0][0])
+        self.assertEqual('senders', first[1][0])
+        self.assertEqual(int(first[0][1]), sum(int(count) for label, count in first[2:]))
+        self.assertEqual({'A', 'B'}, {label for label, count in first[2:]})
+        self.assertNotEqual(0, CliRunner().invoke(window, ['--size', '60', '--slide', '120', self.sample]).exit_code)
+
+    def test_follow_reports_windows_while_the_source_is_quiet(self):
+        import subprocess
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'live.ais')
+            with open(self.sample) as source, open(path, 'w') as live:
+                live.writelines(source.readlines()[:100])
+            # the file stops growing, but its sentences are long past, so the clock ends their window
+            process = subprocess.Popen([sys.executable, '-m', 'simpleais.tools', 'window', '--size', '3600',
+                                        '--follow', '--unbuffered', path],
+                                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+            timer = threading.Timer(30, process.kill)
+            timer.start()
+            try:
+                line = process.stdout.readline()
+            finally:
+                timer.cancel()
+                process.kill()
+                process.wait()
+                process.stdout.close()
+        self.assertEqual(["all", "90"], line.split()[-2:])  # some sentences take two lines
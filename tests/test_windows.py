@@ -0,0 +1,98 @@
+import threading
+from unittest import TestCase
+
+from simpleais.windows import *
+
+
+class Stub:
+    def __init__(self, time, mmsi='1', type_id=1):
+        self.time = time
+        self.mmsi = mmsi
+        self.type = type_id
+
+    def __getitem__(self, key):
+        return {'mmsi': self.mmsi, 'type': self.type}[key]
+
+
+def at(*times):
+    return [Stub(t) for t in times]
+
+
+class TestWindows(TestCase):
+    def test_tumbling(self):
+        windows = Windows(SentenceCount, 10)
+        results = list(windows.windows(at(1, 2, 9.999, 10, 15, 31)))
+        self.assertEqual([WindowResult(0, 10, 3), WindowResult(10, 20, 2), WindowResult(30, 40, 1)], results)
+
+    def test_sliding_windows_agree_with_counting_directly(self):
+        times = [i * 0.7 for i in range(200)]
+        results = list(Windows(SentenceCount, 10, slide=4).windows(at(*times)))
+        self.assertEqual(-8, results[0].start)
+        for result in results:
+            self.assertEqual(len([t for t in times if result.start <= t < result.end]), result.value)
+            self.assertEqual(10, result.end - result.start)
+        self.assertEqual(list(range(-8, 140, 4)), [r.start for r in results])
+
+    def test_results_come_as_windows_finish(self):
+        windows = Windows(SentenceCount, 10, lateness=2)
+        self.assertEqual([], windows.process(Stub(5)))
+        self.assertEqual([], windows.process(Stub(11)))
+        self.assertEqual([WindowResult(0, 10, 1)], windows.process(Stub(12)))
+        self.assertEqual([WindowResult(10, 20, 2)], windows.flush())
+
+    def test_lateness(self):
+        windows = Windows(SentenceCount, 10, lateness=5)
+        results = [r for s in at(1, 12, 8, 16, 9, 25) for r in windows.process(s)] + windows.flush()
+        # 8 is within lateness of 12; 9 arrives after the watermark passed 10
+        self.assertEqual([WindowResult(0, 10, 2), WindowResult(10, 20, 2), WindowResult(20, 30, 1)], results)
+        self.assertEqual(1, windows.late_count)
+
+    def test_gaps_are_skipped_without_losing_open_windows(self):
+        windows = Windows(SentenceCount, 60, lateness=30)
+        results = [r for s in at(0, 200, 175, 1000000) for r in windows.process(s)] + windows.flush()
+        self.assertEqual([WindowResult(0, 60, 1), WindowResult(120, 180, 1), WindowResult(180, 240, 1),
+                          WindowResult(999960, 1000020, 1)], results)
+        self.assertEqual(0, windows.late_count)
+
+    def test_memory_stays_bounded(self):
+        windows = Windows(SentenceCount, 60, slide=15, lateness=10)
+        largest = 0
+        for i in range(20000):
+            windows.process(Stub(i * 0.5))
+            largest = max(largest, len(windows.panes))
+        self.assertLessEqual(largest, 6)
+
+    def test_untimed_sentences_go_with_the_newest(self):
+        results = list(Windows(SentenceCount, 10).windows(at(None, 3, None, 12, None)))
+        self.assertEqual([WindowResult(0, 10, 2), WindowResult(10, 20, 2)], results)
+
+    def test_aggregators(self):
+        factories = {'all': SentenceCount, 'types': lambda: CountBy(lambda s: s['type']), 'senders': DistinctSenders}
+        sentences = [Stub(t, mmsi=str(t % 7), type_id=1 + t % 2) for t in range(100)]
+        results = list(Windows(lambda: Aggregators(factories), 50, slide=25).windows(sentences))
+        self.assertEqual({'all': 50, 'types': {1: 25, 2: 25}, 'senders': 7}, results[1].value)
+        self.assertEqual([25, 50, 50, 50, 25], [r.value['all'] for r in results])
+
+    def test_clock_ends_windows_on_a_stalled_source(self):
+        stalled = threading.Event()
+        resume = threading.Event()
+
+        def source():
+            yield from at(1, 5, 12)
+            stalled.set()
+            resume.wait(10)
+            yield Stub(25)
+
+        windows = Windows(SentenceCount, 10, lateness=2)
+        results = windows.windows(source(), clock=lambda: 40, idle_interval=0.01)
+        # while the source is stalled, the clock finishes both windows
+        self.assertEqual(WindowResult(0, 10, 2), next(results))
+        self.assertEqual(WindowResult(10, 20, 1), next(results))
+        self.assertTrue(stalled.is_set())
+        resume.set()
+        self.assertEqual([], list(results))
+        self.assertEqual(1, windows.late_count)  # 25 is behind the watermark the clock set
+
+    def test_bad_sizes(self):
+        self.assertRaises(ValueError, Windows, SentenceCount, 0)
+        self.assertRaises(ValueError, Windows, SentenceCount, 10, slide=20)